@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the tiles pre-processing stages on synthetic H&E-like tiles, which does not require QuPath nor real WSIs.
+
+A folder of synthetic JPEG tiles is generated (tissue tiles obtained by the Beer-Lambert mixing of hematoxylin and eosin, background tiles
+made of almost transparent pixels), then each stage of the pre-processing is timed on it: decode, median intensity, filter, Macenko
+normalization, JPEG encoding, tiles store and pickle writing, and finally the whole pipeline.saveRes. The same tiles are also stitched into
+a synthetic pyramidal TIFF, to time reading them in-process (tilesTiff) instead of decoding them from JPEG files. For each stage the throughput
+(tiles per second) and the peak resident memory are reported; the results are saved as json and can be compared against a baseline.
+
+Example of usage:
+    python benchmark.py --numTiles 256 --output bench.json
+    python benchmark.py --numTiles 256 --output bench_new.json --baseline bench.json
+"""
+import argparse
+import io
+import json
+import math
+import numpy as np
+import os
+import pickle
+import platform
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+
+import preprocessing
+from tilesMetrics import peakRSS, resetPeakRSS
+from tilesStore import tilesStoreWriter
+from tilesTiff import tiffSlide, tiffTiles, writeTiledTiff
+
+# Stain OD vectors (columns: hematoxylin, eosin) used to synthesize the tiles
+HESynth = np.array([[0.65, 0.07],
+                    [0.70, 0.99],
+                    [0.29, 0.11]])
+
+
+def makeSyntheticTiles(folder, numTiles=256, tileSize=512, backgroundFraction=0.2, seed=0, Io=240):
+
+    '''Writes numTiles synthetic H&E-like JPEG tiles of tileSize x tileSize pixels into folder. A fraction backgroundFraction of
+    the tiles is made of background (low stain concentrations), the others of tissue with varying stain concentrations.'''
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for k in range(numTiles):
+        if rng.random() < backgroundFraction:
+            scale = rng.uniform(0.005, 0.03)
+        else:
+            scale = rng.uniform(0.1, 0.6)
+        C = rng.gamma(2.0, scale, size=(2, tileSize*tileSize))
+        I = Io * np.exp(-HESynth.dot(C))
+        img = I.T.reshape((tileSize, tileSize, 3)) + rng.normal(0, 3, (tileSize, tileSize, 3))
+        Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(os.path.join(folder, f"synthetic_({k})_{k+1}.jpg"), quality=90)
+
+
+def timeStage(results, stage, numTiles, func):
+
+    '''Runs func, records its wall time, throughput and peak resident memory under results[stage] and returns its output.'''
+
+    resetPeakRSS()
+    time_start = time.perf_counter()
+    out = func()
+    elapsed = time.perf_counter() - time_start
+    results[stage] = {"seconds": elapsed, "tilesPerSec": numTiles / elapsed if elapsed > 0 else None, "peakRSS_MB": peakRSS()}
+    print(f"{stage:>15}: {elapsed:8.3f} secs  {results[stage]['tilesPerSec'] or 0:9.1f} tiles/s  {results[stage]['peakRSS_MB']:8.1f} MB")
+    return out
+
+
+def runBenchmark(workDir, numTiles=256, tileSize=512, backgroundFraction=0.2, batchSize=16, seed=0, lowerPerc=10, upperPerc=90):
+
+    ''' Generates the synthetic tiles under workDir and times each pre-processing stage on them. Returns the results as a dictionary.'''
+
+    slide = "synthetic"
+    tilesDir = os.path.join(workDir, "tiles")
+    wsiTilesDir = os.path.join(tilesDir, slide)
+    makeSyntheticTiles(wsiTilesDir, numTiles, tileSize, backgroundFraction, seed)
+    tiles = preprocessing.readFiles(wsiTilesDir)
+
+    results = {}
+    decoded = timeStage(results, "decode", numTiles, lambda: [preprocessing.readTile(os.path.join(wsiTilesDir, i)) for i in tiles])
+
+    # The tiles are stitched row by row into an uncompressed TIFF, whose annotation covers all of them
+    cols = math.ceil(math.sqrt(numTiles))
+    mosaic = np.full((math.ceil(numTiles / cols) * tileSize, cols * tileSize, 3), 255, dtype=np.uint8)
+    for k, np_img in enumerate(decoded):
+        mosaic[k // cols * tileSize:(k // cols + 1) * tileSize, k % cols * tileSize:(k % cols + 1) * tileSize] = np_img
+    writeTiledTiff(os.path.join(workDir, "synthetic.tif"), mosaic, tileSize = 256, numLevels = 1)
+    del mosaic
+    fullRows = numTiles // cols
+    border = np.array([[1, 1], [cols * tileSize - 1, 1], [cols * tileSize - 1, fullRows * tileSize - 1], [1, fullRows * tileSize - 1]], dtype=np.float64)
+    tiff = tiffSlide(os.path.join(workDir, "synthetic.tif"))
+    timeStage(results, "tiffRead", fullRows * cols, lambda: [np.array(tile) for name, tile in tiffTiles(tiff, [[border]], tileSize)])
+    tiff.close()
+    logMedians = timeStage(results, "median", numTiles, lambda: np.log10(np.array([np.median(np_img) for np_img in decoded])))
+    darkTh, whiteTh, tilesToKeep = timeStage(results, "filter", numTiles, lambda: preprocessing.filterTiles(logMedians, lowerPerc, upperPerc))
+
+    kept = [np_img for np_img, keep in zip(decoded, tilesToKeep) if keep]
+    del decoded
+    keptNames = [i for i, keep in zip(tiles, tilesToKeep) if keep]
+
+    def normalize():
+        normTiles = []
+        for k in range(0, len(kept), batchSize):
+            Inorm, valid = preprocessing.macenkoNormBatch(np.stack(kept[k:k+batchSize]))
+            normTiles.extend(Inorm[valid])
+        return normTiles
+    normTiles = timeStage(results, "normalization", len(kept), normalize)
+
+    def encode():
+        for normTile in normTiles:
+            Image.fromarray(normTile).save(io.BytesIO(), format="JPEG")
+    timeStage(results, "encode", len(normTiles), encode)
+
+    def storeWrite():
+        with tilesStoreWriter(os.path.join(workDir, "store")) as store:
+            for name, normTile in zip(keptNames, normTiles):
+                store.add(name, normTile)
+    timeStage(results, "storeWrite", len(normTiles), storeWrite)
+
+    def pickleWrite():
+        with open(os.path.join(workDir, "normTiles.pickle"), 'wb') as fn:
+            pickle.dump(dict(zip(keptNames, normTiles)), fn)
+    timeStage(results, "pickleWrite", len(normTiles), pickleWrite)
+    del kept, normTiles
+
+    preprocessingResDir = os.path.join(workDir, "preprocessingRes")
+    timeStage(results, "saveRes", numTiles, lambda: preprocessing.pipeline.saveRes(tilesDir, preprocessingResDir, slide, {slide: 0}, {}, False,
+                                                                                   lowerPerc = lowerPerc, upperPerc = upperPerc, batchSize = batchSize))
+
+    return {"config": {"numTiles": numTiles, "tileSize": tileSize, "backgroundFraction": backgroundFraction, "batchSize": batchSize, "seed": seed,
+                       "numTilesKept": int(np.count_nonzero(tilesToKeep)), "numpy": np.__version__, "python": platform.python_version(),
+                       "machine": platform.machine(), "cpus": os.cpu_count()},
+            "stages": results}
+
+
+def compareBaseline(results, baseline):
+
+    ''' Prints, for each stage, the ratio between the current and the baseline wall times (> 1 means slower than the baseline).'''
+
+    print('\n' "Comparison with the baseline (time ratio, > 1 means slower):")
+    for stage, res in results["stages"].items():
+        if stage in baseline["stages"] and baseline["stages"][stage]["seconds"] > 0:
+            print(f"{stage:>15}: {res['seconds'] / baseline['stages'][stage]['seconds']:6.2f}x")
+
+
+def create_parser():
+    Description = "********* Benchmark of the tiles pre-processing stages on synthetic H&E-like tiles. *********"
+
+    Epilog = "Example of usage: benchmark.py --numTiles 256 --output bench.json --baseline previous_bench.json"
+
+    parser = argparse.ArgumentParser(description = Description, epilog = Epilog, formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--numTiles', nargs = '?', default = 256, type = int, dest = "NUM_TILES", help = 'Number of synthetic tiles to generate')
+
+    parser.add_argument('--tileSize', nargs = '?', default = 512, type = int, dest = "TILE_SIZE", help = 'Edge length (in pixels) of the synthetic tiles')
+
+    parser.add_argument('--backgroundFraction', nargs = '?', default = 0.2, type = float, dest = "BACKGROUND_FRACTION", help = 'Fraction of background tiles')
+
+    parser.add_argument('--batchSize', nargs = '?', default = 16, type = int, dest = "BATCH_SIZE", help = 'Number of tiles normalized together in a single batch')
+
+    parser.add_argument('--seed', nargs = '?', default = 0, type = int, dest = "SEED", help = 'Seed of the synthetic tiles generator')
+
+    parser.add_argument('--workDir', nargs = '?', default = None, type = str, dest = "WORK_DIR", help = 'Folder where tiles and results are written (default: a temporary folder, removed at the end)')
+
+    parser.add_argument('--output', nargs = '?', default = None, type = str, dest = "OUTPUT", help = 'Absolute path to the .json file where the results will be saved')
+
+    parser.add_argument('--baseline', nargs = '?', default = None, type = str, dest = "BASELINE", help = 'Absolute path to the .json file of a previous benchmark to compare with')
+
+    return parser
+
+
+if __name__ == "__main__":
+
+    args = create_parser().parse_args()
+
+    workDir = args.WORK_DIR if args.WORK_DIR is not None else tempfile.mkdtemp(prefix = "tilGenProBench_")
+    try:
+        results = runBenchmark(workDir, args.NUM_TILES, args.TILE_SIZE, args.BACKGROUND_FRACTION, args.BATCH_SIZE, args.SEED)
+    finally:
+        if args.WORK_DIR is None:
+            shutil.rmtree(workDir, ignore_errors = True)
+
+    if args.OUTPUT is not None:
+        with open(args.OUTPUT, 'w') as fn:
+            json.dump(results, fn, indent = 2)
+        print('\n' f"The benchmark results have been saved under: {args.OUTPUT}")
+
+    if args.BASELINE is not None:
+        with open(args.BASELINE) as fn:
+            compareBaseline(results, json.load(fn))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Reports how many keep/discard decisions of the quality filter change, for a given WSI, when the median intensities are computed
+on tiles decoded at reduced resolution (tilesPreprocessing.py --fastFilterScale) instead of at full resolution.
+"""
+from preprocessing import compareFastIntensity
+import argparse
+import json
+
+def create_parser():
+    Description = "********* Compare the full-resolution and the reduced-resolution quality filter on the tiles of a WSI. *********"
+
+    Epilog = "Example of usage: compareFastFilter.py <TILES_DIR>/<WSI_NAME> --scale 4"
+
+    parser = argparse.ArgumentParser(description = Description, epilog = Epilog, formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('WSI_TILES_DIR', type = str, help = 'Absolute path to the folder containing the tiles generated for the WSI')
+
+    parser.add_argument('--scale', nargs = '?', default = 4, type = int, dest = "SCALE", help = 'Reduction factor of the tiles resolution')
+
+    parser.add_argument('--lowerPerc', nargs = '?', default = 10, type = int, dest = "LOWER_PERCENTILE", help = 'Lower percentile for tiles filtering')
+
+    parser.add_argument('--upperPerc', nargs = '?', default = 90, type = int, dest = "UPPER_PERCENTILE", help = 'Upper percentile for tiles filtering')
+
+    parser.add_argument('--json', nargs = '?', default = None, type = str, dest = "JSON_FILE", help = 'Absolute path to a .json file where the full report will be saved')
+
+    return parser
+
+args = create_parser().parse_args()
+
+report = compareFastIntensity(args.WSI_TILES_DIR, args.LOWER_PERCENTILE, args.UPPER_PERCENTILE, args.SCALE)
+
+print('\n' f"Tiles analyzed: {report['numTiles']}")
+print(f"Tiles kept at full resolution: {report['keptFull']} ({report['timeFull']:.1f} secs)")
+print(f"Tiles kept at 1/{report['scale']} resolution: {report['keptFast']} ({report['timeFast']:.1f} secs)")
+print(f"Dark threshold (log10): {report['darkThFull']:.4f} (full) vs {report['darkThFast']:.4f} (reduced)")
+print(f"White threshold (log10): {report['whiteThFull']:.4f} (full) vs {report['whiteThFast']:.4f} (reduced)")
+print(f"Maximum difference between log10-transformed median intensities: {report['maxLogMedianDiff']:.4f}")
+print(f"Tiles with a different keep/discard decision: {report['numDifferent']} ({100*report['numDifferent']/max(1, report['numTiles']):.2f}%)")
+for tile in report['differentTiles']:
+    print(f"  {tile}")
+
+if args.JSON_FILE is not None:
+    with open(args.JSON_FILE, 'w') as fn:
+        json.dump(report, fn, indent = 2)
+    print('\n' f"The report has been saved under: {args.JSON_FILE}")
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Reports, for the tiles of a given WSI, the error of the stain normalization when the stain vectors are estimated on a subsample of the
+pixels of each tile (tilesPreprocessing.py --stainSampleSize) instead of on all of them.
+"""
+from preprocessing import compareStainSampling
+import argparse
+import json
+import os
+
+def create_parser():
+    Description = "********* Compare the exact and the approximate (pixel subsample) stain normalization on the tiles of a WSI. *********"
+
+    Epilog = "Example of usage: compareStainSampling.py <TILES_DIR>/<WSI_NAME> --sampleSize 16384"
+
+    parser = argparse.ArgumentParser(description = Description, epilog = Epilog, formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('WSI_TILES_DIR', type = str, help = 'Absolute path to the folder containing the tiles generated for the WSI')
+
+    parser.add_argument('--sampleSize', nargs = '?', default = 16384, type = int, dest = "SAMPLE_SIZE", help = 'Number of pixels of each tile used to estimate the stain vectors')
+
+    parser.add_argument('--sampling', nargs = '?', default = "strided", choices = ["strided", "random"], type = str, dest = "SAMPLING", help = 'Pixel subsample: evenly spaced or random (with a fixed seed) pixels')
+
+    parser.add_argument('--batchSize', nargs = '?', default = 16, type = int, dest = "BATCH_SIZE", help = 'Number of tiles normalized together in a single batch')
+
+    parser.add_argument('--numTiles', nargs = '?', default = None, type = int, dest = "NUM_TILES", help = 'Only compare the first NUM_TILES tiles of the WSI')
+
+    parser.add_argument('--json', nargs = '?', default = None, type = str, dest = "JSON_FILE", help = 'Absolute path to a .json file where the full report, including the error of each tile, will be saved')
+
+    return parser
+
+args = create_parser().parse_args()
+
+tileNames = None
+if args.NUM_TILES is not None:
+    tileNames = sorted(os.listdir(args.WSI_TILES_DIR))[:args.NUM_TILES]
+
+report = compareStainSampling(args.WSI_TILES_DIR, args.SAMPLE_SIZE, args.SAMPLING, args.BATCH_SIZE, tileNames)
+
+print('\n' f"Tiles analyzed: {report['numTiles']} (failed: {report['numFailedExact']} exact, {report['numFailedApprox']} approximate)")
+print(f"Time taken: {report['timeExact']:.1f} secs (exact) vs {report['timeApprox']:.1f} secs ({report['sampleSize']} {report['sampling']} pixels)")
+print(f"Mean absolute difference (intensity levels): {report['meanAbsDiff']:.3f} on average, {report['p99MeanAbsDiff']:.3f} at the 99th percentile of the tiles")
+print(f"Maximum absolute difference (intensity levels): {report['maxAbsDiff']}")
+worstTiles = sorted([tile for tile in report['tiles'] if tile['meanAbsDiff'] is not None], key = lambda tile: tile['meanAbsDiff'], reverse = True)[:10]
+print("Tiles with the largest mean absolute difference:")
+for tile in worstTiles:
+    print(f"  {tile['tile']}: mean {tile['meanAbsDiff']:.3f}, max {tile['maxAbsDiff']}")
+
+if args.JSON_FILE is not None:
+    with open(args.JSON_FILE, 'w') as fn:
+        json.dump(report, fn, indent = 2)
+    print('\n' f"The report has been saved under: {args.JSON_FILE}")
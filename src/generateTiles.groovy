@@ -32,7 +32,8 @@ def name = GeneralTools.getNameWithoutExtension(ImageData.getServer().getMetadat
 name_n = name.replaceAll("\\s","")
 
 // The file path were to store the generated tiles will be dinamically created basing on the user.
-def pathOutput = buildFilePath('/bioinfo_archive/AI/UTUC_Erlangen_Marburg/qupathProjUTER_server_test/tiles', name_n)
+// The TILES_DIR environment variable, if set, replaces the tiles directory (e.g. a staging folder of a node of a distributed run).
+def pathOutput = buildFilePath(System.getenv("TILES_DIR") ?: '/bioinfo_archive/AI/UTUC_Erlangen_Marburg/qupathProjUTER_server_test/tiles', name_n)
 mkdirs(pathOutput)
 
 
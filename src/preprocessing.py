@@ -12,20 +12,35 @@ Created on Thu Oct 14 17:56:50 2021
 @author: angelomm
 """
 
+import csv
+import json
 import logging
-import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np 
 import operator
 import os
-import pandas as pd
 import pickle
+import queue
+import shutil
 import subprocess
 import sys 
+import threading
 import time
+import traceback
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from PIL import Image
 
-from tqdm import tqdm
+
+from tilesLeases import commitFolder, leaseManager, writeJson
+from tilesManifest import isComplete, loadManifest, manifestPath, tileStat, unchangedTiles
+from tilesMetrics import folderSize, metricsRecorder
+from tilesStains import loadStains, saveStains, stainsPath
+from tilesSketch import loadSketch, midpointPercentile, quantileSketch, saveSketch, sketchPath
+from tilesStore import countTiles, tilesStore, tilesStoreWriter
+from tilesTiff import gridTiles, loadAnnotations, tiffSlide
+from tilesWriter import asyncWriter, queueLogging, saveJpeg, stopLogging
 
 
 ### DEFINITION OF THE MAIN VARIABLES NECESSARY TO RUN THE SCRIPT
@@ -38,17 +53,22 @@ from tqdm import tqdm
 # 7) wsiList --> list of WSIs to process
 # 8) lowerPerc --> percentile correspondent to the dark threshold on the log10-transformed median intesity pixel values distribution for a given WSI
 # 9) upperPerc --> percentile correspondent to the white threshold on the log10-transformed median intesity pixel values distribution for a given WSI
+# 10) thresholdMode --> distribution the two percentiles are computed on: the tiles of each WSI ("slide", default), of all the WSIs processed ("cohort") or of the WSIs of the same group of slidesToProcess.csv ("group")
+
+# Columns of infoWSIs.csv filled from the summary of each WSI (see saveSummary)
+summaryColumns = ['Slide', 'numTilesInit', 'numTilesAfterPreproc', 'numTilesDiscarded', 'numTilesFailed', 'lowerPerc', 'upperPerc', 'darkTh', 'whiteTh', 'generationTime', 'preprocessingTime']
 
 ### AUXILIARY FUNCTIONS ###
 
 ## Function 1
-def tilesGenerator(qupathProj, shellScript, groovyScript, wsi=None):
+def tilesGenerator(qupathProj, shellScript, groovyScript, wsi=None, tilesDir=None):
     
-    """ Generates tiles through the execution of a shell script that, in turn, runs the qupath command on the provided QuPath project and groovy script """
+    """ Generates tiles through the execution of a shell script that, in turn, runs the qupath command on the provided QuPath project and groovy script.
+    If tilesDir is provided, the tiles are written there instead of the tiles directory set in the groovy script (through the TILES_DIR environment variable). """
     
     if wsi is not None:
         p = subprocess.Popen(["sh", f"{shellScript}", f"{wsi}", f"{qupathProj}", \
-                            f"{groovyScript}"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                            f"{groovyScript}"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dict(os.environ, TILES_DIR=tilesDir) if tilesDir is not None else None)
     else:
         p = subprocess.Popen(["sh", f"{shellScript}", f"{qupathProj}", f"{groovyScript}"], \
                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -59,6 +79,95 @@ def tilesGenerator(qupathProj, shellScript, groovyScript, wsi=None):
         if retcode is not None:
             return p.stderr
 
+def projectImages(qupathProj):
+
+    ''' Returns the names of the images (WSIs) of the given QuPath project, as listed in the project file.'''
+
+    with open(qupathProj) as fn:
+        project = json.load(fn)
+    return [image["imageName"] for image in project.get("images", [])]
+
+class generationScheduler:
+
+    '''
+    Runs tiles generation for a list of WSIs as concurrent QuPath processes (one per WSI), at most maxProcesses at a time.
+    The output of each process (shell script and QuPath) is written by the OS directly to its own log file (logDir/<slide>.log), hence it
+    never blocks the pipeline and is not interleaved with the output of the other processes. The exit status and the time taken by each WSI
+    are appended to logDir/generation.csv as soon as its process ends. A WSI whose process fails (non-zero exit status or no tiles generated)
+    is reported as failed, without stopping the generation of the other WSIs.
+    '''
+
+    reportFields = ['Slide', 'exitCode', 'numTiles', 'generationTime', 'failed', 'logFile']
+
+    def __init__(self, qupathProj, shellScript, groovyScript, tilesDir, logDir, maxProcesses=1, pollInterval=0.5):
+
+        self.qupathProj = qupathProj
+        self.shellScript = shellScript
+        self.groovyScript = groovyScript
+        self.tilesDir = tilesDir
+        self.logDir = logDir
+        self.maxProcesses = maxProcesses
+        self.pollInterval = pollInterval
+        os.makedirs(logDir, exist_ok=True)
+
+    def start(self, wsi):
+
+        file = os.path.splitext(wsi)[0].replace(" ", "")
+        logFile = os.path.join(self.logDir, f"{file}.log")
+        # The log of a previous run is replaced; both the shell script and QuPath (through QUPATH_LOG) then append to it
+        open(logFile, 'w').close()
+        with open(logFile, 'a') as log:
+            p = subprocess.Popen(["sh", f"{self.shellScript}", f"{wsi}", f"{self.qupathProj}", f"{self.groovyScript}"], stdin=subprocess.DEVNULL,
+                                 stdout=log, stderr=subprocess.STDOUT, env=dict(os.environ, QUPATH_LOG=logFile))
+        return p, file, logFile
+
+    def report(self, result):
+
+        reportFile = os.path.join(self.logDir, "generation.csv")
+        newReport = not os.path.exists(reportFile)
+        with open(reportFile, 'a', newline='') as fn:
+            writer = csv.DictWriter(fn, fieldnames=self.reportFields)
+            if newReport:
+                writer.writeheader()
+            writer.writerow(result)
+
+    def run(self, wsiList, canStart=None, started=None, stopped=None):
+
+        '''Generates the tiles of the given WSIs and yields, in order of completion, a dictionary per WSI with its name (without extension),
+        the exit status of its process, the number of tiles generated, the time taken, whether it failed and the path of its log file.
+        canStart is an optional callable invoked before starting each process: if it returns False, the process is started later
+        (e.g. when too many WSIs are waiting to be pre-processed). started is an optional callable invoked with the name of each WSI
+        (without extension) once its process has been started. stopped is an optional callable checked at every poll: once it returns True,
+        the processes still running are killed and no more WSIs are generated.'''
+
+        pending = list(wsiList)
+        running = []
+        try:
+            while (pending or running) and (stopped is None or not stopped()):
+                while pending and len(running) < self.maxProcesses and (canStart is None or canStart()):
+                    running.append(self.start(pending.pop(0)) + (time.time(),))
+                    if started is not None:
+                        started(running[-1][1])
+
+                finished = [proc for proc in running if proc[0].poll() is not None]
+                for proc in finished:
+                    running.remove(proc)
+                    p, file, logFile, time_start = proc
+                    wsiTilesDir = os.path.join(self.tilesDir, file)
+                    numTiles = len(os.listdir(wsiTilesDir)) if os.path.isdir(wsiTilesDir) else 0
+                    result = {'Slide': file, 'exitCode': p.returncode, 'numTiles': numTiles, 'generationTime': time.time() - time_start,
+                              'failed': p.returncode != 0 or numTiles == 0, 'logFile': logFile}
+                    self.report(result)
+                    yield result
+
+                if not finished:
+                    time.sleep(self.pollInterval)
+        finally:
+            # If the caller stops early (e.g. an exception), the processes still running are not left behind
+            for p, _, _, _ in running:
+                p.kill()
+                p.wait()
+
 ## Function 2
 def readFiles(dirPath):
 
@@ -67,13 +176,109 @@ def readFiles(dirPath):
     listFiles = [filename for filename in os.listdir(dirPath)] 
     return listFiles
 
+class tilesCache:
+
+    '''
+    Memory-bounded store of decoded tiles, shared between the intensity pass (calculateIntensity) and the normalization pass
+    (macenkoNormTiles) so that each tile is decoded only once. Tiles are added until maxBytes is reached; afterwards new tiles are
+    simply not cached (and will be decoded again when needed). Since tiles are normalized in the same order in which their
+    intensity is computed, this keeps the first tiles to be consumed, and each tile is released as soon as it is popped.
+    '''
+
+    def __init__(self, maxBytes):
+
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+        self.tiles = {}
+
+    def put(self, name, np_img):
+
+        if self.nBytes + np_img.nbytes <= self.maxBytes:
+            self.tiles[name] = np_img
+            self.nBytes += np_img.nbytes
+
+    def pop(self, name, default=None):
+
+        np_img = self.tiles.pop(name, None)
+        if np_img is None:
+            return default
+        self.nBytes -= np_img.nbytes
+        return np_img
+
 ## Function 3
-def calculateIntensity(tilesPath, lowerPerc=10, upperPerc=90):
+def copyTile(srcPath, dstPath):
+
+    '''Stores a copy of the tile file provided in input at the destination path, without decoding it: the file is hard-linked
+    when possible (same file system) and its bytes are copied otherwise.'''
+
+    if os.path.exists(dstPath):
+        os.remove(dstPath)
+    try:
+        os.link(srcPath, dstPath)
+    except OSError:
+        shutil.copyfile(srcPath, dstPath)
+
+## Function 4
+def readTile(tilePath, scale=1):
+
+    '''Decodes the tile provided in input into a numpy array. If scale > 1, the tile is decoded at about 1/scale of its resolution:
+    JPEG tiles are decoded directly at reduced resolution through the PIL draft mode (which supports 1/2, 1/4 and 1/8 scaling),
+    any remaining reduction (or the whole one for other formats) is obtained by subsampling the decoded pixels.'''
+
+    img = Image.open(tilePath)
+    if scale == 1:
+        return np.array(img)
+
+    w, h = img.size
+    img.draft(img.mode, (max(1, w // scale), max(1, h // scale)))
+    np_img = np.array(img)
+    step = max(1, np_img.shape[1] // max(1, w // scale))
+    return np_img[::step, ::step]
+
+## Function 5
+def logMedianIntensity(tilesPath, tiles, cache=None, scale=1, loader=None):
+
+    '''Returns the log10-transformed median intensity pixel values of the given tiles.
+    If a tilesCache is provided, the decoded tiles are stored in it for the following normalization step.
+    If scale > 1, the median intensities are computed on tiles decoded at reduced resolution (see readTile): this is faster, but the
+    resulting keep/discard decisions may slightly differ from the full-resolution ones (see compareFastIntensity). In this case the
+    decoded tiles are not cached, since they cannot be normalized.
+    Tiles are decoded from tilesPath, unless a loader (a function returning the tile given its name and scale, e.g. tilesFolder.read) is provided.
+    '''
+
+    medianIntensities = []
+    for filename in tiles:
+        np_img = loader(filename, scale) if loader is not None else readTile(os.path.join(tilesPath, filename), scale)
+        medianIntensities.append(np.median(np_img))
+        if cache is not None and scale == 1:
+            cache.put(filename, np_img)
+    return np.log10(np.array(medianIntensities))
+
+def filterTiles(logMedianIntensities, lowerPerc=10, upperPerc=90, thresholds=None):
+
+    '''Given the log10-transformed median intensity pixel values of the tiles of a WSI, returns the values correspondent to the
+    lower and upper percentiles and a list of booleans indicating which tile needs to be kept (True) or discarded (False).
+    If thresholds (darkTh, whiteTh) are provided (e.g. computed on a whole cohort, see cohortThresholds), they are used instead of the percentiles of the WSI.'''
+
+    if thresholds is not None:
+        darkTh, whiteTh = thresholds
+    else:
+        darkTh = midpointPercentile(logMedianIntensities, lowerPerc)
+        whiteTh = midpointPercentile(logMedianIntensities, upperPerc)
+    
+    # Create a list where each element is a logical condition met by the tiles associated with the analyzed WSI:
+    # tilesToKeep[i] = True if tile's log10 median intensity lays between the two thresholds, otherweise tilesToKeep[i] = False.
+    tilesToKeep = (operator.ge(logMedianIntensities, darkTh) & operator.le(logMedianIntensities, whiteTh))
+
+    return darkTh, whiteTh, tilesToKeep
+
+def calculateIntensity(tilesPath, lowerPerc=10, upperPerc=90, cache=None, scale=1, thresholds=None):
 
     '''For each WSI to process, the function returns in output:
     - the list of log10-transformed median intensity pixel values associated with each tile 
     - the log10-transformed median intensity pixel values correspondend to the 10th and 90th percentiles
     - a list of booleans indicating which tile needs to be kept (True) or discarded (False)
+    cache and scale are passed to logMedianIntensity, thresholds to filterTiles.
     '''
     
     # Note: the function "calculateIntensity" takes into account that all the tiles belonging to a WSI are saved in a single folder.
@@ -81,23 +286,50 @@ def calculateIntensity(tilesPath, lowerPerc=10, upperPerc=90):
     
     # Store in a list all the median intensity values associated with each tile belonging to a given WSI
     tiles = readFiles(tilesPath)
-    medianIntensities = [np.median(Image.open(os.path.join(tilesPath, filename))) for filename in tiles]
-    logMedianIntensities = np.log10(np.array(medianIntensities))
-    darkTh = np.percentile(logMedianIntensities, lowerPerc, interpolation = 'midpoint')
-    whiteTh = np.percentile(logMedianIntensities, upperPerc, interpolation = 'midpoint')
-    
-    # Create a list where each element is a logical condition met by the tiles associated with the analyzed WSI:
-    # tilesToKeep[i] = True if tile's log10 median intensity lays between the two thresholds, otherweise tilesToKeep[i] = False.
-    tilesToKeep = (operator.ge(logMedianIntensities, darkTh) & operator.le(logMedianIntensities, whiteTh))
+    logMedianIntensities = logMedianIntensity(tilesPath, tiles, cache, scale)
+    darkTh, whiteTh, tilesToKeep = filterTiles(logMedianIntensities, lowerPerc, upperPerc, thresholds)
 
     return logMedianIntensities, darkTh, whiteTh, tilesToKeep
+
+## Function 6
+def compareFastIntensity(tilesPath, lowerPerc=10, upperPerc=90, scale=4):
+
+    '''Runs the quality filter of a WSI both at full resolution and at reduced resolution (scale) and returns a dictionary reporting
+    how much the two differ: number of tiles, tiles kept by each pass, number and names of the tiles with a different keep/discard decision,
+    thresholds, maximum absolute difference between the log10-transformed median intensities and time taken by each pass.'''
+
+    time_start = time.time()
+    logMedianFull, darkThFull, whiteThFull, keepFull = calculateIntensity(tilesPath, lowerPerc, upperPerc)
+    time_full = time.time() - time_start
+    time_start = time.time()
+    logMedianFast, darkThFast, whiteThFast, keepFast = calculateIntensity(tilesPath, lowerPerc, upperPerc, scale=scale)
+    time_fast = time.time() - time_start
+
+    tiles = readFiles(tilesPath)
+    differing = [tile for countPos, tile in enumerate(tiles) if keepFull[countPos] != keepFast[countPos]]
+
+    return {"numTiles": len(tiles),
+            "scale": scale,
+            "keptFull": int(np.count_nonzero(keepFull)),
+            "keptFast": int(np.count_nonzero(keepFast)),
+            "numDifferent": len(differing),
+            "differentTiles": differing,
+            "darkThFull": float(darkThFull), "darkThFast": float(darkThFast),
+            "whiteThFull": float(whiteThFull), "whiteThFast": float(whiteThFast),
+            "maxLogMedianDiff": float(np.max(np.abs(logMedianFull - logMedianFast))) if len(tiles) > 0 else 0.0,
+            "timeFull": time_full,
+            "timeFast": time_fast}
     
-## Function 4
+## Function 7
 def histIntensities(logMedianIntensities, darkTh, whiteTh, filePath):
     
     '''Given the list of tiles log10-transformed median intensity pixel values associated with a given WSI,
     the function plots a histogram, highlighting the 10th and 90th percentiles, and save it in the specified file path'''
     
+    # matplotlib is imported only when a histogram is rendered, since it makes every process importing this module (e.g. the
+    # normalization workers) slower to start
+    import matplotlib.pyplot as plt
+
     n, bins, patches = plt.hist(logMedianIntensities, 60, density = False, facecolor = "r", alpha = 0.75)
     plt.xlabel('Median intensity value (log10)')
     plt.ylabel('Frequency')
@@ -107,35 +339,167 @@ def histIntensities(logMedianIntensities, darkTh, whiteTh, filePath):
     plt.savefig(filePath)
     plt.clf()
     plt.close()
+
+def renderHistogram(preprocessingResDir, file):
+
+    '''Renders the histogram of the log10-transformed median intensities of a WSI from its manifest, i.e. from the intensities and thresholds
+    saved by saveRes. Returns the path of the histogram, or None if the WSI has no manifest or its thresholds have not been computed yet.'''
+
+    normTilesFolder = os.path.join(preprocessingResDir, f"normTiles/{file}")
+    manifest = loadManifest(manifestPath(normTilesFolder, file))
+    if manifest is None or manifest["darkTh"] is None:
+        return None
+    filePath = os.path.join(normTilesFolder, f"Hist_log_trans_RGB_{file}.png")
+    histIntensities([tile["logMedian"] for tile in manifest["tiles"].values()], manifest["darkTh"], manifest["whiteTh"], filePath)
+    return filePath
+
+def renderReports(preprocessingResDir, slides=None, workers=1):
+
+    '''Renders the histograms of the given WSIs (all the WSIs pre-processed under preprocessingResDir if slides is None) through workers
+    processes. It is the deferred report stage of pipelines run with deferReport = True. Returns the paths of the histograms rendered.'''
+
+    if slides is None:
+        slides = sorted(os.listdir(os.path.join(preprocessingResDir, "normTiles")))
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            paths = pool.map(partial(renderHistogram, preprocessingResDir), slides)
+    else:
+        paths = [renderHistogram(preprocessingResDir, file) for file in slides]
+    return [path for path in paths if path is not None]
     
-## Function 5
-def extractInfo(tilesDir, preprocessingResDir, resDir, wsiDir):
+## Function 8
+def summaryPath(normTilesFolder, file):
+
+    ''' Returns the path of the summary sidecar of the given WSI.'''
+
+    return os.path.join(normTilesFolder, f"summary_{file}.json")
+
+def saveSummary(normTilesFolder, file, summary):
+
+    '''Saves the summary of the pre-processing of a WSI (counts, thresholds and timings) in a small json sidecar, next to its results.
+    The sidecar is written atomically (see tilesLeases.writeJson), so that a reader never finds it half written.'''
+
+    writeJson(summaryPath(normTilesFolder, file), summary, indent = 2)
+
+def loadSummary(tilesDir, preprocessingResDir, file):
+
+    '''Returns the summary of the pre-processing of a WSI. For results produced before summaries were introduced, the number of tiles
+    before and after pre-processing is recomputed from the tiles folder and from the normalized tiles. The counts that cannot be
+    recomputed (e.g. the tiles generation of the WSI failed, hence it has neither tiles nor results) are None.'''
+
+    import pandas as pd
+
+    normTilesFolder = os.path.join(preprocessingResDir, f"normTiles/{file}")
+    try:
+        with open(summaryPath(normTilesFolder, file)) as fn:
+            return json.load(fn)
+    except (OSError, ValueError):
+        pass
+
+    wsiTilesDir = os.path.join(tilesDir, file)
+    summary = {"Slide": file, "numTilesInit": len(os.listdir(wsiTilesDir)) if os.path.isdir(wsiTilesDir) else None, "numTilesAfterPreproc": None}
+    picklePath = os.path.join(normTilesFolder, f"normTiles_{file}")
+    if os.path.isdir(f"{picklePath}.store"):
+        summary["numTilesAfterPreproc"] = countTiles(f"{picklePath}.store")
+    elif os.path.isfile(picklePath):
+        summary["numTilesAfterPreproc"] = len(pd.read_pickle(fr'{picklePath}'))
+    return summary
 
-    '''Provide in output a data frame containing information (e.g. initial number of tiles, number of tiles after pre-processing, etc) on the WSIs processed
+class tilesFolder:
+
+    """Tiles of a WSI generated through QuPath, stored as image files under path. The per-WSI pre-processing (see pipeline.saveRes) reads the
+    tiles through this interface, shared with tiffTilesSource: the names of the tiles, the settings of the source (stored in the manifest
+    next to the pre-processing ones), a description logged instead of the tiles generation time (None for QuPath tiles), stats() returning
+    the (size, modification time) of the source of each tile (see tilesManifest), read() decoding a tile (see readTile), copy() storing a
+    discarded tile and chunkTile() returning the tile passed to normalizeChunk (None meaning that it is decoded from its file). """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.names = readFiles(path)
+        self.settings = {}
+        self.description = None
+
+    def stats(self):
+
+        return {name: tileStat(os.path.join(self.path, name)) for name in self.names}
+
+    def read(self, name, scale=1):
+
+        return readTile(os.path.join(self.path, name), scale)
+
+    def copy(self, name, dstPath, np_img=None):
+
+        copyTile(os.path.join(self.path, name), dstPath)
+
+    def chunkTile(self, name):
+
+        return None
+
+class tiffTilesSource:
+
+    """Tiles of a pyramidal TIFF WSI intersecting its annotations (see tilesTiff), read in-process from the memory-mapped TIFF file, with the
+    same interface as tilesFolder. The tiles are named as the ones generated through QuPath and are never written to the tiles directory: the
+    discarded tiles are encoded as JPEG files and the tiles themselves are passed to the normalization. The source of every tile is the TIFF
+    file, hence all the tiles are considered changed when the TIFF file changes. With scale > 1, read() subsamples the tile by scale. """
+
+    def __init__(self, tiffPath, annotationsPath, file, tileSize=512, level=0):
+
+        if not os.path.isfile(annotationsPath):
+            raise FileNotFoundError(f"The annotations of {file} were not found: export them from QuPath as GeoJSON to {annotationsPath}")
+        self.path = tiffPath
+        self.slide = tiffSlide(tiffPath)
+        self.tileSize = tileSize
+        self.level = level
+        self.origins = gridTiles(self.slide, loadAnnotations(annotationsPath), tileSize, level, file)
+        self.names = list(self.origins)
+        self.settings = {"tileSize": tileSize, "level": level}
+        self.description = f"Tiles read in-process from {tiffPath} (level {level}, {tileSize}x{tileSize} pixels) within the annotations of {annotationsPath}"
+
+    def stats(self):
+
+        stat = tileStat(self.path)
+        return {name: stat for name in self.names}
+
+    def read(self, name, scale=1):
+
+        np_img = self.slide.readRegion(*self.origins[name], self.tileSize, self.tileSize, self.level)
+        return np_img[::scale, ::scale] if scale > 1 else np_img
+
+    def copy(self, name, dstPath, np_img=None):
+
+        saveJpeg(np.asarray(np_img if np_img is not None else self.read(name)), dstPath)
+
+    def chunkTile(self, name):
+
+        return np.asarray(self.read(name))
+
+## Function 9
+def extractInfo(tilesDir, preprocessingResDir, resDir, wsiDir, slides=None):
+
+    '''Provide in output a data frame containing information (e.g. initial number of tiles, number of tiles after pre-processing, etc) on the WSIs processed.
+    The information is collected from the summary sidecars written by saveRes, hence neither tiles nor normalized tiles need to be read.
+    If no data frame of the WSIs to process is provided, the WSIs are the given slides or, if None, the folders of tilesDir.
     '''
 
+    import pandas as pd
+
     if wsiDir == None:
-        df = pd.DataFrame(columns = ['Slide', 'numTilesInit', 'numTilesAfterPreproc'])
-        df['Slide'] = os.listdir(tilesDir)
+        df = pd.DataFrame({'Slide': slides if slides is not None else os.listdir(tilesDir)})
 
     elif os.path.exists(os.path.join(wsiDir, "slidesToProcess.csv")):
         df = pd.read_csv(os.path.join(wsiDir, "slidesToProcess.csv"))
-        df['numTilesInit'] = ""
-        df['numTilesAfterPreproc'] = ""
-        for rowIdx in range(len(df)):
-            wsiName = df.loc[rowIdx, 'Slide']
-            newWsiName = os.path.splitext(wsiName)[0].replace(" ", "")
-            df['Slide'].replace(to_replace = wsiName, value = newWsiName, inplace = True)
-        
-    for rowIdx in range(len(df)):
-        numTiles_init = len(os.listdir(os.path.join(tilesDir, f"{df.loc[rowIdx,'Slide']}")))
-        df.loc[rowIdx, "numTilesInit"] = numTiles_init
-        picklePath = os.path.join(preprocessingResDir, f"normTiles/{df.loc[rowIdx,'Slide']}/normTiles_{df.loc[rowIdx,'Slide']}")
-        pickleFile = pd.read_pickle(fr'{picklePath}')
-        df.loc[rowIdx, "numTilesAfterPreproc"] = len(pickleFile)
+        df['Slide'] = df['Slide'].map(lambda wsiName: os.path.splitext(wsiName)[0].replace(" ", ""))
+    
+    summaries = pd.DataFrame([loadSummary(tilesDir, preprocessingResDir, slide) for slide in df['Slide'].unique()], columns = summaryColumns)
+    # Counts stay integers even if some of them are missing (summaries of results produced by previous versions of the pipeline)
+    summaries = summaries.astype({col: 'Int64' for col in ['numTilesInit', 'numTilesAfterPreproc', 'numTilesDiscarded', 'numTilesFailed', 'lowerPerc', 'upperPerc']})
+    df = df.drop(columns = [col for col in summaryColumns[1:] if col in df.columns]).merge(summaries, on = 'Slide', how = 'left')
     
     # Save the obtained data frame 
-    df.to_csv(os.path.join(resDir, "infoWSIs.csv"), sep = ",", index = False)
+    # The data frame is written to a temporary file first, since several nodes may write it at the same time (see pipeline.distributedRun)
+    df.to_csv(os.path.join(resDir, f"infoWSIs.csv.{os.getpid()}.tmp"), sep = ",", index = False)
+    os.replace(os.path.join(resDir, f"infoWSIs.csv.{os.getpid()}.tmp"), os.path.join(resDir, "infoWSIs.csv"))
     print("\n"         " ---------------------------------------------------------------------------------------------------------------------------------------------------------------")
     csv_filePath = os.path.join(resDir,"infoWSIs.csv")
     print("\n" f"The data-frame containing information on the WSIs processed has been saved under: {csv_filePath}")
@@ -195,7 +559,7 @@ def macenkoNorm(img, Io=240, alpha=1, beta=0.15):
     
     # Calculate the optical density OD = -log(I/Io)
     # Add 1 to avoid log(0) in case any pixels in the image have a value of 0
-    OD = -np.log((np_img.astype(np.float)+1)/Io)
+    OD = -np.log((np_img.astype(np.float64)+1)/Io)
         
     # Remove transparent pixels, i.e. OD intensities less than beta
     ODhat = OD[~np.any(OD<beta, axis=1)]
@@ -246,16 +610,506 @@ def macenkoNorm(img, Io=240, alpha=1, beta=0.15):
     Inorm = np.multiply(Io, np.exp(-HERef.dot(C2)))
     Inorm[Inorm > 255] = 254
     Inorm = np.reshape(Inorm.T, (h, w, 3)).astype(np.uint8)
-        
+
     return Inorm
 
+def maskedPercentile(values, mask, q, inPlace=False):
+
+    '''Row-wise percentiles (numpy's default linear interpolation) of a 2D array, taking into account only the elements where mask is True
+    (all the elements if mask is None). q is a sequence of percentiles; the output has shape (len(q), number of rows). Rows without any valid
+    element return NaN. If inPlace is True and mask is None, values is partially sorted in place instead of being copied.'''
+
+    count = mask.sum(axis=1) if mask is not None else np.full(values.shape[0], values.shape[1])
+    pos = [(np.maximum(count, 1) - 1) * (perc / 100) for perc in q]
+    lo = [np.floor(p).astype(np.int64) for p in pos]
+    hi = [np.ceil(p).astype(np.int64) for p in pos]
+
+    # Push the masked out elements to the end of each row, so that the first count[k] elements of row k are the valid ones.
+    # A partial sort around the positions needed by any of the rows is enough to get all the order statistics.
+    kth = np.unique(np.concatenate(lo + hi))
+    if mask is not None:
+        partValues = np.partition(np.where(mask, values, np.inf), kth, axis=1)
+    elif inPlace:
+        values.partition(kth, axis=1)
+        partValues = values
+    else:
+        partValues = np.partition(values, kth, axis=1)
+
+    res = []
+    for p, l, h in zip(pos, lo, hi):
+        vLo = np.take_along_axis(partValues, l[:,np.newaxis], axis=1)[:,0]
+        vHi = np.take_along_axis(partValues, h[:,np.newaxis], axis=1)[:,0]
+        # Rows without valid elements only hold inf values, whose difference is NaN anyway
+        with np.errstate(invalid='ignore'):
+            res.append(np.where(count == 0, np.nan, vLo + (vHi - vLo) * (p - l)))
+
+    return np.array(res)
+
+class macenkoWorkspace:
+
+    '''
+    Buffers reused by macenkoNormBatch across calls, so that the full-size arrays (optical densities, stain concentrations, normalized
+    intensities) are allocated once rather than for every batch. Each named buffer grows to the largest size requested and smaller
+    requests (e.g. the last batch of a slide) are served by a view of it. A workspace must not be shared by threads running at the
+    same time: by default each thread uses its own one (see defaultWorkspace).
+    '''
+
+    def __init__(self):
+
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.float32):
+
+        ''' Returns an uninitialized array of the given shape and dtype, backed by the buffer called name.'''
+
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if name not in self.buffers or self.buffers[name].nbytes < size:
+            self.buffers[name] = np.empty(size, dtype=np.uint8)
+        return self.buffers[name][:size].view(dtype).reshape(shape)
+
+workspaces = threading.local()
+
+def defaultWorkspace():
+
+    ''' Returns the macenkoWorkspace of the calling thread.'''
+
+    if not hasattr(workspaces, "workspace"):
+        workspaces.workspace = macenkoWorkspace()
+    return workspaces.workspace
+
+odTables = {}
+
+def odTable(Io=240):
+
+    ''' Returns the optical density -log((I+1)/Io) of each of the 256 intensities of a uint8 pixel, as a float32 lookup table.'''
+
+    if Io not in odTables:
+        odTables[Io] = (-np.log((np.arange(256, dtype=np.float64)+1)/Io)).astype(np.float32)
+    return odTables[Io]
+
+def samplePixels(numPixels, sampleSize, sampling="strided", seed=0):
+
+    '''Returns the sorted indices of a deterministic subsample of sampleSize pixels out of numPixels: evenly spaced pixels if sampling is
+    "strided", pixels drawn at random (without replacement, from a generator with a fixed seed) if sampling is "random".'''
+
+    if sampling == "strided":
+        return np.unique(np.linspace(0, numPixels - 1, sampleSize).round().astype(np.int64))
+    elif sampling == "random":
+        return np.sort(np.random.default_rng(seed).choice(numPixels, sampleSize, replace=False))
+    raise ValueError(f"Unknown pixel sampling: {sampling}")
+
+def macenkoStainVectors(OD, alpha=1, beta=0.15, sampleSize=None, sampling="strided", workspace=None):
+
+    '''Estimates, through the Macenko's method, the stain vectors of a stack of tiles given their optical densities (array of shape (N, pixels, 3)).
+    Returns the stain matrices HE (shape (N, 3, 2), hematoxylin first), a numpy array of N booleans which is False for the tiles whose stain
+    vectors cannot be estimated (less than two non-transparent pixels) and the indices of the pixels used for the estimation (None if all the
+    pixels were used, see macenkoNormBatch). The full-size temporaries have the dtype of OD and are taken from workspace, if provided.'''
+
+    numPixels = OD.shape[1]
+    buffer = lambda name, shape: workspace.get(name, shape, OD.dtype) if workspace is not None else np.empty(shape, dtype=OD.dtype)
+
+    # Transparent pixels (i.e. OD intensities less than beta) are not removed but masked out, since their number differs from tile to tile
+    # In approximate mode, the stain vectors are estimated on a subsample of the pixels only
+    idx = samplePixels(numPixels, sampleSize, sampling) if sampleSize is not None and sampleSize < numPixels else None
+    ODs = OD[:,idx] if idx is not None else OD
+    mask = np.minimum(np.minimum(ODs[:,:,0], ODs[:,:,1]), ODs[:,:,2]) >= beta
+    count = mask.sum(axis=1)
+    valid = count > 1
+
+    # Optical density covariance matrix of the non-transparent pixels of each tile, shape (N, 3, 3). The optical densities are centered
+    # on the mean of the non-transparent pixels before accumulating their products, which keeps the covariance accurate also in float32
+    maskOD = mask.astype(OD.dtype)
+    safeCount = np.where(valid, count, 2)
+    meanOD = np.matmul(maskOD[:,np.newaxis,:], ODs)[:,0,:].astype(np.float64) / safeCount[:,np.newaxis]
+    centeredOD = np.subtract(ODs, meanOD[:,np.newaxis,:].astype(OD.dtype), out=buffer("centeredOD", ODs.shape))
+    np.multiply(centeredOD, maskOD[:,:,np.newaxis], out=centeredOD)
+    cov_ODhat = np.matmul(centeredOD.transpose(0,2,1), centeredOD).astype(np.float64) / (safeCount - 1)[:,np.newaxis,np.newaxis]
+    del centeredOD, maskOD
+    # Tiles that cannot be normalized get an identity covariance matrix so that they do not break the batched linear algebra
+    cov_ODhat[~valid] = np.eye(3)
+
+    # Compute eigen values and eigenvectors to create the projection plane of each tile
+    eigvals, eigvecs = np.linalg.eigh(cov_ODhat)
+    proj_plane = eigvecs[:,:,1:3]
+    That = np.matmul(ODs, proj_plane.astype(OD.dtype), out=buffer("That", ODs.shape[:2] + (2,)))
+    del ODs
+
+    # Obtain the angle between point and first SVD direction
+    phi = np.arctan2(That[:,:,1], That[:,:,0], out=buffer("phi", That.shape[:2]))
+    del That
+
+    # Identify angle's extremes, taking into account only the non-transparent pixels
+    minPhi, maxPhi = maskedPercentile(phi, mask, (alpha, 100-alpha)).astype(np.float64)
+    del phi
+    minPhi[~valid] = 0
+    maxPhi[~valid] = 0
+
+    # Convert to OD space and get the stain vectors for hematoxylin and eosin, shape (N, 3)
+    vMin = np.matmul(proj_plane, np.stack((np.cos(minPhi), np.sin(minPhi)), axis=1)[:,:,np.newaxis])[:,:,0]
+    vMax = np.matmul(proj_plane, np.stack((np.cos(maxPhi), np.sin(maxPhi)), axis=1)[:,:,np.newaxis])[:,:,0]
+
+    # Make the vector corresponding to hematoxylin first and the one corresponding to eosin second
+    swap = (vMin[:,0] > vMax[:,0])[:,np.newaxis]
+    HE = np.stack((np.where(swap, vMin, vMax), np.where(swap, vMax, vMin)), axis=2)
+
+    return HE, valid, idx
+
+def macenkoNormBatch(imgs, Io=240, alpha=1, beta=0.15, sampleSize=None, sampling="strided", stains=None, reference=None, workspace=None):
+
+    """
+    Batched version of macenkoNorm: normalize a stack of N same-sized tiles at once through the Macenko's method.
+    Covariance matrices, eigendecompositions, stain saturation and percentiles are computed for all the tiles of the
+    stack together, so that the per-tile Python overhead is paid once per batch.
+
+    Input:
+        imgs: uint8 numpy array of shape (N, h, w, 3) storing the tiles to normalize
+        Io, alpha, beta: same meaning as in macenkoNorm
+        sampleSize: (optional) number of pixels of each tile used to estimate the stain vectors and the stain saturation (approximate mode).
+                    The covariance matrix, the angles and both percentiles are then computed on a deterministic subsample of the pixels
+                    (see samplePixels), while the projection and the reconstruction still run over all the pixels of the tile.
+                    None (default) uses all the pixels (exact mode)
+        sampling: "strided" (default) or "random", the subsample used in approximate mode
+        stains: (optional) tuple (HE, maxC) storing the stain matrix (shape (3, 2)) and the stain saturation (shape (2,)) fitted on the
+                whole slide (see fitSlideStains). If provided, they are used for all the tiles instead of being estimated tile by tile
+        reference: (optional) tuple (HERef, maxCRef) replacing the default reference stain matrix and saturation (e.g. fitted on a reference slide)
+        workspace: (optional) macenkoWorkspace whose buffers are used for the full-size temporaries (by default, the one of the calling thread)
+
+    Output:
+        Inorm: uint8 numpy array of shape (N, h, w, 3) storing the normalized tiles
+        valid: numpy array of N booleans, False for the tiles that could not be normalized
+               (e.g. less than two non-transparent pixels); the corresponding entries of Inorm are meaningless
+
+    The optical densities are read from a 256-entry lookup table (see odTable) and all the per-pixel arithmetic runs in float32 on the
+    preallocated buffers of the workspace, hence the only full-size array allocated by each call is the returned one. In exact mode, each
+    normalized tile matches the one returned by macenkoNorm on the same tile within +/-1 intensity level (the difference is due to
+    floating-point rounding only: the two functions implement the same steps). The error of the
+    approximate mode can be checked on the tiles of a WSI through compareStainSampling.
+    """
+
+    # Reference OD matrix
+    HERef = np.array([[0.5626, 0.2159],
+                      [0.7201, 0.8012],
+                      [0.4062, 0.5581]])
+
+    # Reference saturation vector
+    maxCRef = np.array([1.9705, 1.0308])
+
+    if reference is not None:
+        HERef, maxCRef = reference
+    if workspace is None:
+        workspace = defaultWorkspace()
+
+    n, h, w, c = imgs.shape
+
+    # Optical density OD = -log((I+1)/Io) of each pixel, looked up from the table of the 256 possible intensities, shape (N, h*w, 3)
+    OD = np.take(odTable(Io), imgs.reshape((n, -1, 3)), out=workspace.get("OD", (n, h*w, 3)), mode='clip')
+    C = workspace.get("C", (n, 2, h*w))
+    # The buffer of the normalized intensities, shape (N, 3, h*w), is also used as scratch space before them
+    Inorm = workspace.get("Inorm", (n, 3, h*w))
+
+    if stains is None:
+        HE, valid, idx = macenkoStainVectors(OD, alpha, beta, sampleSize, sampling, workspace)
+        # Determine stain saturation, shape (N, 2, h*w). HE has full column rank, hence the least-squares solution is given by its pseudo-inverse
+        np.matmul(np.linalg.pinv(HE).astype(np.float32), OD.transpose(0,2,1), out=C)
+        # The 99th percentile is computed on a copy of the concentrations in the scratch space, since it partially sorts them
+        Cs = C[:,:,idx] if idx is not None else C
+        scratch = Inorm.reshape(-1)[:Cs.size].reshape((2*n, -1))
+        np.copyto(scratch, Cs.reshape((2*n, -1)))
+        maxC = maskedPercentile(scratch, None, (99,), inPlace=True)[0].astype(np.float64).reshape((n, 2))
+    else:
+        # Per-slide mode: the stain vectors and the stain saturation fitted on the slide are used for all the tiles,
+        # hence only the projection on the stain vectors and the reconstruction are computed for each tile
+        valid = np.ones(n, dtype=bool)
+        np.matmul(np.linalg.pinv(stains[0]).astype(np.float32), OD.transpose(0,2,1), out=C)
+        maxC = np.tile(stains[1], (n, 1))
+    del OD
+
+    # Normalize stain saturation
+    tmp = np.divide(maxC, maxCRef)
+    tmp[~valid] = 1
+    np.divide(C, tmp[:,:,np.newaxis].astype(np.float32), out=C)
+
+    # Recreate the images. Intensities of pixels with very large stain concentrations overflow to inf, and are then set to 254 as the others above 255
+    np.matmul(np.asarray(HERef, dtype=np.float32), C, out=Inorm)
+    with np.errstate(over='ignore'):
+        np.negative(Inorm, out=Inorm)
+        np.exp(Inorm, out=Inorm)
+        np.multiply(Inorm, np.float32(Io), out=Inorm)
+    overflow = np.greater(Inorm, 255, out=workspace.get("overflow", Inorm.shape, bool))
+    np.copyto(Inorm, 254, where=overflow)
+    normImgs = np.empty((n, h, w, 3), dtype=np.uint8)
+    np.copyto(normImgs.reshape((n, -1, 3)), Inorm.transpose(0,2,1), casting='unsafe')
+
+    return normImgs, valid
+
+def fitStains(pixels, Io=240, alpha=1, beta=0.15):
+
+    '''Estimates, through the Macenko's method, the stain matrix HE (shape (3, 2), hematoxylin first) and the stain saturation maxC
+    (99th percentile of the stain concentrations, shape (2,)) of a set of pixels (uint8 numpy array of shape (P, 3)), e.g. pooled from
+    several tiles of a slide.'''
+
+    OD = -np.log((pixels.reshape((-1, 3)).astype(np.float64)+1)/Io)
+    HE, valid, idx = macenkoStainVectors(OD[np.newaxis], alpha, beta)
+    if not valid[0]:
+        raise ValueError("Less than two non-transparent pixels are available to fit the stain vectors")
+    C = np.linalg.pinv(HE[0]).dot(OD.T)
+    maxC = np.percentile(C, 99, axis=1)
+
+    return HE[0], maxC
+
+def fitSlideStains(tilesPath, tileNames, numTiles=64, pixelsPerTile=16384, Io=240, alpha=1, beta=0.15, loader=None):
+
+    '''Fits the stain matrix and the stain saturation of a slide (see fitStains) on the pixels pooled from numTiles of the given tiles
+    (evenly spaced in tileNames, e.g. the tiles kept by the quality filter), pixelsPerTile evenly spaced pixels being taken from each tile.
+    Tiles are decoded from tilesPath, unless a loader (a function returning the tile given its name) is provided.
+    Returns HE, maxC and the list of the tiles used.'''
+
+    sampledTiles = [tileNames[k] for k in np.unique(np.linspace(0, len(tileNames) - 1, min(numTiles, len(tileNames))).round().astype(np.int64))] if len(tileNames) > 0 else []
+    pixels = []
+    for name in sampledTiles:
+        np_img = (loader(name) if loader is not None else readTile(os.path.join(tilesPath, name)))[:,:,:3].reshape((-1, 3))
+        pixels.append(np_img[samplePixels(len(np_img), min(pixelsPerTile, len(np_img)))])
+    if len(pixels) == 0:
+        raise ValueError(f"No tiles are available to fit the stain vectors of {tilesPath}")
+    HE, maxC = fitStains(np.concatenate(pixels), Io, alpha, beta)
+
+    return HE, maxC, sampledTiles
+
+def macenkoNormTiles(tilesPath, tileNames, batchSize=16, Io=240, alpha=1, beta=0.15, cache=None, sampleSize=None, sampling="strided", stains=None, reference=None):
+
+    '''Decodes and normalizes the given tiles in fixed-size batches through macenkoNormBatch (sampleSize, sampling, stains and reference are passed to it).
+    Yields, in the same order as tileNames, a tuple (tileName, normalized tile, error) where either the normalized tile
+    or the error (the exception raised while processing the tile) is None.
+    Tiles found in cache (a tilesCache or a dictionary) are taken, and removed, from it instead of being decoded again.'''
+
+    for batchStart in range(0, len(tileNames), batchSize):
+        batch = tileNames[batchStart:batchStart+batchSize]
+        results = {}
+        # Tiles are stacked by shape, since tiles cut at the border of an image may be smaller than the others
+        stacks = {}
+        for name in batch:
+            try:
+                np_img = cache.pop(name, None) if cache is not None else None
+                if np_img is None:
+                    np_img = np.array(Image.open(os.path.join(tilesPath, name)))
+                stacks.setdefault(np_img.shape, []).append((name, np_img))
+            except Exception as e:
+                results[name] = (None, e)
+
+        for stack in stacks.values():
+            names = [name for name, _ in stack]
+            try:
+                Inorm, valid = macenkoNormBatch(np.stack([np_img for _, np_img in stack]), Io, alpha, beta, sampleSize, sampling, stains, reference)
+            except Exception as e:
+                results.update({name: (None, e) for name in names})
+                continue
+            for k, name in enumerate(names):
+                if valid[k]:
+                    results[name] = (Inorm[k].copy(), None)
+                else:
+                    results[name] = (None, ValueError(f"Tile {name} has less than two non-transparent pixels"))
+
+        for name in batch:
+            yield (name,) + results[name]
+
+def normalizeChunk(tilesPath, chunk, batchSize=16, sampleSize=None, sampling="strided", stains=None, reference=None):
+
+    '''Normalizes a chunk of tiles, given as a list of (tileName, decoded tile or None) tuples, through macenkoNormTiles and returns 
+    the list of (tileName, normalized tile, error) tuples, where error is the formatted traceback of the exception raised while processing
+    the tile (None otherwise). Errors are returned as text, rather than logged, so that the function can run in a worker process and the
+    calling process can log them in the same order as a serial run.'''
+
+    tileNames = [name for name, _ in chunk]
+    cachedTiles = {name: np_img for name, np_img in chunk if np_img is not None}
+    res = []
+    for name, normTile, error in macenkoNormTiles(tilesPath, tileNames, batchSize, cache=cachedTiles, sampleSize=sampleSize, sampling=sampling, stains=stains, reference=reference):
+        if error is not None:
+            error = "".join(traceback.format_exception(type(error), error, error.__traceback__)).rstrip()
+        res.append((name, normTile, error))
+    return res
+
+def compareStainSampling(tilesPath, sampleSize=16384, sampling="strided", batchSize=16, tileNames=None):
+
+    '''Normalizes the tiles of a WSI (or the given tileNames only) both in exact mode and in approximate mode (stain vectors estimated on
+    a subsample of sampleSize pixels, see macenkoNormBatch) and returns a dictionary reporting, for each tile, the maximum and mean absolute
+    difference between the two normalized tiles, together with the overall errors and the time taken by each mode.'''
+
+    if tileNames is None:
+        tileNames = readFiles(tilesPath)
+
+    time_start = time.time()
+    exact = {name: normTile for name, normTile, error in macenkoNormTiles(tilesPath, tileNames, batchSize)}
+    time_exact = time.time() - time_start
+    time_start = time.time()
+    approx = {name: normTile for name, normTile, error in macenkoNormTiles(tilesPath, tileNames, batchSize, sampleSize=sampleSize, sampling=sampling)}
+    time_approx = time.time() - time_start
+
+    tiles = []
+    for name in tileNames:
+        if exact[name] is None or approx[name] is None:
+            tiles.append({"tile": name, "maxAbsDiff": None, "meanAbsDiff": None, "failedExact": exact[name] is None, "failedApprox": approx[name] is None})
+            continue
+        diff = np.abs(exact[name].astype(np.int16) - approx[name].astype(np.int16))
+        tiles.append({"tile": name, "maxAbsDiff": int(diff.max()), "meanAbsDiff": float(diff.mean()), "failedExact": False, "failedApprox": False})
+
+    compared = [tile for tile in tiles if tile["maxAbsDiff"] is not None]
+    return {"numTiles": len(tileNames),
+            "sampleSize": sampleSize,
+            "sampling": sampling,
+            "numCompared": len(compared),
+            "numFailedExact": sum(tile["failedExact"] for tile in tiles),
+            "numFailedApprox": sum(tile["failedApprox"] for tile in tiles),
+            "maxAbsDiff": max([tile["maxAbsDiff"] for tile in compared], default=0),
+            "meanAbsDiff": float(np.mean([tile["meanAbsDiff"] for tile in compared])) if len(compared) > 0 else 0.0,
+            "p99MeanAbsDiff": float(np.percentile([tile["meanAbsDiff"] for tile in compared], 99)) if len(compared) > 0 else 0.0,
+            "timeExact": time_exact,
+            "timeApprox": time_approx,
+            "tiles": tiles}
+
+def manifestSettings(lowerPerc=10, upperPerc=90, fastFilterScale=1, pickleNormTiles=False, jpgNormTiles=False, stainSampleSize=None, stainSampling="strided", slideStains=False, stainTiles=64, reference=None, thresholds=None):
+
+    '''Returns the settings recorded in the manifest of a WSI pre-processed from its tiles folder (see saveRes and tilesWatcher).'''
+
+    return {"lowerPerc": lowerPerc, "upperPerc": upperPerc, "fastFilterScale": fastFilterScale, "pickleNormTiles": pickleNormTiles, "jpgNormTiles": jpgNormTiles,
+            "stainSampleSize": stainSampleSize, "stainSampling": stainSampling, "slideStains": slideStains, "stainTiles": stainTiles,
+            "reference": [reference[0].tolist(), reference[1].tolist()] if reference is not None else None,
+            "thresholds": [float(th) for th in thresholds] if thresholds is not None else None}
+
+class tilesWatcher:
+
+    '''
+    Follows the folder where QuPath is writing the tiles of a WSI (watch mode), so that most of the pre-processing of the WSI is already done
+    when its tiles generation ends. Every pollInterval seconds the folder is listed again: a tile whose size and modification time did not
+    change since the previous listing is complete, hence its median intensity is computed and, since the thresholds of the quality filter are
+    only known once all the tiles have been generated, it is normalized provisionally and appended to the tiles store of the WSI.
+    Once the generation ends, stop() processes the tiles left and saves a manifest (not complete) recording the median intensity and the
+    output of each tile: saveRes then applies the final thresholds, reusing the median intensities and the normalized tiles of the unchanged
+    tiles (as when a run is resumed), and rebuilds the tiles store with the kept tiles only. Tiles changed after being processed, or whose
+    normalization failed, are processed again by saveRes.
+    If preprocessingResDir is None or normalize is False, only the median intensities are computed (e.g. for the sketch of the WSI).
+    '''
+
+    def __init__(self, wsiTilesDir, preprocessingResDir, file, settings, batchSize=16, normalize=True, stainSampleSize=None, stainSampling="strided", reference=None, pollInterval=1.0):
+
+        self.wsiTilesDir = wsiTilesDir
+        self.preprocessingResDir = preprocessingResDir
+        self.file = file
+        self.settings = settings
+        self.batchSize = batchSize
+        self.normalize = normalize and preprocessingResDir is not None
+        self.normalizer = partial(normalizeChunk, wsiTilesDir, batchSize=batchSize, sampleSize=stainSampleSize, sampling=stainSampling, reference=reference)
+        self.pollInterval = pollInterval
+        # Size and modification time of the tiles listed so far, and manifest entries of the tiles already processed
+        self.seen = {}
+        self.tiles = {}
+        self.batch = []
+        self.store = None
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = None
+        if preprocessingResDir is not None:
+            self.normTilesFolder = f"{preprocessingResDir}/normTiles/{file}"
+            self.storeDir = f"{self.normTilesFolder}/normTiles_{file}.store"
+
+    def start(self):
+
+        if self.preprocessingResDir is not None:
+            os.makedirs(self.normTilesFolder, exist_ok=True)
+            # The manifest of a previous run refers to the tiles being generated again
+            if os.path.exists(manifestPath(self.normTilesFolder, self.file)):
+                os.remove(manifestPath(self.normTilesFolder, self.file))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+
+        try:
+            while not self.stopped.wait(self.pollInterval):
+                self.poll()
+        except Exception as e:
+            self.error = e
+
+    def poll(self, final=False):
+
+        ''' Processes the tiles that are complete, i.e. whose size and modification time did not change since the previous listing or,
+        if final is True (the tiles generation ended), all the tiles not processed yet.'''
+
+        if not os.path.isdir(self.wsiTilesDir):
+            return
+        for name in readFiles(self.wsiTilesDir):
+            if name in self.tiles:
+                continue
+            try:
+                stat = tileStat(os.path.join(self.wsiTilesDir, name))
+            except FileNotFoundError:
+                continue
+            if final or self.seen.get(name) == stat:
+                self.process(name, stat, final)
+            else:
+                self.seen[name] = stat
+        # The tiles left in the current batch are normalized right away, so that little work is left when the generation ends
+        self.flush()
+
+    def process(self, name, stat, final=False):
+
+        try:
+            np_img = readTile(os.path.join(self.wsiTilesDir, name), self.settings["fastFilterScale"])
+        except Exception:
+            # A tile that cannot be decoded yet is tried again at the next listing; after the generation it is left to saveRes
+            if not final:
+                self.seen.pop(name, None)
+            return
+        self.tiles[name] = {"size": stat[0], "mtime": stat[1], "logMedian": float(np.log10(np.array([np.median(np_img)]))[0]), "keep": None, "output": None}
+        if self.normalize:
+            # Tiles decoded at reduced resolution cannot be normalized, hence they are decoded again
+            self.batch.append((name, np_img if self.settings["fastFilterScale"] == 1 else None))
+            if len(self.batch) >= self.batchSize:
+                self.flush()
+
+    def flush(self):
+
+        ''' Normalizes the tiles waiting in the current batch and appends them to the tiles store.'''
+
+        if len(self.batch) == 0:
+            return
+        batch, self.batch = self.batch, []
+        if self.store is None:
+            self.store = tilesStoreWriter(self.storeDir)
+        for name, normTile, error in self.normalizer(batch):
+            if error is None:
+                self.store.add(name, normTile)
+                self.tiles[name]["output"] = os.path.relpath(self.storeDir, self.preprocessingResDir)
+
+    def stop(self, generated=True):
+
+        ''' Stops following the tiles. If generated is True (the tiles generation succeeded), the tiles left are processed and the
+        provisional manifest is saved. Returns True if the results of the watcher can be used by saveRes.'''
+
+        self.stopped.set()
+        self.thread.join()
+        try:
+            if self.error is None and generated:
+                self.poll(final=True)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.store is not None:
+                self.store.close()
+        if self.error is not None:
+            print('\n' f"Watch mode failed for {self.file} ({self.error}): its tiles will be pre-processed once generated.")
+            return False
+        if generated and self.preprocessingResDir is not None:
+            writeJson(manifestPath(self.normTilesFolder, self.file), {"settings": self.settings, "darkTh": None, "whiteTh": None, "stains": None, "complete": False, "tiles": self.tiles})
+        return generated
+
 class pipeline:
 
     '''
     Pipeline for running tiles generation and pre-processing for each WSI provided in input.
     '''
 
-    def __init__(self, qupathProj, groovyScript, shellScript, tilesDir, resultsDir, wsiDir, jpgNormTiles, wsiList=None, lowerPerc=10, upperPerc=90):
+    def __init__(self, qupathProj, groovyScript, shellScript, tilesDir, resultsDir, wsiDir, jpgNormTiles, wsiList=None, lowerPerc=10, upperPerc=90, batchSize=16, workers=1, maxPendingSlides=1, cacheSize=2048, pickleNormTiles=False, fastFilterScale=1, resume=False, metricsFile=None, promFile=None, generationProcesses=1, stainSampleSize=None, stainSampling="strided", slideStains=False, stainTiles=64, referenceSlide=None, distributed=False, nodeId=None, leaseTTL=600, deferReport=False, tiffDir=None, tileSize=512, tiffLevel=0, writerThreads=2, thresholdMode="slide", groupColumn="Group", watch=False, watchInterval=1.0):
         
         self.qupathProj = qupathProj 
         self.groovyScript = groovyScript
@@ -267,10 +1121,48 @@ class pipeline:
         self.wsiList = wsiList
         self.lowerPerc = lowerPerc
         self.upperPerc = upperPerc
+        self.batchSize = batchSize
+        self.workers = workers
+        self.maxPendingSlides = maxPendingSlides
+        self.cacheSize = cacheSize
+        self.pickleNormTiles = pickleNormTiles
+        self.fastFilterScale = fastFilterScale
+        self.resume = resume
+        # Per-stage metrics are only recorded if at least one of the two output files is provided
+        self.metrics = metricsRecorder(metricsFile, promFile)
+        self.generationProcesses = generationProcesses
+        self.stainSampleSize = stainSampleSize
+        self.stainSampling = stainSampling
+        self.slideStains = slideStains
+        self.stainTiles = stainTiles
+        self.referenceSlide = referenceSlide
+        self.distributed = distributed
+        self.nodeId = nodeId
+        self.leaseTTL = leaseTTL
+        self.deferReport = deferReport
+        self.tiffDir = tiffDir
+        self.tileSize = tileSize
+        self.tiffLevel = tiffLevel
+        self.writerThreads = writerThreads
+        self.thresholdMode = thresholdMode
+        self.groupColumn = groupColumn
+        # Thresholds (darkTh, whiteTh) of each slide in cohort and group modes, computed by cohortThresholds before pre-processing any slide
+        self.thresholds = {}
+        self.watch = watch
+        self.watchInterval = watchInterval
+        # Slides whose provisional results were saved by a tilesWatcher while their tiles were being generated
+        self.watched = set()
+        # Reference stain matrix and saturation (None for the default ones), fitted on referenceSlide when the first slide is pre-processed
+        self.reference = None
             
     @staticmethod
-    def saveRes(tilesDir, preprocessingResDir, file, t, g, jpgNormTiles, lowerPerc=10, upperPerc=90):
-    
+    def saveRes(tilesDir, preprocessingResDir, file, t, g, jpgNormTiles, lowerPerc=10, upperPerc=90, batchSize=16, workers=1, cacheSize=2048, pickleNormTiles=False, fastFilterScale=1, resume=False, metrics=None, stainSampleSize=None, stainSampling="strided", slideStains=False, stainTiles=64, reference=None, deferReport=False, writerThreads=2, thresholds=None, watched=False, source=None):
+
+        """Pre-processes the tiles of a WSI (quality filter, stain normalization, discarded tiles, manifest, log, histogram and summary). The
+        tiles are read from source (a tilesFolder or a tiffTilesSource), by default the tiles generated through QuPath under tilesDir/file. """
+
+        if metrics is None:
+            metrics = metricsRecorder()
         os.makedirs(f"{preprocessingResDir}/normTiles/{file}", exist_ok=True)
         os.makedirs(f"{preprocessingResDir}/discTiles/{file}", exist_ok=True)
         normTilesFolder = f"{preprocessingResDir}/normTiles/{file}"
@@ -282,17 +1174,93 @@ class pipeline:
             jpgNormTilesFolder = None
         
         tilesDiscardedFolder = f"{preprocessingResDir}/discTiles/{file}"
-        wsiTilesDir = os.path.join(tilesDir, file)
-        tiles = readFiles(wsiTilesDir)
+        if source is None:
+            source = tilesFolder(os.path.join(tilesDir, file))
+        time_start = time.time()
+        tiles = source.names
+        storeDir = f"{normTilesFolder}/normTiles_{file}.store"
+        storeOutput = os.path.relpath(storeDir, preprocessingResDir)
+        
+        # The manifest records, for each tile, its median intensity, the keep/discard decision and where its output was stored. When resuming
+        # a run, slides already pre-processed with the same settings are skipped, the median intensities of the unchanged tiles are reused and
+        # the tiles already in the tiles store are not normalized again. The provisional results of watch mode (see tilesWatcher) are reused
+        # in the same way.
+        manifestFile = manifestPath(normTilesFolder, file)
+        settings = manifestSettings(lowerPerc, upperPerc, fastFilterScale, pickleNormTiles, jpgNormTiles, stainSampleSize, stainSampling, slideStains, stainTiles, reference, thresholds)
+        settings.update(source.settings)
+        tileStats = source.stats()
+        oldManifest = loadManifest(manifestFile) if resume == True or watched == True else None
+        
+        if isComplete(oldManifest, settings, tileStats):
+            print('\n' f"Tiles pre-processing for {file} had already been completed. Results from pre-processing can be found under: {normTilesFolder}")
+            return
+
+        # A WSI without any tile (e.g. annotations outside the image of a TIFF WSI) has nothing to filter nor to normalize
+        if len(tiles) == 0:
+            saveSummary(normTilesFolder, file, {"Slide": file, "numTilesInit": 0, "numTilesAfterPreproc": 0, "numTilesDiscarded": 0, "numTilesFailed": 0,
+                                                "lowerPerc": lowerPerc, "upperPerc": upperPerc, "darkTh": None, "whiteTh": None,
+                                                "generationTime": t.get(file, t.get('Project')), "preprocessingTime": time.time() - time_start})
+            print('\n' f"Tiles pre-processing for {file} was skipped: no tiles were found" + (f" ({source.description})" if source.description is not None else ""))
+            return
+        
+        unchanged = unchangedTiles(oldManifest, tileStats)
+        # Median intensities computed at a different resolution cannot be reused
+        if oldManifest is not None and oldManifest["settings"]["fastFilterScale"] == fastFilterScale:
+            reusedMedians = unchanged
+        else:
+            reusedMedians = set()
+        
+        # Tiles decoded while computing their intensity are kept in memory (up to cacheSize MB) to be normalized without decoding them again
+        cache = tilesCache(cacheSize * 1024**2)
+        with metrics.stage(file, "intensity", numTiles = len(tiles) - len(reusedMedians)):
+            newMedians = dict(zip([i for i in tiles if i not in reusedMedians], logMedianIntensity(source.path, [i for i in tiles if i not in reusedMedians], cache, fastFilterScale, source.read)))
+            logMedianIntensities = np.array([oldManifest["tiles"][i]["logMedian"] if i in reusedMedians else newMedians[i] for i in tiles])
+            darkTh, whiteTh, tilesToKeep = filterTiles(logMedianIntensities, lowerPerc, upperPerc, thresholds)
+        
+        keptTiles = [i for countPos, i in enumerate(tiles) if tilesToKeep[countPos] == True]
+        
+        # In per-slide stains mode, the stain matrix and saturation are fitted once on a sample of the kept tiles, unless the stains file
+        # of a previous run was fitted with the same settings on the same tiles. If they cannot be fitted, they are estimated tile by tile.
+        stains, stainsReused, stainsError = None, False, None
+        if slideStains == True and len(keptTiles) > 0:
+            with metrics.stage(file, "stainFit", numTiles = min(stainTiles, len(keptTiles))):
+                stainsFile = stainsPath(normTilesFolder, file)
+                stainsSettings = {"numTiles": stainTiles, "lowerPerc": lowerPerc, "upperPerc": upperPerc, "fastFilterScale": fastFilterScale,
+                                  "thresholds": settings["thresholds"]}
+                stains = loadStains(stainsFile, stainsSettings, tileStats)
+                stainsReused = stains is not None
+                if stains is None:
+                    try:
+                        HE, maxC, sampledTiles = fitSlideStains(source.path, keptTiles, stainTiles, loader = lambda name: cache.tiles[name] if name in cache.tiles else source.read(name))
+                        saveStains(stainsFile, HE, maxC, stainsSettings, {i: tileStats[i] for i in sampledTiles})
+                        stains = (HE, maxC)
+                    except Exception as e:
+                        stainsError = e
         
-        logMedianIntensities, darkTh, whiteTh, tilesToKeep = calculateIntensity(wsiTilesDir, lowerPerc, upperPerc)
+        # Normalized tiles already in the tiles store can be reused if the tile did not change and is still kept, and if the stain vectors were
+        # estimated in the same way (manifests written before these settings were introduced always estimated them tile by tile on all the pixels)
+        stainDefaults = {"stainSampleSize": None, "stainSampling": "strided", "slideStains": False, "stainTiles": 64, "reference": None}
+        manifestStains = [stains[0].tolist(), stains[1].tolist()] if stains is not None else None
+        sameStainSettings = (oldManifest is not None and oldManifest.get("stains") == manifestStains
+                             and all(oldManifest["settings"].get(key, default) == settings[key] for key, default in stainDefaults.items()))
+        storedTiles = set(tilesStore(storeDir).keys()) if ((resume == True or watched == True) and sameStainSettings and pickleNormTiles == False and os.path.isdir(storeDir)) else set()
+        reusedTiles = [i for i in keptTiles if i in storedTiles and i in unchanged]
+        tilesToNormalize = [i for i in keptTiles if i not in set(reusedTiles)]
+        
+        manifest = {"settings": settings, "darkTh": float(darkTh), "whiteTh": float(whiteTh), "stains": manifestStains, "complete": False, "tiles": {}}
+        for countPos, i in enumerate(tiles):
+            manifest["tiles"][i] = {"size": tileStats[i][0], "mtime": tileStats[i][1], "logMedian": float(logMedianIntensities[countPos]), "keep": bool(tilesToKeep[countPos]),
+                                    "output": os.path.join(os.path.relpath(tilesDiscardedFolder, preprocessingResDir), i) if tilesToKeep[countPos] == False else None}
+        for i in reusedTiles:
+            manifest["tiles"][i]["output"] = storeOutput
+        writeJson(manifestFile, manifest)
         
         log_file = os.path.join(normTilesFolder, f"{file}.log")
        
         # If tiles generation and pre-processing is performed more than once for the same slide, this check avoids that the new log file
         # will be appended to the previous one. Notably, if the log file already exists in that file path (i.e. the preprocessing pipeline has been run already once)
-        # remove it otherwise proceed as usual.
-        if os.path.exists(log_file):
+        # remove it otherwise proceed as usual. When a run is resumed, the log of the previous run is kept and appended to.
+        if os.path.exists(log_file) and resume == False:
             os.remove(log_file)
         else:
             pass
@@ -302,52 +1270,591 @@ class pipeline:
         file_handler = logging.FileHandler(log_file)
         formatter    = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt='%m/%d/%Y %I:%M:%S %p')
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-        logger.info("********** Tiles generation **********")
-        logger.info(f"Number of tiles generated: {len(tiles)}")
+        # Records are written to the log file by a background listener (see tilesWriter), flushed at the end of the slide
+        listener = queueLogging(logger, file_handler)
+        try:
+            if watched == True:
+                logger.info("********** Watch mode **********")
+                logger.info(f"Median intensities computed while the tiles were being generated: {len(reusedMedians)}; tiles normalized while the tiles were being generated and kept: {len(reusedTiles)}")
+            elif oldManifest is not None:
+                logger.info("********** Resumed run **********")
+                logger.info(f"Median intensities reused from the previous run: {len(reusedMedians)}; normalized tiles reused from the previous run: {len(reusedTiles)}")
+            logger.info("********** Tiles generation **********")
+            logger.info(f"Number of tiles generated: {len(tiles)}")
         
-        if file in t.keys():
-            logger.info(f"Tiles generation took a total of {round(t[file])} secs.")
-        else:
-            logger.info(f"Tiles generation took a total of {round(t['Project'])} sec for the entire project")
+            if source.description is not None:
+                logger.info(source.description)
+            elif file in t.keys():
+                logger.info(f"Tiles generation took a total of {round(t[file])} secs.")
+            elif 'Project' in t.keys():
+                logger.info(f"Tiles generation took a total of {round(t['Project'])} sec for the entire project")
+            else:
+                logger.info("Tiles generation was not run again: the tiles generated by a previous run were used")
+        
+            logger.info("********** Tiles pre-processing **********")
+        
+            logger.info(f"The following percentiles were chosen for tiles filtering: lower threshold = {lowerPerc}th; upper threshold = {upperPerc}th")
+            if thresholds is not None:
+                logger.info(f"The thresholds were computed on the tiles of all the slides of its cohort or group (see thresholds.json): darkTh = {darkTh}; whiteTh = {whiteTh}")
+            if fastFilterScale > 1:
+                logger.info(f"Median intensities were computed on tiles decoded at 1/{fastFilterScale} of their resolution")
+            if reference is not None:
+                logger.info(f"Reference stain matrix: {reference[0].tolist()}; reference stain saturation: {reference[1].tolist()}")
+            if stains is not None:
+                logger.info(f"Stain matrix {stains[0].tolist()} and stain saturation {stains[1].tolist()} " + ("reused from the previous run" if stainsReused else f"fitted on {min(stainTiles, len(keptTiles))} tiles of the slide"))
+            elif stainsError is not None:
+                logger.warning(f"The stain vectors of the slide could not be fitted, hence they were estimated tile by tile: {stainsError}")
         
-        logger.info("********** Tiles pre-processing **********")
+            # Copies of the discarded tiles and JPEG normalized tiles are written by a pool of writerThreads threads, so that normalization does
+            # not wait for the storage; all the writes are completed by the end of the normalization stage
+            writer = asyncWriter(writerThreads)
+            with metrics.stage(file, "discardedTiles", numTiles = len(tiles) - len(keptTiles)):
+                for countPos, i in enumerate(tiles):
+                    if tilesToKeep[countPos] == False:
+                        logger.info(f"Tile {i} was excluded from further pre-processing due to thresholding")
+                        writer.submit(source.copy, i, os.path.join(tilesDiscardedFolder, i), cache.pop(i))
         
-        logger.info(f"The following percentiles were chosen for tiles filtering: lower threshold = {lowerPerc}th; upper threshold = {upperPerc}th")
+            # Tiles discarded by a previous run but kept by this one (e.g. because the percentiles changed) are removed from the discarded tiles
+            discardedTiles = set(tiles) - set(keptTiles)
+            for i in readFiles(tilesDiscardedFolder):
+                if i not in discardedTiles:
+                    os.remove(os.path.join(tilesDiscardedFolder, i))
         
-        for countPos, i in enumerate(tqdm(tiles, desc = f"{file} pre-processing", ncols= 100)):
-            path = f"{tilesDir}/{file}/{i}"
-            if tilesToKeep[countPos] == True:
+            # The tiles passing the filter are normalized in fixed-size batches. If more than one worker is requested, the batches are
+            # distributed over a pool of processes; results are collected in the original tiles order, so that the output matches a serial run.
+            # Each chunk carries, next to the tile names, the tiles already decoded during the intensity pass (if not cached, the tiles given by
+            # source.chunkTile, i.e. None for tile files, which are decoded by the workers).
+            # Chunks are built lazily, so that cached tiles leave the cache only when their chunk is about to be normalized.
+            # The normalization stage also covers the writing of the outputs; the CPU time of the workers is counted once the pool is joined
+            with metrics.stage(file, "normalization", numTiles = len(tilesToNormalize), children = workers > 1):
+                chunks = ([(name, cache.pop(name) if name in cache.tiles else source.chunkTile(name)) for name in tilesToNormalize[k:k+batchSize]] for k in range(0, len(tilesToNormalize), batchSize))
+                normalizer = partial(normalizeChunk, source.path, batchSize=batchSize, sampleSize=stainSampleSize, sampling=stainSampling, stains=stains, reference=reference)
+                pool = multiprocessing.Pool(workers) if workers > 1 else None
+                chunkResults = pool.imap(normalizer, chunks) if pool is not None else map(normalizer, chunks)
+        
+                # Unless the legacy pickle output is requested, the normalized tiles are written to the tiles store as soon as they are available,
+                # instead of being collected in g. If the store of a previous run only holds tiles that can be reused, the new tiles are appended to it,
+                # otherwise a new store is built from the reusable tiles and replaces the previous one at the end.
+                oldStore = tilesStore(storeDir) if len(reusedTiles) > 0 else None
+                if pickleNormTiles == False and set(reusedTiles) == storedTiles and len(storedTiles) > 0:
+                    store = tilesStoreWriter(storeDir, append=True)
+                elif pickleNormTiles == False:
+                    store = tilesStoreWriter(f"{storeDir}.tmp" if len(reusedTiles) > 0 else storeDir)
+                    for i in reusedTiles:
+                        store.add(i, oldStore[i])
+                else:
+                    store = None
+        
+                if jpgNormTilesFolder != None:
+                    for i in reusedTiles:
+                        if not os.path.exists(os.path.join(jpgNormTilesFolder, f"norm_{i}")):
+                            writer.submit(saveJpeg, np.array(oldStore[i]), os.path.join(jpgNormTilesFolder, f"norm_{i}"))
+                del oldStore
+        
+                from tqdm import tqdm
                 try:
-                      g[i] = macenkoNorm(path)
-                except Exception as e:
-                      logger.debug(f"Tile {i} had problems during the Macenko normalization", exc_info=True)
+                    with tqdm(total = len(keptTiles), initial = len(reusedTiles), desc = f"{file} pre-processing", ncols= 100) as pbar:
+                        for chunkResult in chunkResults:
+                            for i, normTile, error in chunkResult:
+                                pbar.update()
+                                if error is not None:
+                                    logger.debug(f"Tile {i} had problems during the Macenko normalization\n{error}")
+                                    continue
+                                if store is not None:
+                                    store.add(i, normTile)
+                                    manifest["tiles"][i]["output"] = storeOutput
+                                else:
+                                    # Arrays received from the worker processes carry their own unpickled copy of the dtype: viewing them with the
+                                    # canonical one keeps the pickle file written below byte-identical to the one of a serial run
+                                    g[i] = normTile.view(np.uint8)
+                                    manifest["tiles"][i]["output"] = os.path.relpath(f"{normTilesFolder}/normTiles_{file}", preprocessingResDir)
                       
-                if jpgNormTilesFolder != None:
-                    normImg = Image.fromarray(g[i])
-                    normImg.save(os.path.join(jpgNormTilesFolder, f"norm_{i}"))
-                else:
-                    pass
-            else:
-                logger.info(f"Tile {i} was excluded from further pre-processing due to thresholding")
-                imgDiscarded = Image.open(os.path.join(wsiTilesDir, i))
-                imgDiscarded.save(os.path.join(tilesDiscardedFolder, i))
-        
-        logger.info("********** End of the pre-processing pipeline **********")
-        logger.info(f"A total of {len(tiles)-np.count_nonzero(tilesToKeep)} tiles were excluded from further pre-processing")
-        # Remove all the handlers from the logger
-        for handler in logger.handlers[:]:
-            logger.removeHandler(handler)
+                                if jpgNormTilesFolder != None:
+                                    writer.submit(saveJpeg, normTile, os.path.join(jpgNormTilesFolder, f"norm_{i}"))
+                                else:
+                                    pass
+                    writer.close()
+                finally:
+                    if pool is not None:
+                        pool.terminate()
+                        pool.join()
+                    if store is not None:
+                        store.close()
+                    writer.close(raiseErrors = False)
+        
+            if store is not None and store.storeDir != storeDir:
+                shutil.rmtree(storeDir)
+                os.replace(store.storeDir, storeDir)
+        
+            logger.info("********** End of the pre-processing pipeline **********")
+            logger.info(f"A total of {len(tiles)-np.count_nonzero(tilesToKeep)} tiles were excluded from further pre-processing")
+        finally:
+            # Remove all the handlers from the logger, once the queued records have been written, also if the pre-processing failed
+            stopLogging(logger, listener)
             
-        filePath = os.path.join(normTilesFolder, f"Hist_log_trans_RGB_{file}.png")
-        histIntensities(logMedianIntensities, darkTh, whiteTh, filePath)
-        filename = f"{normTilesFolder}/normTiles_{file}"
-        outfile = open(filename,'wb')
-        pickle.dump(g,outfile)
-        outfile.close() 
+        with metrics.stage(file, "report"):
+            # With deferReport the histogram is rendered later from the manifest (see renderReports)
+            if deferReport == False:
+                filePath = os.path.join(normTilesFolder, f"Hist_log_trans_RGB_{file}.png")
+                histIntensities(logMedianIntensities, darkTh, whiteTh, filePath)
+            if pickleNormTiles == True:
+                filename = f"{normTilesFolder}/normTiles_{file}"
+                outfile = open(filename,'wb')
+                pickle.dump(g,outfile)
+                outfile.close() 
+        
+        manifest["complete"] = True
+        writeJson(manifestFile, manifest)
+        
+        # When tiles generation was skipped (resumed run), the generation time recorded by the previous run is kept
+        generationTime = t.get(file, t.get('Project'))
+        if generationTime is None and os.path.exists(summaryPath(normTilesFolder, file)):
+            generationTime = loadSummary(tilesDir, preprocessingResDir, file).get("generationTime")
+        numTilesNormalized = sum(1 for i in keptTiles if manifest["tiles"][i]["output"] is not None)
+        saveSummary(normTilesFolder, file, {"Slide": file, "numTilesInit": len(tiles), "numTilesAfterPreproc": numTilesNormalized,
+                                            "numTilesDiscarded": len(tiles) - len(keptTiles), "numTilesFailed": len(keptTiles) - numTilesNormalized,
+                                            "lowerPerc": lowerPerc, "upperPerc": upperPerc, "darkTh": float(darkTh), "whiteTh": float(whiteTh),
+                                            "generationTime": generationTime, "preprocessingTime": time.time() - time_start})
         print('\n' f"Tiles pre-processing for {file} has been completed.", '\n' f"Results from pre-processing can be found under: {normTilesFolder}")
 
     
+    def preprocessSlide(self, preprocessingResDir, file, timeDict, normTilesDict, source=None):
+
+        """Runs saveRes on the given WSI with the settings of the pipeline, recording the whole pre-processing of the WSI as a single stage.
+        The memory high-water mark is reset at the start of each WSI, so that it refers to the WSI being pre-processed. The tiles are read
+        from source (see saveRes), by default the tiles generated through QuPath. """
+
+        # The stage owns the pool of normalization workers (see saveRes), hence their CPU time is counted
+        with self.metrics.stage(file, "preprocessing", resetPeak = True, children = self.workers > 1) as stage:
+            if self.metrics.enabled:
+                stage.numTiles = len(source.names) if source is not None else len(readFiles(os.path.join(self.tilesDir, file)))
+            # The options are passed by keyword, since saveRes has many parameters with defaults that a positional call could silently swap
+            self.saveRes(self.tilesDir, preprocessingResDir, file, timeDict, normTilesDict, self.jpgNormTiles, lowerPerc = self.lowerPerc, upperPerc = self.upperPerc,
+                         batchSize = self.batchSize, workers = self.workers, cacheSize = self.cacheSize, pickleNormTiles = self.pickleNormTiles,
+                         fastFilterScale = self.fastFilterScale, resume = self.resume, metrics = self.metrics, stainSampleSize = self.stainSampleSize,
+                         stainSampling = self.stainSampling, slideStains = self.slideStains, stainTiles = self.stainTiles,
+                         reference = self.referenceStains(preprocessingResDir), deferReport = self.deferReport, writerThreads = self.writerThreads,
+                         thresholds = self.thresholds.get(file), watched = file in self.watched, source = source)
+
+    def referenceStains(self, preprocessingResDir):
+
+        """Returns the reference stain matrix and saturation fitted on the kept tiles of referenceSlide (None if no reference slide was chosen).
+        They are fitted once, when first needed, hence the tiles of the reference slide must have already been generated by then (e.g. by a
+        previous run, or by listing the reference slide first); they are cached in the stains file of the reference slide. When the WSIs are
+        pyramidal TIFF files tiled in-process (tiffDir), they are fitted on the tiles read from the TIFF file of the reference slide instead. """
+
+        if self.referenceSlide is None or self.reference is not None:
+            return self.reference
+
+        if self.tiffDir is not None:
+            tiffFiles = [i for i in os.listdir(self.tiffDir) if os.path.splitext(i)[0].replace(" ", "") == self.referenceSlide and os.path.splitext(i)[1].lower() != ".geojson"]
+            if len(tiffFiles) == 0:
+                raise FileNotFoundError(f"The TIFF file of the reference slide {self.referenceSlide} was not found under {self.tiffDir}")
+            tiffPath = os.path.join(self.tiffDir, tiffFiles[0])
+            source = tiffTilesSource(tiffPath, f"{os.path.splitext(tiffPath)[0]}.geojson", self.referenceSlide, self.tileSize, self.tiffLevel)
+        else:
+            referenceTilesDir = os.path.join(self.tilesDir, self.referenceSlide)
+            if not os.path.isdir(referenceTilesDir):
+                raise FileNotFoundError(f"The tiles of the reference slide {self.referenceSlide} have not been generated: {referenceTilesDir} does not exist")
+            source = tilesFolder(referenceTilesDir)
+        normTilesFolder = f"{preprocessingResDir}/normTiles/{self.referenceSlide}"
+        os.makedirs(normTilesFolder, exist_ok=True)
+        stainsFile = stainsPath(normTilesFolder, self.referenceSlide)
+        # The tiles of the reference slide are always filtered on its own percentiles
+        stainsSettings = {"numTiles": self.stainTiles, "lowerPerc": self.lowerPerc, "upperPerc": self.upperPerc, "fastFilterScale": self.fastFilterScale, "thresholds": None}
+        stainsSettings.update(source.settings)
+        tileStats = source.stats()
+        self.reference = loadStains(stainsFile, stainsSettings, tileStats)
+        if self.reference is None:
+            darkTh, whiteTh, tilesToKeep = filterTiles(logMedianIntensity(source.path, source.names, scale = self.fastFilterScale, loader = source.read), self.lowerPerc, self.upperPerc)
+            keptTiles = [i for countPos, i in enumerate(source.names) if tilesToKeep[countPos] == True]
+            HE, maxC, sampledTiles = fitSlideStains(source.path, keptTiles, self.stainTiles, loader = source.read)
+            saveStains(stainsFile, HE, maxC, stainsSettings, {i: tileStats[i] for i in sampledTiles})
+            self.reference = (HE, maxC)
+        print('\n' f"Reference stain matrix (fitted on {self.referenceSlide}): {self.reference[0].round(4).tolist()}; reference stain saturation: {self.reference[1].round(4).tolist()}")
+        return self.reference
+
+    def slideSketch(self, preprocessingResDir, file, tiffPath=None, watcher=None):
+
+        """Returns the quantile sketch of the median intensities of the tiles of the given WSI (see tilesSketch). The sketch is saved under
+        preprocessingRes/sketches and reused by the following runs (and by the other nodes) as long as neither the settings nor the tiles
+        changed. The tiles are read from tilesDir or, if tiffPath is provided, from the pyramidal TIFF file of the WSI (see tiffTilesSource).
+        If the tilesWatcher that followed the generation of the tiles is provided and processed all of them, its median intensities are used. """
+
+        sketchFile = sketchPath(os.path.join(preprocessingResDir, "sketches"), file)
+        if tiffPath is None:
+            # The tiles followed by the watcher may not have been moved to tilesDir yet (see distributedRun)
+            source = tilesFolder(watcher.wsiTilesDir if watcher is not None else os.path.join(self.tilesDir, file))
+        else:
+            # The missing annotations are reported when the WSI is pre-processed (see tiffRun)
+            if not os.path.isfile(f"{os.path.splitext(tiffPath)[0]}.geojson"):
+                return quantileSketch()
+            source = tiffTilesSource(tiffPath, f"{os.path.splitext(tiffPath)[0]}.geojson", file, self.tileSize, self.tiffLevel)
+        settings = {"fastFilterScale": self.fastFilterScale}
+        settings.update(source.settings)
+        sources = {i: list(stat) for i, stat in source.stats().items()}
+
+        sketch = loadSketch(sketchFile, settings, sources)
+        if sketch is None:
+            with self.metrics.stage(file, "sketch") as stage:
+                if watcher is not None and sources == {i: [tile["size"], tile["mtime"]] for i, tile in watcher.tiles.items()}:
+                    sketch = quantileSketch().add([watcher.tiles[i]["logMedian"] for i in source.names])
+                else:
+                    sketch = quantileSketch().add(logMedianIntensity(source.path, source.names, scale = self.fastFilterScale, loader = source.read))
+                stage.numTiles = sketch.count()
+            os.makedirs(os.path.dirname(sketchFile), exist_ok=True)
+            saveSketch(sketchFile, sketch, settings, sources)
+        return sketch
+
+    def slideGroups(self, slides):
+
+        """Returns a dictionary mapping each group of slides sharing the same thresholds to the list of its slides: a single group ("cohort")
+        in cohort mode, the values of the groupColumn column of slidesToProcess.csv in group mode. """
+
+        if self.thresholdMode == "cohort":
+            return {"cohort": list(slides)}
+
+        import pandas as pd
+
+        if self.wsiDir is None or not os.path.exists(os.path.join(self.wsiDir, "slidesToProcess.csv")):
+            raise FileNotFoundError("Group thresholds need the file slidesToProcess.csv storing the group of each slide (see --wsiDir)")
+        df = pd.read_csv(os.path.join(self.wsiDir, "slidesToProcess.csv"))
+        if self.groupColumn not in df.columns:
+            raise ValueError(f"The column {self.groupColumn} storing the group of each slide is missing from slidesToProcess.csv")
+        slideGroup = {os.path.splitext(wsiName)[0].replace(" ", ""): group for wsiName, group in zip(df['Slide'], df[self.groupColumn]) if not pd.isna(group)}
+        missing = [file for file in slides if file not in slideGroup]
+        if len(missing) > 0:
+            raise ValueError(f"The following slides have no {self.groupColumn} in slidesToProcess.csv: {missing}")
+        groups = {}
+        for file in slides:
+            groups.setdefault(str(slideGroup[file]), []).append(file)
+        return groups
+
+    def cohortThresholds(self, preprocessingResDir, slides, tiffPaths=None):
+
+        """Computes the thresholds of the quality filter (the lowerPerc and upperPerc percentiles of the log10-transformed median intensities)
+        on the tiles of all the given slides (cohort mode) or of all the slides of the same group (group mode), instead of slide by slide.
+        The sketches of the slides (see slideSketch) are computed by up to workers threads, hence the tiles of all the slides must have
+        already been generated; tiffPaths maps each slide to its TIFF file when the WSIs are tiled in-process. The sketches of each group
+        are then merged, so that the median intensities of the tiles are never held in memory all together. The thresholds of each slide are
+        stored in self.thresholds and the ones of each group are saved in preprocessingRes/thresholds.json. Groups without any tile are
+        skipped: their slides are filtered on their own percentiles. """
+
+        groups = self.slideGroups(slides)
+        with ThreadPoolExecutor(max(1, self.workers)) as pool:
+            sketches = dict(zip(slides, pool.map(lambda file: self.slideSketch(preprocessingResDir, file, tiffPaths[file] if tiffPaths is not None else None), slides)))
+
+        summary = {"thresholdMode": self.thresholdMode, "lowerPerc": self.lowerPerc, "upperPerc": self.upperPerc, "groups": {}}
+        for group, members in groups.items():
+            sketch = quantileSketch()
+            for file in members:
+                sketch.merge(sketches[file])
+            if sketch.count() == 0:
+                print('\n' f"No tiles were generated for the slides of {group}: they will be filtered on their own percentiles.")
+                continue
+            darkTh, whiteTh = sketch.percentile(self.lowerPerc), sketch.percentile(self.upperPerc)
+            for file in members:
+                self.thresholds[file] = (darkTh, whiteTh)
+            summary["groups"][group] = {"slides": members, "numTiles": sketch.count(), "darkTh": float(darkTh), "whiteTh": float(whiteTh), "sketch": sketch.toDict()}
+            print('\n' f"Thresholds of {group} ({len(members)} slide(s), {sketch.count()} tiles): darkTh = {darkTh}; whiteTh = {whiteTh}")
+        writeJson(os.path.join(preprocessingResDir, "thresholds.json"), summary)
+
+    def startWatcher(self, preprocessingResDir, file, provisional=True, tilesDir=None):
+
+        """In watch mode, starts following the tiles of the given WSI while QuPath generates them (see tilesWatcher) and returns the
+        watcher; returns None otherwise. If provisional is False (or the stain vectors are fitted per slide, which needs the final thresholds),
+        only the median intensities are computed. The tiles are followed under tilesDir, by default the tiles directory of the pipeline. """
+
+        if self.watch == False:
+            return None
+        try:
+            reference = self.referenceStains(preprocessingResDir)
+        except FileNotFoundError:
+            # The tiles of the reference slide are not available yet: only the median intensities can be computed
+            reference, provisional = None, False
+        settings = manifestSettings(self.lowerPerc, self.upperPerc, self.fastFilterScale, self.pickleNormTiles, self.jpgNormTiles, self.stainSampleSize, self.stainSampling, self.slideStains, self.stainTiles, reference)
+        normalize = provisional and self.slideStains == False and self.pickleNormTiles == False
+        return tilesWatcher(os.path.join(tilesDir if tilesDir is not None else self.tilesDir, file), preprocessingResDir if provisional else None, file, settings, batchSize = self.batchSize, normalize = normalize,
+                            stainSampleSize = self.stainSampleSize, stainSampling = self.stainSampling, reference = reference,
+                            pollInterval = self.watchInterval).start()
+
+    def stopWatcher(self, watcher, preprocessingResDir, generated=True):
+
+        """Stops the given watcher (if any) once the tiles generation of its WSI ended: if the tiles were generated, the tiles left are
+        processed and its provisional results are saved, so that saveRes only needs to apply the final thresholds. In cohort and group
+        modes, the sketch of the WSI is saved from its median intensities as well. """
+
+        if watcher is None or not watcher.stop(generated):
+            return
+        if watcher.preprocessingResDir is not None:
+            self.watched.add(watcher.file)
+        if self.thresholdMode != "slide":
+            self.slideSketch(preprocessingResDir, watcher.file, watcher = watcher)
+
+    def generateTiles(self, slide, wsi=None, preprocessingResDir=None, provisional=True, tilesDir=None):
+
+        """Runs tilesGenerator on the given WSI (on the entire project if wsi is None), echoing the QuPath output, and
+        returns the time taken. Since tiles are written by QuPath, the tiles generated and the bytes written are counted on the tiles folder.
+        In watch mode, if preprocessingResDir is provided, the tiles of the WSI are followed while they are generated (see startWatcher).
+        The tiles of the WSI are written under tilesDir, by default the tiles directory of the pipeline. """
+
+        if tilesDir is None:
+            tilesDir = self.tilesDir
+        watcher = self.startWatcher(preprocessingResDir, slide, provisional, tilesDir) if preprocessingResDir is not None and wsi is not None else None
+        try:
+            # QuPath is a child process of the stage, hence its CPU time is counted
+            with self.metrics.stage(slide, "generation", children = True) as stage:
+                time_start = time.time()
+                for line in tilesGenerator(self.qupathProj, self.shellScript, self.groovyScript, wsi = wsi, tilesDir = tilesDir if wsi is not None else None):
+                    print(line)
+                time_end = time.time()
+                if self.metrics.enabled:
+                    stage.numTiles, stage.bytesWritten = folderSize(os.path.join(tilesDir, slide) if wsi is not None else tilesDir)
+        except BaseException:
+            self.stopWatcher(watcher, preprocessingResDir, generated = False)
+            raise
+        self.stopWatcher(watcher, preprocessingResDir)
+        return time_end - time_start
+
+    def tilesAlreadyGenerated(self, preprocessingResDir, file):
+
+        """When resuming a run, the tiles of a WSI do not need to be generated again if its manifest exists, since the manifest is only
+        written by saveRes, i.e. after tiles generation has been completed. """
+
+        return self.resume == True and os.path.exists(manifestPath(f"{preprocessingResDir}/normTiles/{file}", file))
+
+    def pipelinedRun(self, preprocessingResDir, timeDict, normTilesDict, wsiList):
+
+        """Runs tiles generation and pre-processing of the WSIs in wsiList as two overlapping stages: while a slide is being filtered 
+        and normalized, QuPath already generates the tiles of the following one(s), through up to generationProcesses concurrent processes
+        whose output is written to resultsDir/generationLogs. A slide holds one of the max(maxPendingSlides, generationProcesses) slots from 
+        the start of its tiles generation until the end of its pre-processing, so that the number of tile folders generated but not yet 
+        pre-processed never exceeds it. Slides are pre-processed in the order their generation ends; slides whose generation failed are 
+        reported and skipped. With cohort or group thresholds, the slides are only pre-processed once the tiles of all of them have been
+        generated and the thresholds computed (see cohortThresholds), hence the number of pending slides is not bounded. """
+
+        slots = threading.BoundedSemaphore(max(self.maxPendingSlides, self.generationProcesses) if self.thresholdMode == "slide" else max(1, len(wsiList)))
+        generatedSlides = queue.Queue()
+        scheduler = generationScheduler(self.qupathProj, self.shellScript, self.groovyScript, self.tilesDir, os.path.join(self.resultsDir, "generationLogs"), self.generationProcesses)
+
+        # In watch mode, the tiles of each slide are followed while they are generated (see startWatcher)
+        watchers = {}
+        # Set when the pre-processing stops (also if it fails), so that the generation thread kills the QuPath processes and returns
+        stop = threading.Event()
+
+        def acquireSlot():
+            while not stop.is_set():
+                if slots.acquire(timeout = scheduler.pollInterval):
+                    return True
+            return False
+
+        def generateSlides():
+            runs = None
+            try:
+                toGenerate = []
+                for i in wsiList:
+                    # Remove file extension as well as all possible white spaces from the WSI name
+                    file = os.path.splitext(i)[0].replace(" ", "")
+                    if self.tilesAlreadyGenerated(preprocessingResDir, file):
+                        if not acquireSlot():
+                            return
+                        print('\n' f"Tiles generation for {file} is skipped: tiles generated by a previous run will be used.")
+                        generatedSlides.put(file)
+                    else:
+                        toGenerate.append(i)
+
+                print('\n' f"Tiles generation has been started for {len(toGenerate)} slide(s), with up to {self.generationProcesses} concurrent QuPath process(es).")
+                # A slot is taken without waiting, so that the scheduler keeps collecting the processes that end in the meantime
+                runs = scheduler.run(toGenerate, canStart = lambda: not stop.is_set() and slots.acquire(blocking = False),
+                                     started = lambda file: watchers.update({file: self.startWatcher(preprocessingResDir, file)}), stopped = stop.is_set)
+                for res in runs:
+                    self.stopWatcher(watchers.pop(res['Slide'], None), preprocessingResDir, generated = not res['failed'])
+                    if self.metrics.enabled:
+                        self.metrics.recordStage(res['Slide'], "generation", res['generationTime'], res['numTiles'], folderSize(os.path.join(self.tilesDir, res['Slide']))[1], res['failed'])
+                    if res['failed']:
+                        print('\n' f"Tiles generation for {res['Slide']} failed (exit status {res['exitCode']}, {res['numTiles']} tiles generated): the slide will not be pre-processed. See: {res['logFile']}")
+                        slots.release()
+                        continue
+                    timeDict[res['Slide']] = res['generationTime']
+                    print('\n' f"Tiles generation for {res['Slide']} has been completed.", '\n' f"Tiles can be found under: {os.path.join(self.tilesDir, res['Slide'])}")
+                    generatedSlides.put(res['Slide'])
+            except Exception as e:
+                generatedSlides.put(e)
+            finally:
+                # Closing the scheduler kills the QuPath processes still running (e.g. if the pre-processing failed)
+                if runs is not None:
+                    runs.close()
+                for file in list(watchers):
+                    self.stopWatcher(watchers.pop(file), preprocessingResDir, generated = False)
+                generatedSlides.put(None)
+
+        def preprocess(file):
+            try:
+                print('\n\n'     "---------------------------------------------------------------------------------------------------------------------------------------------------------------")
+                print('\n' f'************ Slide being processed: {file} ************')
+                normTilesDict.clear()
+                print('\n' f'Tiles pre-processing for {file} has been started.')
+                self.preprocessSlide(preprocessingResDir, file, timeDict, normTilesDict)
+            finally:
+                slots.release()
+
+        def generateInBackground():
+            # The CPU time of the generation thread (QuPath processes reaped, watchers) cannot be told apart from the one of the slides being pre-processed
+            with self.metrics.background():
+                generateSlides()
+
+        generator = threading.Thread(target = generateInBackground, daemon = True)
+        generator.start()
+
+        generated = []
+        try:
+            while True:
+                file = generatedSlides.get()
+                if file is None:
+                    break
+                elif isinstance(file, Exception):
+                    raise file
+                elif self.thresholdMode == "slide":
+                    preprocess(file)
+                else:
+                    generated.append(file)
+        finally:
+            stop.set()
+            generator.join()
+
+        if len(generated) > 0:
+            self.cohortThresholds(preprocessingResDir, generated)
+            for file in generated:
+                preprocess(file)
+
+    def leasedRun(self, leases, files, process):
+
+        """Runs process(file) on each slide of files (dictionary mapping the name of each slide to its WSI) that has not been processed yet by
+        any node, claiming it first through leases. process returns True if its results were committed, False if they were discarded since
+        the lease was lost; the slide is then marked as done, or as failed if process raises an exception. Slides claimed by other nodes are
+        waited for, so that they can be taken over if their node dies: the function returns once all the slides are marked. """
+
+        with leases:
+            while True:
+                unfinished = [file for file in files if leases.status(file) is None]
+                if len(unfinished) == 0:
+                    break
+                claimed = False
+                for file in unfinished:
+                    if not leases.claim(file):
+                        continue
+                    claimed = True
+                    print('\n\n'     "---------------------------------------------------------------------------------------------------------------------------------------------------------------")
+                    print('\n' f'************ Slide being processed: {file} (node {leases.nodeId}) ************')
+                    try:
+                        if process(file):
+                            leases.release(file, "done")
+                    except Exception as e:
+                        print('\n' f"The processing of {file} failed: {e}")
+                        leases.release(file, "failed", {"error": "".join(traceback.format_exception(type(e), e, e.__traceback__))})
+                if not claimed:
+                    time.sleep(min(30, self.leaseTTL / 4))
+
+        failed = [file for file in files if leases.status(file) == "failed"]
+        if len(failed) > 0:
+            print('\n' f"The processing of the following slides failed (see the .failed files under {leases.leaseDir}): {failed}")
+        return [file for file in files if leases.status(file) == "done"]
+
+    def distributedRun(self, preprocessingResDir, timeDict, normTilesDict, wsiList):
+
+        """Runs tiles generation and pre-processing of the WSIs in wsiList together with other nodes sharing the same results directory.
+        Each slide is claimed through a lease file (see tilesLeases), its tiles are generated and pre-processed into staging folders of this
+        node (tilesStaging/<node> next to tilesDir, preprocessingRes/staging/<node>) and the tiles and the results are then moved in place
+        through a rename, as long as the node still holds the lease; finally the slide is marked as done (or failed). Slides claimed by other
+        nodes are skipped, unless their lease expires (e.g. the node died), in which case they are taken over. The node returns once all the
+        slides have been processed; the last nodes to finish write infoWSIs.csv.
+        With cohort or group thresholds, the slides are first claimed (through the leases under leases/sketches) to generate their tiles and
+        compute their sketches; once all the sketches are available, every node merges them into the same thresholds (see cohortThresholds)
+        and the slides are then claimed again to be pre-processed. """
+
+        leases = leaseManager(os.path.join(self.resultsDir, "leases"), self.nodeId, self.leaseTTL)
+        stagingDir = os.path.join(preprocessingResDir, "staging", leases.nodeId)
+        # The tiles are generated into a folder of this node, so that a node taking over a slide (e.g. since this node was too slow to renew
+        # its lease) never shares the tiles folder with the QuPath process of this node; the folder must be on the same file system as tilesDir
+        tilesStagingDir = os.path.join(os.path.dirname(os.path.normpath(self.tilesDir)), "tilesStaging", leases.nodeId)
+        files = {os.path.splitext(i)[0].replace(" ", ""): i for i in wsiList}
+        print('\n' f"Distributed run: node {leases.nodeId}, leases under {leases.leaseDir}")
+
+        def generate(file, slideLeases, resDir, provisional=True):
+            # Tiles possibly left by a previous run of this node are removed
+            shutil.rmtree(os.path.join(tilesStagingDir, file), ignore_errors = True)
+            os.makedirs(tilesStagingDir, exist_ok = True)
+            print('\n' f'Tiles generation for {file} has been started.')
+            timeDict[file] = self.generateTiles(file, wsi = files[file], preprocessingResDir = resDir, provisional = provisional, tilesDir = tilesStagingDir)
+            if not slideLeases.holds(file):
+                print('\n' f"The lease of {file} expired and was taken over by another node: its tiles are discarded.")
+                shutil.rmtree(os.path.join(tilesStagingDir, file), ignore_errors = True)
+                return False
+            commitFolder(os.path.join(tilesStagingDir, file), os.path.join(self.tilesDir, file))
+            return True
+
+        def sketch(file):
+            # In watch mode only the median intensities are computed while the tiles are generated, since the slide may then be
+            # pre-processed by another node
+            if not generate(file, sketchLeases, preprocessingResDir, provisional = False):
+                return False
+            self.slideSketch(preprocessingResDir, file)
+            return True
+
+        def preprocess(file):
+            shutil.rmtree(stagingDir, ignore_errors = True)
+            if self.thresholdMode == "slide" and not generate(file, leases, stagingDir):
+                return False
+            normTilesDict.clear()
+            print('\n' f'Tiles pre-processing for {file} has been started.')
+            self.preprocessSlide(stagingDir, file, timeDict, normTilesDict)
+            if not leases.holds(file):
+                print('\n' f"The lease of {file} expired and was taken over by another node: its results are discarded.")
+                return False
+            for folder in ["normTiles", "discTiles"]:
+                commitFolder(os.path.join(stagingDir, folder, file), os.path.join(preprocessingResDir, folder, file))
+            return True
+
+        if self.thresholdMode != "slide":
+            sketchLeases = leaseManager(os.path.join(leases.leaseDir, "sketches"), leases.nodeId, self.leaseTTL)
+            sketched = self.leasedRun(sketchLeases, files, sketch)
+            self.cohortThresholds(preprocessingResDir, sketched)
+            files = {file: files[file] for file in sketched}
+
+        self.leasedRun(leases, files, preprocess)
+        for folder in [stagingDir, tilesStagingDir]:
+            shutil.rmtree(folder, ignore_errors = True)
+            try:
+                os.rmdir(os.path.dirname(folder))
+            except OSError:
+                pass
+
+    def tiffRun(self, preprocessingResDir, wsiList=None):
+
+        """Pre-processes the pyramidal TIFF WSIs of tiffDir in-process (see tiffTilesSource), i.e. without running QuPath. The annotations of each
+        WSI are read from the GeoJSON file with the same name (e.g. wsi1.geojson for wsi1.tif). If no wsiList is provided, all the .tif, .tiff,
+        .svs and .btf files of tiffDir are pre-processed. With cohort or group thresholds, the tiles of all the WSIs are read once more before
+        pre-processing the first one, to compute the thresholds (see cohortThresholds). Returns the names of the WSIs pre-processed. """
+
+        if wsiList is None:
+            wsiList = sorted(i for i in os.listdir(self.tiffDir) if os.path.splitext(i)[1].lower() in (".tif", ".tiff", ".svs", ".btf"))
+        if self.thresholdMode != "slide":
+            tiffPaths = {os.path.splitext(i)[0].replace(" ", ""): os.path.join(self.tiffDir, i) for i in wsiList}
+            self.cohortThresholds(preprocessingResDir, list(tiffPaths), tiffPaths)
+        slides = []
+        for i in wsiList:
+            file = os.path.splitext(i)[0].replace(" ", "")
+            tiffPath = os.path.join(self.tiffDir, i)
+            print('\n\n'     "---------------------------------------------------------------------------------------------------------------------------------------------------------------")
+            print('\n' f'************ Slide being processed: {file} ************')
+            # A WSI that cannot be pre-processed (e.g. its annotations are missing) is reported and skipped, while the other WSIs are processed as usual
+            try:
+                self.preprocessSlide(preprocessingResDir, file, {}, {}, source = tiffTilesSource(tiffPath, f"{os.path.splitext(tiffPath)[0]}.geojson", file, self.tileSize, self.tiffLevel))
+            except Exception as e:
+                print('\n' f"Tiles pre-processing for {file} failed: {e}")
+            slides.append(file)
+        return slides
+
     def initialize(self):
         
         """For each WSI processed, a folder will be created to store results from pre-processing. 
@@ -364,8 +1871,28 @@ class pipeline:
         os.makedirs(f"{preprocessingResDir}/normTiles", exist_ok=True)
         os.makedirs(f"{preprocessingResDir}/discTiles", exist_ok=True)
         
+        # Pyramidal TIFF WSIs are tiled in-process, hence QuPath is not run and no tiles are written to tilesDir
+        if self.tiffDir is not None:
+            slides = self.tiffRun(preprocessingResDir, self.wsiList)
+            with self.metrics.stage(None, "extractInfo"):
+                extractInfo(self.tilesDir, preprocessingResDir, self.resultsDir, self.wsiDir, slides)
+            return
+
+        # If the WSIs are distributed over several nodes, the slides to process are either the ones provided or all the ones of the project
+        if self.distributed == True:
+            self.distributedRun(preprocessingResDir, timeDict, normTilesDict, self.wsiList if self.wsiList is not None else projectImages(self.qupathProj))
+
+        # If the WSIs to process are provided in the form of a list and more than one slide can be pending at a time (or more than one
+        # QuPath process can run at a time), tiles generation of the next slides overlaps with pre-processing of the current one.
+        elif self.wsiList is not None and (self.maxPendingSlides > 1 or self.generationProcesses > 1):
+            self.pipelinedRun(preprocessingResDir, timeDict, normTilesDict, self.wsiList)
+
+        # If the entire QuPath project is processed through concurrent QuPath processes, tiles are generated slide by slide
+        elif self.generationProcesses > 1:
+            self.pipelinedRun(preprocessingResDir, timeDict, normTilesDict, projectImages(self.qupathProj))
+
         # If the WSIs to process are provided in the form of a list
-        if self.wsiList is not None:
+        elif self.wsiList is not None:
             
             # The first thing to do is generating tiles. For each WSI belonging to the input wsiList, tiles generation is handled by the function 
             # tilesGenerator and a message is printed in output as soon all tiles belonging to the WSI have been generated.
@@ -374,41 +1901,56 @@ class pipeline:
                 file = os.path.splitext(i)[0].replace(" ", "")
                 print('\n\n'     "---------------------------------------------------------------------------------------------------------------------------------------------------------------")
                 print('\n' f'************ Slide being processed: {file} ************')
-                print('\n' f'Tiles generation for {file} has been started.')
-                # When generating tiles the original file name (included the extension) is used to match the one in the QuPath project.
-                time_start = time.time()
-                for line in tilesGenerator(self.qupathProj, self.shellScript, self.groovyScript, wsi = i):
-                    print(line)
-                time_end = time.time()
-                print('\n' f"Tiles generation for {file} has been completed.", '\n' f"Tiles can be found under: {os.path.join(self.tilesDir, file)}")
-                timeDict[f"{file}"] = (time_end-time_start)
+                if self.tilesAlreadyGenerated(preprocessingResDir, file):
+                    print('\n' f"Tiles generation for {file} is skipped: tiles generated by a previous run will be used.")
+                else:
+                    print('\n' f'Tiles generation for {file} has been started.')
+                    # When generating tiles the original file name (included the extension) is used to match the one in the QuPath project.
+                    timeDict[f"{file}"] = self.generateTiles(file, wsi = i, preprocessingResDir = preprocessingResDir)
+                    print('\n' f"Tiles generation for {file} has been completed.", '\n' f"Tiles can be found under: {os.path.join(self.tilesDir, file)}")
                 
-                # After tiles generation, tiles filtering and normalization is performed.
-                normTilesDict.clear()
-                print('\n' f'Tiles pre-processing for {file} has been started.')
-                self.saveRes(self.tilesDir, preprocessingResDir, file, timeDict, normTilesDict, self.jpgNormTiles, self.lowerPerc, self.upperPerc)
+                # After tiles generation, tiles filtering and normalization is performed. With cohort or group thresholds, the tiles of all the
+                # slides are generated first, since the thresholds depend on all of them.
+                if self.thresholdMode == "slide":
+                    normTilesDict.clear()
+                    print('\n' f'Tiles pre-processing for {file} has been started.')
+                    self.preprocessSlide(preprocessingResDir, file, timeDict, normTilesDict)
+            
+            if self.thresholdMode != "slide":
+                slides = [os.path.splitext(i)[0].replace(" ", "") for i in self.wsiList]
+                self.cohortThresholds(preprocessingResDir, slides)
+                for file in slides:
+                    print('\n\n'     "---------------------------------------------------------------------------------------------------------------------------------------------------------------")
+                    print('\n' f'************ Slide being processed: {file} ************')
+                    normTilesDict.clear()
+                    print('\n' f'Tiles pre-processing for {file} has been started.')
+                    self.preprocessSlide(preprocessingResDir, file, timeDict, normTilesDict)
                 
         # If no list of WSIs is provided in input to the pipeline, the entire QuPath project will be processed.
         else:
             #print('\n\n'     "---------------------------------------------------------------------------------------------------------------------------------------------------------------")
             print('\n\n'     "----------------------------------------------------------------------- Tiles generation ----------------------------------------------------------------------")
-            time_start = time.time()
-            for line in tilesGenerator(self.qupathProj, self.shellScript, self.groovyScript):
-                print(line)
-            time_end = time.time()
-            print('\n' "Tiles generation for the entire project has been completed", '\n' f'Tiles can be found under: {self.tilesDir}')
-            timeDict["Project"] = (time_end-time_start)
+            # When resuming a run, tiles generation for the entire project has already been completed if any WSI has a manifest
+            if os.path.isdir(self.tilesDir) and any(self.tilesAlreadyGenerated(preprocessingResDir, i) for i in os.listdir(self.tilesDir)):
+                print('\n' "Tiles generation is skipped: tiles generated by a previous run will be used.")
+            else:
+                timeDict["Project"] = self.generateTiles("Project")
+                print('\n' "Tiles generation for the entire project has been completed", '\n' f'Tiles can be found under: {self.tilesDir}')
             
             print('\n\n'     "--------------------------------------------------------------------- Tiles pre-processing ---------------------------------------------------------------------")
             
+            if self.thresholdMode != "slide":
+                self.cohortThresholds(preprocessingResDir, os.listdir(self.tilesDir))
+            
             for i in os.listdir(self.tilesDir):
                 
                 normTilesDict.clear()
                 
                 print('\n' f'************ Slide being processed: {i} ************')
-                self.saveRes(self.tilesDir, preprocessingResDir, i, timeDict, normTilesDict, self.jpgNormTiles, self.lowerPerc, self.upperPerc)
+                self.preprocessSlide(preprocessingResDir, i, timeDict, normTilesDict)
                 
-        extractInfo(self.tilesDir, preprocessingResDir, self.resultsDir, self.wsiDir)
+        with self.metrics.stage(None, "extractInfo"):
+            extractInfo(self.tilesDir, preprocessingResDir, self.resultsDir, self.wsiDir)
                 
         print('\n'   "----------------------------------------------------------------------------------------------------------------------------------------------------------------")
         print(       "                                                             Tiles pre-processing completed!                                                                    ")
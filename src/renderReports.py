@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Renders the histograms of the log10-transformed median intensities of the WSIs pre-processed with tilesPreprocessing.py --deferReport,
+from the intensities and thresholds saved in their manifests, through several processes. If the tiles directory is provided, the
+data-frame infoWSIs.csv is also rebuilt from the summaries of the WSIs.
+"""
+from preprocessing import extractInfo, renderReports
+import argparse
+import os
+import time
+
+def create_parser():
+    Description = "********* Render the histograms of the WSIs pre-processed with --deferReport. *********"
+
+    Epilog = "Example of usage: renderReports.py <OUTPUT_DIR> --workers 8"
+
+    parser = argparse.ArgumentParser(description = Description, epilog = Epilog, formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('OUTPUT_DIR', type = str, help = 'Absolute path to the directory where results from pre-processing were stored')
+
+    parser.add_argument('--wsiList', nargs = '+', default = None, type = str, dest = "WSIs_LIST", help = 'Name(s) (without extension) of the WSIs whose histograms will be rendered (default: all the WSIs pre-processed)')
+
+    parser.add_argument('--workers', nargs = '?', default = os.cpu_count(), type = int, dest = "WORKERS", help = 'Number of processes rendering the histograms in parallel')
+
+    parser.add_argument('--tilesDir', nargs = '?', default = None, type = str, dest = "TILES_DIR", help = 'Absolute path to the directory storing the generated tiles; if provided, infoWSIs.csv is rebuilt as well')
+
+    parser.add_argument('--wsiDir', nargs = '?', default = None, type = str, dest = "WSIs_DIR", help = 'Absolute path to the folder containing slidesToProcess.csv (used with --tilesDir)')
+
+    return parser
+
+if __name__ == "__main__":
+
+    args = create_parser().parse_args()
+    preprocessingResDir = os.path.join(args.OUTPUT_DIR, "preprocessingRes")
+
+    time_start = time.time()
+    paths = renderReports(preprocessingResDir, args.WSIs_LIST, args.WORKERS)
+    print('\n' f"{len(paths)} histograms have been rendered in {time.time() - time_start:.1f} secs.")
+
+    if args.TILES_DIR is not None:
+        extractInfo(args.TILES_DIR, preprocessingResDir, args.OUTPUT_DIR, args.WSIs_DIR)
@@ -1,12 +1,15 @@
 #!/bin/bash
 
-# This script is controlled by the function "tilesGenerator" from the "preprocessing.py" script.
+# This script is controlled by the function "tilesGenerator" and by the class "generationScheduler" from the "preprocessing.py" script.
+# The QuPath output is discarded, unless the path of a log file is provided through the QUPATH_LOG environment variable.
+# The TILES_DIR environment variable, if set, is passed on to the groovy script, which writes the tiles there instead of the tiles directory.
+# The exit status of the script is the one of QuPath.
 
 if [ $# -eq 2 ]
 then 
-  qupath script -p="$1" "$2" > /dev/null & PID=$!
+  qupath script -p="$1" "$2" >> "${QUPATH_LOG:-/dev/null}" & PID=$!
 else
-  qupath script -i="$1" -p="$2" "$3" > /dev/null & PID=$ 
+  qupath script -i="$1" -p="$2" "$3" >> "${QUPATH_LOG:-/dev/null}" & PID=$!
 fi
 
 echo "Please be patient while tiles are being generated, it may take a while."
@@ -16,4 +19,5 @@ while kill -0 $PID 2> /dev/null; do
     printf  "#"
     sleep 1
 done
-printf "] done!"
\ No newline at end of file
+printf "] done!"
+wait $PID
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Coordination of several nodes pre-processing the same QuPath project through a shared file system (e.g. NFS), without any external service.
+
+Before processing a slide, a node claims it by creating the lease file leases/<slide>.lease in the results directory. The lease is created
+through os.link, which is atomic also on NFS, hence at most one node holds the lease of a slide at a time. While the slide is being processed
+the lease is renewed by a background thread; a lease that has not been renewed within its time-to-live (e.g. because its node died) is
+expired and can be taken over by another node. Once a slide has been processed, its node writes the marker leases/<slide>.done (or
+leases/<slide>.failed, storing the error) and releases the lease: slides with a marker are never claimed again.
+Expiry is checked against the wall clock of the node reading the lease, hence the clocks of the nodes are assumed to be synchronized (e.g. NTP).
+
+Example of usage:
+    with leaseManager("path/to/results/leases", ttl=600) as leases:
+        if leases.claim("slide_name"):
+            ...
+            leases.release("slide_name", "done")
+"""
+
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+
+def writeJson(path, content, indent=None):
+
+    ''' Writes the given content to path atomically: it is first written to a temporary file, which then replaces path. The name of the
+    temporary file is unique, hence several nodes (or threads) writing the same file at the same time never write to the same temporary file.'''
+
+    tmpPath = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmpPath, 'w') as fn:
+        json.dump(content, fn, indent = indent)
+    os.replace(tmpPath, path)
+
+
+def readJson(path):
+
+    ''' Returns the content of the json file at the given path, or None if it does not exist or cannot be read.'''
+
+    try:
+        with open(path) as fn:
+            return json.load(fn)
+    except (OSError, ValueError):
+        return None
+
+
+def commitFolder(srcDir, dstDir):
+
+    ''' Moves the folder srcDir to dstDir through a rename, replacing the previous dstDir (if any) only once the new folder is in place.'''
+
+    if os.path.exists(dstDir):
+        oldDir = f"{dstDir}.{uuid.uuid4().hex}.old"
+        os.rename(dstDir, oldDir)
+        os.rename(srcDir, dstDir)
+        shutil.rmtree(oldDir)
+    else:
+        os.rename(srcDir, dstDir)
+
+
+class leaseManager:
+
+    '''
+    Claims, renews and releases the leases of the slides processed by this node (see the module docstring). Leases last ttl seconds and are
+    renewed every ttl/4 seconds while the manager is open (i.e. within its with block). nodeId defaults to <host name>-<process id>.
+    '''
+
+    def __init__(self, leaseDir, nodeId=None, ttl=600):
+
+        os.makedirs(leaseDir, exist_ok=True)
+        self.leaseDir = leaseDir
+        self.nodeId = nodeId if nodeId is not None else f"{socket.gethostname()}-{os.getpid()}"
+        self.ttl = ttl
+        # The token identifies the leases created by this manager, also if two managers share the same node id
+        self.token = uuid.uuid4().hex
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def path(self, file, kind="lease"):
+
+        return os.path.join(self.leaseDir, f"{file}.{kind}")
+
+    def newLease(self, file):
+
+        ''' Writes a new lease of this node to a temporary file and returns its path.'''
+
+        tmpPath = f"{self.path(file)}.{self.token}.tmp"
+        with open(tmpPath, 'w') as fn:
+            json.dump({"node": self.nodeId, "token": self.token, "expires": time.time() + self.ttl}, fn)
+        return tmpPath
+
+    def status(self, file):
+
+        ''' Returns "done" or "failed" if the slide has been processed, None otherwise.'''
+
+        for kind in ["done", "failed"]:
+            if os.path.exists(self.path(file, kind)):
+                return kind
+        return None
+
+    def claim(self, file):
+
+        ''' Tries to claim the given slide. Returns True if this node now holds its lease, False if the slide has already been processed
+        or is held by another node whose lease has not expired.'''
+
+        if self.status(file) is not None:
+            return False
+        leasePath = self.path(file)
+        tmpPath = self.newLease(file)
+        try:
+            try:
+                os.link(tmpPath, leasePath)
+            except FileExistsError:
+                lease = readJson(leasePath)
+                if lease is not None and lease["expires"] > time.time():
+                    return False
+                # The expired lease is moved aside before creating the new one. If another node took it over in the meantime, the lease
+                # moved aside is not the expired one anymore and it is put back.
+                stalePath = f"{leasePath}.{self.token}.stale"
+                try:
+                    os.rename(leasePath, stalePath)
+                except FileNotFoundError:
+                    return False
+                if readJson(stalePath) != lease:
+                    try:
+                        os.link(stalePath, leasePath)
+                    except FileExistsError:
+                        pass
+                    os.remove(stalePath)
+                    return False
+                os.remove(stalePath)
+                try:
+                    os.link(tmpPath, leasePath)
+                except FileExistsError:
+                    return False
+        finally:
+            os.remove(tmpPath)
+
+        with self.lock:
+            self.held.add(file)
+        # The slide may have been completed by another node between the first check and the claim
+        if self.status(file) is not None:
+            self.release(file)
+            return False
+        return True
+
+    def holds(self, file):
+
+        ''' True if this node still holds the lease of the given slide (it may have been taken over if it was not renewed in time).'''
+
+        lease = readJson(self.path(file))
+        return file in self.held and lease is not None and lease["token"] == self.token
+
+    def renewLease(self, file):
+
+        ''' Extends the lease of the given slide. Returns False if the lease was taken over by another node. As in claim, the lease is moved
+        aside before the new one is created, so that a lease taken over by another node after it was read is put back instead of being
+        overwritten.'''
+
+        leasePath = self.path(file)
+        lease = readJson(leasePath)
+        if lease is None or lease["token"] != self.token:
+            return False
+        asidePath = f"{leasePath}.{self.token}.renew"
+        try:
+            os.rename(leasePath, asidePath)
+        except FileNotFoundError:
+            return False
+        tmpPath = self.newLease(file)
+        try:
+            lease = readJson(asidePath)
+            if lease is None or lease["token"] != self.token:
+                try:
+                    os.link(asidePath, leasePath)
+                except FileExistsError:
+                    pass
+                return False
+            # Another node may have claimed the slide while its lease was moved aside
+            try:
+                os.link(tmpPath, leasePath)
+            except FileExistsError:
+                return False
+            return True
+        finally:
+            os.remove(tmpPath)
+            os.remove(asidePath)
+
+    def renew(self):
+
+        ''' Extends all the leases held by this node. Leases taken over by other nodes are dropped.'''
+
+        with self.lock:
+            for file in list(self.held):
+                if not self.renewLease(file):
+                    self.held.discard(file)
+
+    def release(self, file, status=None, info=None):
+
+        ''' Releases the lease of the given slide. If status is "done" or "failed", the respective marker (storing info) is written first,
+        so that the slide is never claimed again.'''
+
+        if status is not None:
+            writeJson(self.path(file, status), dict(info or {}, node=self.nodeId, time=time.time()))
+        with self.lock:
+            if self.holds(file):
+                os.remove(self.path(file))
+            self.held.discard(file)
+
+    def renewLoop(self):
+
+        # A failed renewal (e.g. a transient error of the shared file system) does not stop the heartbeat: it is retried at the next beat
+        while not self.stopped.wait(self.ttl / 4):
+            try:
+                self.renew()
+            except Exception as e:
+                print('\n' f"The leases of node {self.nodeId} could not be renewed, they will be renewed again in {self.ttl / 4} secs: {e}")
+
+    def __enter__(self):
+
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=self.renewLoop, daemon=True)
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, *exc):
+
+        self.stopped.set()
+        self.heartbeat.join()
+        for file in list(self.held):
+            self.release(file)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Per-WSI manifest of the pre-processing pipeline, used to resume interrupted runs.
+
+The manifest (manifest_<slide>.json, saved next to the results of the WSI) stores the settings the WSI was pre-processed with and,
+for each tile, its file size and modification time, its log10-transformed median intensity, the keep/discard decision and the
+location of its output relative to the preprocessingRes folder (None while the tile is still waiting to be normalized, or if its
+normalization failed).
+It is saved atomically (see tilesLeases.writeJson) once the quality filter has been applied and again, with complete = True, at the end of
+the pre-processing of the WSI.
+
+Example of manifest:
+    {"settings": {"lowerPerc": 10, "upperPerc": 90, "fastFilterScale": 1, "pickleNormTiles": false, "jpgNormTiles": false},
+     "darkTh": 2.01, "whiteTh": 2.29, "complete": true,
+     "tiles": {"tile_name.jpg": {"size": 45012, "mtime": 1666087321000000000, "logMedian": 2.13, "keep": true,
+                                 "output": "normTiles/<slide>/normTiles_<slide>.store"}}}
+"""
+
+import json
+import os
+
+
+def manifestPath(normTilesFolder, file):
+
+    ''' Returns the path of the manifest of the given WSI.'''
+
+    return os.path.join(normTilesFolder, f"manifest_{file}.json")
+
+
+def loadManifest(path):
+
+    ''' Returns the manifest saved at the given path, or None if it does not exist or cannot be read (e.g. a run interrupted while saving it).'''
+
+    try:
+        with open(path) as fn:
+            return json.load(fn)
+    except (OSError, ValueError):
+        return None
+
+
+def tileStat(path):
+
+    ''' Returns the (size, modification time in ns) pair used to detect new or changed tiles.'''
+
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def unchangedTiles(manifest, tileStats):
+
+    ''' Returns the set of tiles whose size and modification time match the ones recorded in the manifest.'''
+
+    if manifest is None:
+        return set()
+    return {name for name, (size, mtime) in tileStats.items()
+            if name in manifest["tiles"] and manifest["tiles"][name]["size"] == size and manifest["tiles"][name]["mtime"] == mtime}
+
+
+def isComplete(manifest, settings, tileStats):
+
+    ''' True if the manifest records a completed pre-processing of exactly the given tiles with the same settings.'''
+
+    return (manifest is not None and manifest.get("complete", False) and manifest["settings"] == settings
+            and set(manifest["tiles"]) == set(tileStats) and len(unchangedTiles(manifest, tileStats)) == len(tileStats))
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation of the pipeline.
+
+For each stage of the pipeline (e.g. tiles generation, intensity computation, normalization of a WSI) a metricsRecorder records the wall
+and CPU time, the number of tiles processed per second, the bytes read and written and the memory high-water mark of the process.
+Each record is appended as a json line to metricsFile and, if promFile is provided, a snapshot of the last record of each (slide, stage)
+pair is rewritten in the Prometheus textfile format, so that a node exporter (textfile collector) can scrape long runs while in progress.
+A recorder built without any output file is disabled: its stages do not read any counter and cost a single function call.
+
+The CPU time of a stage is the one of the process (all its threads) and, only for the stages that own child processes (e.g. the
+normalization workers, a QuPath run), the one of the children terminated during the stage. Since these counters cannot be told apart
+between concurrent stages, the CPU time of a stage overlapping with a stage of another thread or with background work (see
+metricsRecorder.background, e.g. tiles generation running while WSIs are pre-processed) is not recorded (cpuSeconds: null).
+
+Example of usage:
+    metrics = metricsRecorder("metrics.jsonl", "tilgenpro.prom")
+    with metrics.stage("slide_name", "normalization") as stage:
+        ...
+        stage.numTiles = numTilesNormalized
+
+Example of json line:
+    {"timestamp": 1666087321.5, "slide": "slide_name", "stage": "normalization", "wallSeconds": 42.1, "cpuSeconds": 160.3, "numTiles": 2048,
+     "tilesPerSec": 48.6, "bytesRead": 93000000, "bytesWritten": 1610612736, "peakRSS_MB": 2300.4}
+"""
+
+import contextlib
+import json
+import os
+import platform
+import resource
+import threading
+import time
+
+
+def resetPeakRSS():
+
+    ''' Resets the peak resident memory of the process (Linux only), so that the peak of each stage can be measured separately.'''
+
+    try:
+        with open("/proc/self/clear_refs", 'w') as fn:
+            fn.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peakRSS():
+
+    ''' Returns the peak resident memory of the process in MB.'''
+
+    try:
+        with open("/proc/self/status") as fn:
+            for line in fn:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and in bytes on macOS; it cannot be reset, hence it is the peak of the whole run
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if platform.system() == "Darwin" else maxrss / 1024
+
+
+def cpuTime(children=False):
+
+    ''' Returns the CPU time (user + system) used by the process and, if children is True, by its terminated children (e.g. QuPath,
+    normalization workers).'''
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    if not children:
+        return own.ru_utime + own.ru_stime
+    terminated = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + terminated.ru_utime + terminated.ru_stime
+
+
+def ioBytes():
+
+    ''' Returns the (bytes read, bytes written) by the process so far (Linux only, (None, None) otherwise).'''
+
+    try:
+        with open("/proc/self/io") as fn:
+            counters = dict(line.split(":") for line in fn)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def folderSize(path):
+
+    ''' Returns the number of files stored under the given folder (subfolders included) and their total size in bytes.'''
+
+    numFiles, numBytes = 0, 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            numFiles += 1
+            numBytes += os.path.getsize(os.path.join(root, name))
+    return numFiles, numBytes
+
+
+class stageTimer:
+
+    '''
+    Context manager measuring a single stage. numTiles, bytesRead and bytesWritten can be set inside the block: the number of tiles
+    is used to compute the throughput, the bytes override the ones measured on the process (e.g. for tiles written by QuPath).
+    The CPU time of the terminated children is counted only if children is True; overlapped is set by the recorder (see the module docstring).
+    '''
+
+    def __init__(self, recorder, slide, stage, numTiles=None, resetPeak=False, children=False):
+
+        self.recorder = recorder
+        self.slide = slide
+        self.stage = stage
+        self.numTiles = numTiles
+        self.bytesRead = None
+        self.bytesWritten = None
+        self.resetPeak = resetPeak
+        self.children = children
+        self.thread = threading.get_ident()
+        self.overlapped = False
+
+    def __enter__(self):
+
+        if self.resetPeak:
+            resetPeakRSS()
+        self.recorder.running(self.slide, self.stage, True)
+        self.recorder.track(self, True)
+        self.ioStart = ioBytes()
+        self.cpuStart = cpuTime(self.children)
+        self.timeStart = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        wallSeconds = time.perf_counter() - self.timeStart
+        cpuSeconds = cpuTime(self.children) - self.cpuStart
+        self.recorder.track(self, False)
+        if self.overlapped:
+            cpuSeconds = None
+        ioEnd = ioBytes()
+        if self.bytesRead is None and ioEnd[0] is not None:
+            self.bytesRead = ioEnd[0] - self.ioStart[0]
+        if self.bytesWritten is None and ioEnd[1] is not None:
+            self.bytesWritten = ioEnd[1] - self.ioStart[1]
+
+        self.recorder.record({"timestamp": time.time(), "slide": self.slide, "stage": self.stage,
+                              "wallSeconds": wallSeconds, "cpuSeconds": cpuSeconds, "numTiles": self.numTiles,
+                              "tilesPerSec": self.numTiles / wallSeconds if self.numTiles is not None and wallSeconds > 0 else None,
+                              "bytesRead": self.bytesRead, "bytesWritten": self.bytesWritten, "peakRSS_MB": peakRSS(),
+                              "failed": exc[0] is not None})
+
+
+class nullStage:
+
+    ''' Stage of a disabled recorder: it measures nothing and ignores the attributes set inside the block.'''
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        pass
+
+
+# Metrics exported in the Prometheus snapshot: (metric name, key of the json record, scale, help)
+promMetrics = [("tilgenpro_stage_wall_seconds", "wallSeconds", 1, "Wall time of the last run of the stage"),
+               ("tilgenpro_stage_cpu_seconds", "cpuSeconds", 1, "CPU time (process, and terminated children of the stages owning them) of the last run of the stage"),
+               ("tilgenpro_stage_tiles", "numTiles", 1, "Number of tiles processed by the last run of the stage"),
+               ("tilgenpro_stage_tiles_per_second", "tilesPerSec", 1, "Tiles processed per second by the last run of the stage"),
+               ("tilgenpro_stage_read_bytes", "bytesRead", 1, "Bytes read by the last run of the stage"),
+               ("tilgenpro_stage_written_bytes", "bytesWritten", 1, "Bytes written by the last run of the stage"),
+               ("tilgenpro_stage_peak_rss_bytes", "peakRSS_MB", 1024**2, "Memory high-water mark of the process at the end of the stage"),
+               ("tilgenpro_stage_end_timestamp_seconds", "timestamp", 1, "Time the last run of the stage ended")]
+
+
+def promLabels(slide, stage):
+
+    ''' Returns the Prometheus label set of a (slide, stage) pair, with the label values escaped.'''
+
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{slide="{escape(slide if slide is not None else "")}",stage="{escape(stage)}"}}'
+
+
+class metricsRecorder:
+
+    '''
+    Records the metrics of the stages of the pipeline in metricsFile (json lines, appended) and promFile (Prometheus textfile
+    snapshot, rewritten atomically after each stage). If neither file is provided the recorder is disabled.
+    Stages can be recorded from several threads at once (e.g. tiles generation overlapping with pre-processing).
+    '''
+
+    def __init__(self, metricsFile=None, promFile=None):
+
+        self.metricsFile = metricsFile
+        self.promFile = promFile
+        self.enabled = metricsFile is not None or promFile is not None
+        self.lock = threading.Lock()
+        self.last = {}
+        self.inProgress = set()
+        # Stages being measured and number of background blocks open, used to detect the stages whose CPU time cannot be measured
+        self.timers = set()
+        self.backgroundBlocks = 0
+
+    def stage(self, slide, stage, numTiles=None, resetPeak=False, children=False):
+
+        ''' Returns the context manager measuring the given stage. If resetPeak is True, the memory high-water mark is reset when
+        the stage starts (e.g. at the start of each WSI), otherwise it is the one of the process since the last reset. If children
+        is True, the stage owns the child processes terminated while it runs (e.g. a pool of workers), whose CPU time is counted.'''
+
+        if not self.enabled:
+            return nullStage()
+        return stageTimer(self, slide, stage, numTiles, resetPeak, children)
+
+    @contextlib.contextmanager
+    def background(self):
+
+        ''' Marks the block as background work of the process (e.g. a thread generating tiles while WSIs are pre-processed): the CPU
+        time of the stages running at the same time is not recorded, since it cannot be told apart from the one of the block.'''
+
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            self.backgroundBlocks += 1
+            for timer in self.timers:
+                timer.overlapped = True
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.backgroundBlocks -= 1
+
+    def recordStage(self, slide, stage, wallSeconds, numTiles=None, bytesWritten=None, failed=False):
+
+        ''' Records a stage measured by the caller, e.g. a QuPath process run concurrently with other stages, whose CPU time,
+        bytes read and memory cannot be told apart from the ones of the other stages.'''
+
+        if not self.enabled:
+            return
+        self.record({"timestamp": time.time(), "slide": slide, "stage": stage, "wallSeconds": wallSeconds, "cpuSeconds": None, "numTiles": numTiles,
+                     "tilesPerSec": numTiles / wallSeconds if numTiles is not None and wallSeconds > 0 else None,
+                     "bytesRead": None, "bytesWritten": bytesWritten, "peakRSS_MB": None, "failed": failed})
+
+    def running(self, slide, stage, isRunning):
+
+        with self.lock:
+            if isRunning:
+                self.inProgress.add((slide, stage))
+            else:
+                self.inProgress.discard((slide, stage))
+            self.writeProm()
+
+    def track(self, timer, isRunning):
+
+        ''' Registers (or unregisters) a stage being measured. Stages of different threads running at the same time overlap, while
+        stages nested in the same thread do not.'''
+
+        with self.lock:
+            if isRunning:
+                others = [other for other in self.timers if other.thread != timer.thread]
+                for other in others:
+                    other.overlapped = True
+                timer.overlapped = len(others) > 0 or self.backgroundBlocks > 0
+                self.timers.add(timer)
+            else:
+                self.timers.discard(timer)
+
+    def record(self, rec):
+
+        with self.lock:
+            if self.metricsFile is not None:
+                with open(self.metricsFile, 'a') as fn:
+                    fn.write(json.dumps(rec) + '\n')
+            self.last[(rec["slide"], rec["stage"])] = rec
+            self.inProgress.discard((rec["slide"], rec["stage"]))
+            self.writeProm()
+
+    def writeProm(self):
+
+        if self.promFile is None:
+            return
+        lines = []
+        for name, key, scale, doc in promMetrics:
+            lines += [f"# HELP {name} {doc}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{promLabels(slide, stage)} {rec[key] * scale}" for (slide, stage), rec in self.last.items() if rec[key] is not None]
+        lines += ["# HELP tilgenpro_stage_running Whether the stage is currently running", "# TYPE tilgenpro_stage_running gauge"]
+        lines += [f"tilgenpro_stage_running{promLabels(slide, stage)} {int((slide, stage) in self.inProgress)}"
+                  for slide, stage in sorted(set(self.last) | self.inProgress, key=str)]
+        # The node exporter may read the file at any time, hence it is replaced atomically
+        with open(f"{self.promFile}.tmp", 'w') as fn:
+            fn.write("\n".join(lines) + "\n")
+        os.replace(f"{self.promFile}.tmp", self.promFile)
@@ -8,7 +8,6 @@ from preprocessing import pipeline
 import argparse
 import click
 import os
-import pandas as pd
 
 def create_parser():
     Description = "********* The pipeline performs tiles generation and pre-processing starting from a QuPath project. *********"
@@ -34,13 +33,67 @@ def create_parser():
 
     parser.add_argument('--wsiDir', nargs = '?', default = None, type = str, dest = "WSIs_DIR", help = 'Absolute path to the folder containing the dataframe storing information on the WSIs to process')
 
-    parser.add_argument('--jpgNormTiles', action = 'store_true', dest = 'JPG_NORM_TILES', help = 'Save the normalized tiles in JPG other than as a pickle file')
+    parser.add_argument('--jpgNormTiles', action = 'store_true', dest = 'JPG_NORM_TILES', help = 'Save the normalized tiles in JPG other than in the tiles store')
+
+    parser.add_argument('--pickleNormTiles', action = 'store_true', dest = 'PICKLE_NORM_TILES', help = 'Save the normalized tiles as a single pickle file (legacy format) instead of a chunked, memory-mappable tiles store')
     
+    parser.add_argument('--resume', action = 'store_true', dest = 'RESUME', help = 'Resume a previous run: WSIs already pre-processed with the same settings are skipped and, for the others, only new or changed tiles are processed again')
+
     parser.add_argument('--wsiList', nargs = '+', default = None, type = str, dest = "WSIs_LIST", help = 'Name of the WSIs to process')
 
     parser.add_argument('--lowerPerc', nargs = '?', default = 10, type = int, dest = "LOWER_PERCENTILE", help = 'Lower percentile for tiles filtering')
 
     parser.add_argument('--upperPerc', nargs = '?', default = 90, type = int, dest = "UPPER_PERCENTILE", help = 'Upper percentile for tiles filtering')
+
+    parser.add_argument('--thresholds', nargs = '?', default = "slide", choices = ["slide", "cohort", "group"], type = str, dest = "THRESHOLD_MODE", help = 'Compute the percentiles of the tiles filtering on the tiles of each slide, on the tiles of all the slides processed (cohort) or on the tiles of all the slides of the same group of slidesToProcess.csv (group, see --groupColumn). With cohort and group the tiles of all the slides are generated before pre-processing the first one')
+
+    parser.add_argument('--groupColumn', nargs = '?', default = "Group", type = str, dest = "GROUP_COLUMN", help = 'Column of slidesToProcess.csv storing the group of each slide (--thresholds group)')
+
+    parser.add_argument('--fastFilterScale', nargs = '?', default = 1, type = int, dest = "FAST_FILTER_SCALE", help = 'Compute the median intensities used for tiles filtering on tiles decoded at 1/FAST_FILTER_SCALE of their resolution (1 = full resolution). Use compareFastFilter.py to check its effect on a slide')
+
+    parser.add_argument('--batchSize', nargs = '?', default = 16, type = int, dest = "BATCH_SIZE", help = 'Number of tiles normalized together in a single batch')
+
+    parser.add_argument('--workers', nargs = '?', default = 1, type = int, dest = "WORKERS", help = 'Number of processes used for tiles normalization')
+
+    parser.add_argument('--cacheSize', nargs = '?', default = 2048, type = int, dest = "CACHE_SIZE", help = 'Memory (in MB) used to keep the tiles decoded during filtering for their normalization')
+
+    parser.add_argument('--writerThreads', nargs = '?', default = 2, type = int, dest = "WRITER_THREADS", help = 'Number of background threads encoding and writing the JPEG normalized tiles (--jpgNormTiles) and the discarded tiles, so that normalization does not wait for the storage; 0 writes them synchronously')
+
+    parser.add_argument('--maxPendingSlides', nargs = '?', default = 1, type = int, dest = "MAX_PENDING_SLIDES", help = 'Maximum number of slides whose tiles have been generated but not yet pre-processed. Values greater than 1 overlap tiles generation of the next slide with pre-processing of the current one')
+
+    parser.add_argument('--generationProcesses', nargs = '?', default = 1, type = int, dest = "GENERATION_PROCESSES", help = 'Number of QuPath processes generating the tiles of different slides at the same time. Values greater than 1 generate the tiles slide by slide (also when the entire project is processed), writing the output of each QuPath process to its own log file under OUTPUT_DIR/generationLogs; a slide whose tiles generation fails is skipped without stopping the others')
+
+    parser.add_argument('--stainSampleSize', nargs = '?', default = None, type = int, dest = "STAIN_SAMPLE_SIZE", help = 'Estimate the stain vectors of each tile on a subsample of STAIN_SAMPLE_SIZE pixels (e.g. 16384) instead of on all of them, which speeds up the stain normalization. Use compareStainSampling.py to check its error on a slide')
+
+    parser.add_argument('--stainSampling', nargs = '?', default = "strided", choices = ["strided", "random"], type = str, dest = "STAIN_SAMPLING", help = 'Pixel subsample used with --stainSampleSize: evenly spaced or random (with a fixed seed) pixels')
+
+    parser.add_argument('--slideStains', action = 'store_true', dest = 'SLIDE_STAINS', help = 'Fit the stain vectors once per slide, on a sample of its kept tiles, and normalize all the tiles of the slide with them instead of estimating them tile by tile. The fitted stain vectors are cached in the stains_<slide>.json file of the slide and reused by following runs')
+
+    parser.add_argument('--stainTiles', nargs = '?', default = 64, type = int, dest = "STAIN_TILES", help = 'Number of kept tiles the stain vectors of a slide are fitted on (--slideStains and --referenceSlide)')
+
+    parser.add_argument('--referenceSlide', nargs = '?', default = None, type = str, dest = "REFERENCE_SLIDE", help = 'Name (without extension) of the slide whose stain vectors, fitted on its kept tiles, are used as reference for the stain normalization instead of the default ones. Its tiles must have been generated before the first slide is pre-processed (e.g. list it first)')
+
+    parser.add_argument('--distributed', action = 'store_true', dest = 'DISTRIBUTED', help = 'Share the slides with other nodes running the pipeline on the same QuPath project and OUTPUT_DIR (e.g. on a shared file system): each slide is claimed through a lease file under OUTPUT_DIR/leases, so that it is processed by a single node')
+
+    parser.add_argument('--nodeId', nargs = '?', default = None, type = str, dest = "NODE_ID", help = 'Name of this node in the lease files (--distributed). Default: <host name>-<process id>')
+
+    parser.add_argument('--leaseTTL', nargs = '?', default = 600, type = float, dest = "LEASE_TTL", help = 'Seconds after which the lease of a slide that has not been renewed (e.g. because its node died) is taken over by another node (--distributed)')
+
+    parser.add_argument('--watch', action = 'store_true', dest = 'WATCH', help = 'Compute the median intensities of the tiles of each slide and normalize them provisionally while QuPath is still generating them; once the generation ends, only the final thresholds are applied and the kept tiles committed. Slides are watched when their tiles are generated one at a time (--wsiList or --wsiDir, pipelined and distributed runs)')
+
+    parser.add_argument('--watchInterval', nargs = '?', default = 1.0, type = float, dest = "WATCH_INTERVAL", help = 'Seconds between two listings of the tiles folder of a watched slide (--watch): a tile is read once its size and modification time did not change between two listings. Larger values suit slow network shares, where tiles may be written in several steps')
+
+    parser.add_argument('--deferReport', action = 'store_true', dest = 'DEFER_REPORT', help = 'Do not render the histogram of each slide while pre-processing it: the median intensities and thresholds are saved in the manifest and the histograms can be rendered later, in parallel, through renderReports.py')
+
+    parser.add_argument('--tiffDir', nargs = '?', default = None, type = str, dest = "TIFF_DIR", help = 'Absolute path to a folder of pyramidal TIFF WSIs (e.g. .tif, .svs), each one with its annotations exported from QuPath as GeoJSON (<slide>.geojson). The tiles intersecting the annotations are read in-process from the TIFF files and pre-processed without running QuPath nor writing them to TILES_DIR')
+
+    parser.add_argument('--tileSize', nargs = '?', default = 512, type = int, dest = "TILE_SIZE", help = 'Edge length (in pixels) of the tiles read from the TIFF files (--tiffDir)')
+
+    parser.add_argument('--tiffLevel', nargs = '?', default = 0, type = int, dest = "TIFF_LEVEL", help = 'Pyramid level the tiles are read from (--tiffDir), 0 being the full resolution')
+
+    parser.add_argument('--metricsFile', nargs = '?', default = None, type = str, dest = "METRICS_FILE", help = 'Absolute path to the .jsonl file where the metrics of each stage (wall and CPU time, tiles/s, bytes read and written, peak memory) will be appended')
+
+    parser.add_argument('--promFile', nargs = '?', default = None, type = str, dest = "PROM_FILE", help = 'Absolute path to the .prom file where a Prometheus textfile snapshot of the metrics of each stage will be kept up to date (e.g. in the directory of the node exporter textfile collector)')
     
     return parser
 
@@ -48,6 +101,16 @@ def create_parser():
 parser = create_parser()
 args = parser.parse_args()
 
+if args.THRESHOLD_MODE == "group" and args.WSIs_DIR is None:
+    parser.error("--thresholds group needs the file slidesToProcess.csv storing the group of each slide (--wsiDir)")
+
+# The TIFF WSIs are pre-processed one at a time in-process (see tiffRun), hence the options of the QuPath runs do not apply to them
+if args.TIFF_DIR is not None:
+    unsupported = [flag for flag, used in [("--distributed", args.DISTRIBUTED), ("--watch", args.WATCH), ("--generationProcesses", args.GENERATION_PROCESSES > 1),
+                                           ("--maxPendingSlides", args.MAX_PENDING_SLIDES > 1)] if used]
+    if len(unsupported) > 0:
+        parser.error(f"--tiffDir does not support {', '.join(unsupported)}: the TIFF WSIs are tiled in-process one at a time, without running QuPath")
+
 # Set the default value of both tiles and results directory to the QuPath project directory
 if args.TILES_DIR is None:
     dirname = os.path.dirname(args.QUPATH_PROJ)
@@ -86,6 +149,7 @@ elif args.WSIs_DIR != None:
     wsi_dir = click.prompt('\n'"Proceed with tiles generation and pre-processing? y/n")
     if wsi_dir == 'y':
         wsiDir = args.WSIs_DIR
+        import pandas as pd
         wsiDf = pd.read_csv(os.path.join(wsiDir, "slidesToProcess.csv"))
         wsiList = wsiDf['Slide'].tolist()
     else:
@@ -104,16 +168,18 @@ else:
     print('\n''You provided inconsistent arguments. Please check again.')
     exit()
 
-with open(f'{args.GROOVY_SCRIPT_DIR}','r') as fn:
-    ln = fn.readlines()
-for idx, i in enumerate(ln):
-    if i.startswith("def pathOutput = buildFilePath"):
-        ln[idx] = f"def pathOutput = buildFilePath('{args.TILES_DIR}', name_n)\n"
-    elif i.startswith("File logfile = new File"):
-        ln[idx] = f"File logfile = new File('{args.OUTPUT_DIR}', 'logfile.log')\n"
-with open(f'{args.GROOVY_SCRIPT_DIR}','w') as fn:
-    fn.writelines(ln)
-    fn.close()
+# The groovy script is only needed when tiles are generated through QuPath
+if args.TIFF_DIR is None:
+    with open(f'{args.GROOVY_SCRIPT_DIR}','r') as fn:
+        ln = fn.readlines()
+    for idx, i in enumerate(ln):
+        if i.startswith("def pathOutput = buildFilePath"):
+            ln[idx] = f"def pathOutput = buildFilePath(System.getenv(\"TILES_DIR\") ?: '{args.TILES_DIR}', name_n)\n"
+        elif i.startswith("File logfile = new File"):
+            ln[idx] = f"File logfile = new File('{args.OUTPUT_DIR}', 'logfile.log')\n"
+    with open(f'{args.GROOVY_SCRIPT_DIR}','w') as fn:
+        fn.writelines(ln)
+        fn.close()
       
 # Check if the results directory exists, otherwise create it
 outputDir = args.OUTPUT_DIR
@@ -124,6 +190,6 @@ if not check_outputDir:
 else:
 	print('\n\n' f"Results from tiles pre-processing will be stored under: {args.OUTPUT_DIR}")
 
-tilesPreprocessing = pipeline(args.QUPATH_PROJ, args.GROOVY_SCRIPT_DIR, args.SHELL_SCRIPT_DIR, args.TILES_DIR, args.OUTPUT_DIR, args.WSIs_DIR, jpgNormTiles = args.JPG_NORM_TILES, wsiList = wsiList, lowerPerc = args.LOWER_PERCENTILE, upperPerc = args.UPPER_PERCENTILE)
+tilesPreprocessing = pipeline(args.QUPATH_PROJ, args.GROOVY_SCRIPT_DIR, args.SHELL_SCRIPT_DIR, args.TILES_DIR, args.OUTPUT_DIR, args.WSIs_DIR, jpgNormTiles = args.JPG_NORM_TILES, wsiList = wsiList, lowerPerc = args.LOWER_PERCENTILE, upperPerc = args.UPPER_PERCENTILE, batchSize = args.BATCH_SIZE, workers = args.WORKERS, maxPendingSlides = args.MAX_PENDING_SLIDES, cacheSize = args.CACHE_SIZE, pickleNormTiles = args.PICKLE_NORM_TILES, fastFilterScale = args.FAST_FILTER_SCALE, resume = args.RESUME, metricsFile = args.METRICS_FILE, promFile = args.PROM_FILE, generationProcesses = args.GENERATION_PROCESSES, stainSampleSize = args.STAIN_SAMPLE_SIZE, stainSampling = args.STAIN_SAMPLING, slideStains = args.SLIDE_STAINS, stainTiles = args.STAIN_TILES, referenceSlide = args.REFERENCE_SLIDE, distributed = args.DISTRIBUTED, nodeId = args.NODE_ID, leaseTTL = args.LEASE_TTL, deferReport = args.DEFER_REPORT, tiffDir = args.TIFF_DIR, tileSize = args.TILE_SIZE, tiffLevel = args.TIFF_LEVEL, writerThreads = args.WRITER_THREADS, thresholdMode = args.THRESHOLD_MODE, groupColumn = args.GROUP_COLUMN, watch = args.WATCH, watchInterval = args.WATCH_INTERVAL)
 
 tilesPreprocessing.initialize()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable summaries of the median intensities of the tiles, used to compute the thresholds of the quality filter on several slides at once
+(e.g. on a whole cohort) without keeping the median intensity of every tile in memory.
+
+The median intensity of a tile (np.median of its 8-bit pixel values) is always a multiple of 0.5 between 0 and 255, hence it takes at most
+511 distinct values. A quantileSketch counts the tiles for each of these values: its size is fixed regardless of the number of tiles and
+slides summarized, two sketches are merged by adding their counters and the percentiles of the log10-transformed median intensities are
+computed from the counters in the same way as midpointPercentile (used by preprocessing.filterTiles) on the full list of
+values. Hence the thresholds computed from a sketch are exactly the ones computed from the median intensities it summarizes. Values that are
+not multiples of the resolution (0.5 intensity levels by default) are rounded to the nearest multiple, i.e. they are off by at most
+resolution/2 intensity levels.
+
+The sketch of a slide is saved in sketch_<slide>.json together with the settings it was computed with and the size and modification time of
+its sources (the tiles of the slide, or its TIFF and GeoJSON files), so that it can be reused as long as none of them changed.
+
+Example of sketch file:
+    {"settings": {"fastFilterScale": 1}, "sketch": {"resolution": 0.5, "counts": {"402": 12, "415": 30}},
+     "sources": {"tile_name.jpg": [45012, 1666087321000000000]}}
+"""
+
+import json
+import numpy as np
+import os
+
+from tilesLeases import writeJson
+
+
+def midpointPercentile(values, q):
+
+    ''' Returns the q-th percentile of values as np.percentile with the 'midpoint' method. Both the quality filter (preprocessing.filterTiles)
+    and quantileSketch.percentile compute their percentiles through this function, hence the thresholds computed from a sketch stay exactly
+    the ones computed on the values it summarizes.'''
+
+    return np.percentile(values, q, method = 'midpoint')
+
+
+class quantileSketch:
+
+    '''
+    Counts of the median intensities of a set of tiles (see the module docstring), quantized to multiples of resolution between 0 and
+    maxIntensity. Values are added as log10-transformed median intensities, i.e. as returned by preprocessing.logMedianIntensity.
+    '''
+
+    def __init__(self, resolution=0.5, maxIntensity=255):
+
+        self.resolution = resolution
+        self.counts = np.zeros(int(round(maxIntensity / resolution)) + 1, dtype=np.int64)
+
+    def add(self, logMedianIntensities):
+
+        ''' Adds the given log10-transformed median intensities to the sketch.'''
+
+        bins = np.rint(np.power(10, np.asarray(logMedianIntensities, dtype=np.float64)) / self.resolution).astype(np.int64)
+        self.counts += np.bincount(np.clip(bins, 0, len(self.counts) - 1), minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+
+        ''' Adds the counts of another sketch (with the same resolution) to this one.'''
+
+        if other.resolution != self.resolution or len(other.counts) != len(self.counts):
+            raise ValueError("Only sketches with the same resolution and range can be merged")
+        self.counts += other.counts
+        return self
+
+    def count(self):
+
+        return int(self.counts.sum())
+
+    def orderStatistic(self, k):
+
+        ''' Returns the k-th smallest (from 0) log10-transformed median intensity summarized by the sketch.'''
+
+        idx = int(np.searchsorted(np.cumsum(self.counts), k, side='right'))
+        with np.errstate(divide='ignore'):
+            return np.log10(np.float64(idx * self.resolution))
+
+    def percentile(self, q):
+
+        ''' Returns the q-th percentile of the log10-transformed median intensities, as midpointPercentile(values, q).'''
+
+        n = self.count()
+        if n == 0:
+            raise ValueError("The percentiles of an empty sketch are undefined")
+        # Virtual index of the percentile as computed by numpy for the 'midpoint' method: either an integer (the percentile is
+        # one of the values) or halfway between two consecutive integers (the percentile is the midpoint of two consecutive values)
+        quantile = np.true_divide(q, 100)
+        virtualIndex = 0.5 * (np.floor((n - 1) * quantile) + np.ceil((n - 1) * quantile))
+        previous = int(np.floor(virtualIndex))
+        values = np.array([self.orderStatistic(previous), self.orderStatistic(min(previous + 1, n - 1))])
+        return midpointPercentile(values, 100 * (virtualIndex - previous))
+
+    def toDict(self):
+
+        return {"resolution": self.resolution, "counts": {str(k): int(self.counts[k]) for k in np.flatnonzero(self.counts)}}
+
+    @staticmethod
+    def fromDict(content):
+
+        sketch = quantileSketch(content["resolution"])
+        for k, count in content["counts"].items():
+            sketch.counts[int(k)] = count
+        return sketch
+
+
+def sketchPath(folder, file):
+
+    ''' Returns the path of the sketch file of the given slide.'''
+
+    return os.path.join(folder, f"sketch_{file}.json")
+
+
+def loadSketch(path, settings, sources):
+
+    ''' Returns the quantileSketch saved at the given path, or None if it does not exist, was computed with different settings or if
+    its sources (dict mapping the name of each source to its [size, modification time]) changed.'''
+
+    try:
+        with open(path) as fn:
+            content = json.load(fn)
+    except (OSError, ValueError):
+        return None
+    if content["settings"] != settings or content["sources"] != sources:
+        return None
+    return quantileSketch.fromDict(content["sketch"])
+
+
+def saveSketch(path, sketch, settings, sources):
+
+    ''' Saves the sketch atomically (see tilesLeases.writeJson), together with the settings and the sources it was computed with.'''
+
+    writeJson(path, {"settings": settings, "sketch": sketch.toDict(), "sources": sources})
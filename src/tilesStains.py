@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the stain parameters fitted on a slide (see preprocessing.fitSlideStains).
+
+The stain matrix HE and the stain saturation maxC of a slide are saved in stains_<slide>.json, next to the results of the slide,
+together with the settings they were fitted with and the size and modification time of the sources of the tiles they were fitted on (the
+tile files, or the TIFF file the tiles were read from), so that a following run (or the use of the slide as reference) can reuse them as long
+as neither the settings nor those tiles changed.
+
+Example of stains file:
+    {"settings": {"numTiles": 64, "pixelsPerTile": 16384, "lowerPerc": 10, "upperPerc": 90},
+     "HE": [[0.56, 0.21], [0.72, 0.80], [0.40, 0.55]], "maxC": [1.97, 1.03],
+     "tiles": {"tile_name.jpg": [45012, 1666087321000000000]}}
+"""
+
+import json
+import numpy as np
+import os
+
+from tilesLeases import writeJson
+
+
+def stainsPath(folder, file):
+
+    ''' Returns the path of the stains file of the given slide.'''
+
+    return os.path.join(folder, f"stains_{file}.json")
+
+
+def loadStains(path, settings, tileStats):
+
+    ''' Returns the (HE, maxC) pair saved at the given path, or None if it does not exist, was fitted with different settings or
+    if any of the tiles it was fitted on changed. tileStats maps the name of each tile of the slide to its (size, modification time).'''
+
+    try:
+        with open(path) as fn:
+            stains = json.load(fn)
+    except (OSError, ValueError):
+        return None
+    if stains["settings"] != settings:
+        return None
+    for name, stat in stains["tiles"].items():
+        if name not in tileStats or list(tileStats[name]) != stat:
+            return None
+    return np.array(stains["HE"]), np.array(stains["maxC"])
+
+
+def saveStains(path, HE, maxC, settings, tileStats):
+
+    ''' Saves the stain parameters atomically, together with the settings and the tiles they were fitted on (tileStats maps the name of each
+    of them to its (size, modification time)).'''
+
+    stains = {"settings": settings, "HE": HE.tolist(), "maxC": maxC.tolist(), "tiles": {name: list(stat) for name, stat in tileStats.items()}}
+    writeJson(path, stains, indent = 2)
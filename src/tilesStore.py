@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk store for the normalized tiles of a WSI.
+
+The tiles are appended, as raw uint8 bytes, to a sequence of chunk files of bounded size (chunk_00000.bin, chunk_00001.bin, ...),
+while a csv index (index.csv) records, for each tile, the chunk it was written to, its byte offset and its shape.
+The store is written incrementally, one tile at a time, so that the normalized tiles of a WSI never need to be held in memory
+all together, and it is read by memory-mapping the chunk files, so that a single tile can be accessed without loading the others.
+
+Example of usage:
+    store = tilesStore("path/to/normTiles_<slide>.store")
+    len(store)                   # number of tiles stored
+    tile = store["tile_name.jpg"]  # read-only numpy array of shape (512, 512, 3) backed by the chunk file
+"""
+
+import csv
+import numpy as np
+import os
+import shutil
+
+
+indexName = "index.csv"
+indexFields = ["tile", "chunk", "offset", "height", "width", "channels"]
+
+
+def chunkName(chunk):
+
+    ''' Returns the file name of the chunk with the given number.'''
+
+    return f"chunk_{chunk:05d}.bin"
+
+
+def readIndex(storeDir):
+
+    ''' Returns the rows of the index of a store as a list of dictionaries, skipping a possibly truncated last row. '''
+
+    rows = []
+    with open(os.path.join(storeDir, indexName), newline='') as fn:
+        for row in csv.DictReader(fn):
+            if None in row.values() or "" in row.values():
+                break
+            rows.append(row)
+    return rows
+
+
+class tilesStoreWriter:
+
+    '''
+    Writes the tiles of a WSI into a new store at storeDir (an existing store at the same path is replaced), or, if append is True,
+    adds them to the existing store. A new chunk file is started as soon as the current one would exceed chunkBytes.
+    The index is flushed after each tile, so that the tiles written before an interruption can be found again.
+    '''
+
+    def __init__(self, storeDir, chunkBytes=256*1024**2, append=False):
+
+        rows = readIndex(storeDir) if append and os.path.exists(os.path.join(storeDir, indexName)) else None
+        if rows is None:
+            if os.path.exists(storeDir):
+                shutil.rmtree(storeDir)
+            os.makedirs(storeDir)
+            rows = []
+
+        self.storeDir = storeDir
+        self.chunkBytes = chunkBytes
+        # When appending, the tiles are written to a new chunk, so that the bytes possibly left by an interrupted run are never referenced
+        self.chunk = max([int(row["chunk"]) for row in rows], default=-1) + 1
+        self.offset = 0
+        self.numTiles = len(rows)
+        self.chunkFile = open(os.path.join(storeDir, chunkName(self.chunk)), 'wb')
+        # The index of the tiles already stored is rewritten to a temporary file first, so that it is never lost
+        indexPath = os.path.join(storeDir, indexName)
+        with open(f"{indexPath}.tmp", 'w', newline='') as fn:
+            writer = csv.writer(fn)
+            writer.writerow(indexFields)
+            writer.writerows([[row[field] for field in indexFields] for row in rows])
+        os.replace(f"{indexPath}.tmp", indexPath)
+        self.indexFile = open(indexPath, 'a', newline='')
+        self.index = csv.writer(self.indexFile)
+
+    def add(self, name, tile):
+
+        tile = np.ascontiguousarray(tile, dtype=np.uint8)
+        if self.offset > 0 and self.offset + tile.nbytes > self.chunkBytes:
+            self.chunkFile.close()
+            self.chunk += 1
+            self.offset = 0
+            self.chunkFile = open(os.path.join(self.storeDir, chunkName(self.chunk)), 'wb')
+
+        self.chunkFile.write(tile.tobytes())
+        self.chunkFile.flush()
+        self.index.writerow([name, self.chunk, self.offset] + list(tile.shape))
+        self.indexFile.flush()
+        self.offset += tile.nbytes
+        self.numTiles += 1
+
+    def close(self):
+
+        self.chunkFile.close()
+        self.indexFile.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+
+class tilesStore:
+
+    '''
+    Read-only, dictionary-like access to a store written by tilesStoreWriter. Tiles are returned as read-only numpy arrays
+    backed by the memory-mapped chunk files, hence no data is copied until the returned array is modified or pickled.
+    '''
+
+    def __init__(self, storeDir):
+
+        self.storeDir = storeDir
+        # If a tile was written more than once (e.g. when a run has been resumed), its last copy is used
+        self.index = {}
+        for row in readIndex(storeDir):
+            self.index[row["tile"]] = (int(row["chunk"]), int(row["offset"]), (int(row["height"]), int(row["width"]), int(row["channels"])))
+        self.chunks = {}
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def __contains__(self, name):
+
+        return name in self.index
+
+    def __iter__(self):
+
+        return iter(self.index)
+
+    def keys(self):
+
+        return self.index.keys()
+
+    def __getitem__(self, name):
+
+        chunk, offset, shape = self.index[name]
+        if chunk not in self.chunks:
+            self.chunks[chunk] = np.memmap(os.path.join(self.storeDir, chunkName(chunk)), dtype=np.uint8, mode='r')
+        nbytes = shape[0] * shape[1] * shape[2]
+        return self.chunks[chunk][offset:offset+nbytes].reshape(shape)
+
+    def items(self):
+
+        for name in self.index:
+            yield name, self[name]
+
+
+def countTiles(storeDir):
+
+    ''' Returns the number of tiles in a store from its index, without opening the chunk files.'''
+
+    return len({row["tile"] for row in readIndex(storeDir)})
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming access to the pre-processing of the tiles, for feeding a data loader directly.
+
+streamTiles runs the quality filter and the stain normalization of the given slides and yields a tuple (slide, tile name, normalized tile)
+as soon as each tile is normalized, without writing anything to disk (unless outputDir is provided) and without ever holding the normalized
+tiles of a whole slide in memory: at most `prefetch` batches of tiles are being normalized ahead of the consumer, and no new batch is started
+until the consumer takes the tiles of the oldest one (backpressure). The tiles must have already been generated (e.g. by QuPath through
+tilesPreprocessing.py or by a previous run).
+
+Example of usage:
+    from tilesStream import streamTiles
+
+    for slide, tileName, tile in streamTiles("path/to/tiles", ["wsi1", "wsi2"], workers=4):
+        ...  # tile is a uint8 numpy array of shape (512, 512, 3)
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from preprocessing import fitSlideStains, filterTiles, logMedianIntensity, normalizeChunk, readFiles, tilesCache
+from tilesStore import tilesStoreWriter
+
+logger = logging.getLogger(__name__)
+
+
+def streamTiles(tilesDir, slides=None, lowerPerc=10, upperPerc=90, batchSize=16, workers=1, prefetch=None, cacheSize=512, fastFilterScale=1,
+                stainSampleSize=None, stainSampling="strided", slideStains=False, stainTiles=64, reference=None, outputDir=None):
+
+    '''
+    Yields a tuple (slide, tile name, normalized tile) for each tile of the given slides (all the subfolders of tilesDir if slides is None)
+    passing the quality filter, in the same order as the pre-processing pipeline. Tiles whose normalization fails are skipped (and logged).
+
+    Input:
+        tilesDir: absolute path to the directory storing one folder of tiles per slide
+        slides: (optional) list of the names of the slides (folders of tilesDir) to stream
+        lowerPerc, upperPerc, batchSize, workers, cacheSize, fastFilterScale, stainSampleSize, stainSampling, slideStains, stainTiles:
+            same meaning as the respective arguments of the pipeline (cacheSize in MB, per slide)
+        reference: (optional) tuple (HERef, maxCRef) used as reference for the stain normalization (see macenkoNormBatch)
+        prefetch: maximum number of batches normalized ahead of the consumer (default: 2 per worker)
+        outputDir: (optional) absolute path to a directory where the normalized tiles are also written, as a tiles store per slide
+                   (normTiles_<slide>.store). If None, nothing is written to disk
+
+    With a single worker, batches are normalized by a background thread, so that normalization overlaps with the consumer;
+    with more workers they are distributed over a pool of processes.
+    '''
+
+    if slides is None:
+        slides = sorted(os.listdir(tilesDir))
+    if prefetch is None:
+        prefetch = 2 * workers
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else ThreadPool(1)
+    try:
+        for slide in slides:
+            yield from streamSlide(pool, os.path.join(tilesDir, slide), slide, lowerPerc, upperPerc, batchSize, max(1, prefetch), cacheSize, fastFilterScale,
+                                   stainSampleSize, stainSampling, slideStains, stainTiles, reference, outputDir)
+    finally:
+        # Also reached when the consumer stops iterating early: batches still being normalized are dropped
+        pool.terminate()
+        pool.join()
+
+
+def streamSlide(pool, wsiTilesDir, slide, lowerPerc, upperPerc, batchSize, prefetch, cacheSize, fastFilterScale, stainSampleSize, stainSampling,
+                slideStains, stainTiles, reference, outputDir):
+
+    ''' Filters the tiles of a slide and yields its normalized tiles, keeping at most prefetch batches in flight on the given pool.'''
+
+    tiles = readFiles(wsiTilesDir)
+    cache = tilesCache(cacheSize * 1024**2)
+    darkTh, whiteTh, tilesToKeep = filterTiles(logMedianIntensity(wsiTilesDir, tiles, cache, fastFilterScale), lowerPerc, upperPerc)
+    keptTiles = [i for countPos, i in enumerate(tiles) if tilesToKeep[countPos] == True]
+    # Decoded tiles that were discarded are released right away
+    for i in set(tiles) - set(keptTiles):
+        cache.pop(i)
+
+    stains = None
+    if slideStains == True and len(keptTiles) > 0:
+        try:
+            HE, maxC, sampledTiles = fitSlideStains(wsiTilesDir, keptTiles, stainTiles)
+            stains = (HE, maxC)
+        except ValueError as e:
+            logger.warning(f"The stain vectors of {slide} could not be fitted, hence they are estimated tile by tile: {e}")
+
+    normalizer = partial(normalizeChunk, wsiTilesDir, batchSize=batchSize, sampleSize=stainSampleSize, sampling=stainSampling, stains=stains, reference=reference)
+    store = tilesStoreWriter(os.path.join(outputDir, f"normTiles_{slide}.store")) if outputDir is not None else None
+    pending = collections.deque()
+
+    def results(batch):
+        for name, normTile, error in batch.get():
+            if error is not None:
+                logger.warning(f"Tile {name} of {slide} had problems during the Macenko normalization\n{error}")
+                continue
+            if store is not None:
+                store.add(name, normTile)
+            yield slide, name, normTile
+
+    try:
+        for k in range(0, len(keptTiles), batchSize):
+            # Cached tiles leave the cache only when their batch is submitted
+            pending.append(pool.apply_async(normalizer, ([(name, cache.pop(name)) for name in keptTiles[k:k+batchSize]],)))
+            if len(pending) > prefetch:
+                yield from results(pending.popleft())
+        while len(pending) > 0:
+            yield from results(pending.popleft())
+    finally:
+        if store is not None:
+            store.close()
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+In-process tiling of pyramidal TIFF WSIs, as an alternative to tiles generation through QuPath (see pipeline.tiffRun).
+
+The TIFF file is memory-mapped and its tiled storage is read directly: uncompressed tiles are returned as views of the memory-mapped
+file (no copy, no decoding), JPEG and deflate compressed tiles are decoded in memory. Only the tiles of a regular grid (aligned to the
+image, tileSize x tileSize pixels) intersecting the annotated regions are read; the annotations are polygons (in level 0 pixel coordinates)
+exported from QuPath as GeoJSON (File > Export objects as GeoJSON), e.g. <slide>.geojson next to <slide>.tif.
+
+Supported TIFF files: classic TIFF and BigTIFF, little and big endian, tiled pages with 8 bits per sample, RGB(A) or YCbCr pixels stored
+contiguously and no, JPEG (abbreviated streams included) or deflate compression. Each tiled page is a level of the pyramid (e.g. Aperio
+SVS, or pyramids saved as pages); the levels stored as SubIFDs of the first page (e.g. OME-TIFF) are used too.
+
+Example of usage:
+    slide = tiffSlide("path/to/slide.tif")
+    for name, tile in tiffTiles(slide, loadAnnotations("path/to/slide.geojson"), tileSize=512):
+        ...  # tile is a uint8 numpy array of shape (512, 512, 3)
+
+writeTiledTiff writes synthetic pyramidal TIFFs, e.g. to check the tiler or to benchmark it without real WSIs.
+"""
+
+import io
+import json
+import math
+import numpy as np
+import os
+import struct
+import zlib
+
+from PIL import Image
+
+# Size in bytes of the TIFF field types: BYTE, ASCII, SHORT, LONG, RATIONAL, SBYTE, UNDEFINED, SSHORT, SLONG, SRATIONAL, FLOAT, DOUBLE, LONG8
+tiffTypes = {1: "B", 2: "s", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d", 16: "Q", 17: "q", 18: "Q"}
+
+# Tags read by tiffSlide
+tiffTags = {256: "width", 257: "height", 258: "bitsPerSample", 259: "compression", 262: "photometric", 277: "samplesPerPixel",
+            284: "planarConfig", 317: "predictor", 322: "tileWidth", 323: "tileHeight", 324: "tileOffsets", 325: "tileByteCounts",
+            330: "subIFDs", 347: "jpegTables"}
+
+
+class tiffSlide:
+
+    '''
+    Memory-mapped pyramidal TIFF file. levels lists the tiled pages of the file (largest first) as dictionaries storing their tags;
+    readRegion returns any region of a level, reading only the tiles of the file it overlaps.
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        byteOrder = bytes(self.data[:2])
+        if byteOrder not in (b"II", b"MM"):
+            raise ValueError(f"{path} is not a TIFF file")
+        self.endian = "<" if byteOrder == b"II" else ">"
+        version = self.unpack("H", 2)[0]
+        if version == 42:
+            self.bigTiff = False
+            offset = self.unpack("I", 4)[0]
+        elif version == 43:
+            self.bigTiff = True
+            offset = self.unpack("Q", 8)[0]
+        else:
+            raise ValueError(f"{path} is not a TIFF file")
+
+        pages = []
+        while offset != 0:
+            page, offset = self.readIFD(offset)
+            pages.append(page)
+        if len(pages) > 0:
+            pages += [self.readIFD(subOffset)[0] for subOffset in pages[0].get("subIFDs", [])]
+        self.levels = sorted([page for page in pages if "tileOffsets" in page], key=lambda page: -page["width"])
+        if len(self.levels) == 0:
+            raise ValueError(f"{path} has no tiled pages")
+        for level in self.levels:
+            self.checkLevel(level)
+
+    @property
+    def width(self):
+
+        return self.levels[0]["width"]
+
+    @property
+    def height(self):
+
+        return self.levels[0]["height"]
+
+    def downsample(self, level):
+
+        ''' Returns the downsampling factor of the given level with respect to level 0.'''
+
+        return self.levels[0]["width"] / self.levels[level]["width"]
+
+    def unpack(self, fmt, offset):
+
+        size = struct.calcsize(self.endian + fmt)
+        return struct.unpack(self.endian + fmt, bytes(self.data[offset:offset+size]))
+
+    def readIFD(self, offset):
+
+        ''' Reads the image file directory at the given offset. Returns its tags (the ones in tiffTags) and the offset of the next one.'''
+
+        countFmt, entrySize, valueSize, offsetFmt = ("Q", 20, 8, "Q") if self.bigTiff else ("H", 12, 4, "I")
+        numEntries = self.unpack(countFmt, offset)[0]
+        offset += struct.calcsize(countFmt)
+        page = {}
+        for k in range(numEntries):
+            entry = offset + k * entrySize
+            tag, fieldType = self.unpack("HH", entry)
+            if tag not in tiffTags or fieldType not in tiffTypes:
+                continue
+            count = self.unpack(offsetFmt, entry + 4)[0]
+            fmt = tiffTypes[fieldType]
+            size = struct.calcsize(self.endian + fmt) * count
+            valueOffset = entry + 4 + struct.calcsize(offsetFmt)
+            if size > valueSize:
+                valueOffset = self.unpack(offsetFmt, valueOffset)[0]
+            if fieldType in (1, 7) and tag == 347:
+                page[tiffTags[tag]] = bytes(self.data[valueOffset:valueOffset+count])
+                continue
+            values = np.frombuffer(self.data, dtype=np.dtype(self.endian + fmt[0]), count=count * len(fmt), offset=valueOffset)
+            page[tiffTags[tag]] = values.astype(np.int64) if count > 1 or tag in (258, 324, 325, 330) else int(values[0])
+        nextOffset = self.unpack(offsetFmt, offset + numEntries * entrySize)[0]
+        return page, nextOffset
+
+    def checkLevel(self, level):
+
+        level.setdefault("compression", 1)
+        level.setdefault("photometric", 2)
+        level.setdefault("samplesPerPixel", 1)
+        level.setdefault("planarConfig", 1)
+        level.setdefault("predictor", 1)
+        bitsPerSample = np.atleast_1d(level.get("bitsPerSample", 1))
+        if np.any(bitsPerSample != 8) or level["samplesPerPixel"] not in (3, 4) or level["planarConfig"] != 1:
+            raise ValueError(f"{self.path}: only RGB(A) pages with 8 bits per sample stored contiguously are supported")
+        if level["compression"] not in (1, 7, 8, 32946):
+            raise ValueError(f"{self.path}: compression {level['compression']} is not supported (only none, JPEG and deflate are)")
+        level["tileOffsets"] = np.atleast_1d(level["tileOffsets"])
+        level["tileByteCounts"] = np.atleast_1d(level["tileByteCounts"])
+        level["tilesAcross"] = math.ceil(level["width"] / level["tileWidth"])
+
+    def readTile(self, level, row, col):
+
+        ''' Returns the stored tile (row, col) of the given level as a uint8 array of shape (tileHeight, tileWidth, 3). Uncompressed
+        tiles are read-only views of the memory-mapped file.'''
+
+        page = self.levels[level]
+        index = row * page["tilesAcross"] + col
+        offset, byteCount = int(page["tileOffsets"][index]), int(page["tileByteCounts"][index])
+        tileHeight, tileWidth, samples = page["tileHeight"], page["tileWidth"], page["samplesPerPixel"]
+        if page["compression"] == 1:
+            tile = self.data[offset:offset+tileHeight*tileWidth*samples].reshape((tileHeight, tileWidth, samples))
+        elif page["compression"] in (8, 32946):
+            tile = np.frombuffer(zlib.decompress(self.data[offset:offset+byteCount]), dtype=np.uint8).reshape((tileHeight, tileWidth, samples))
+            if page["predictor"] == 2:
+                tile = np.cumsum(tile, axis=1, dtype=np.uint8)
+        else:
+            stream = bytes(self.data[offset:offset+byteCount])
+            # Abbreviated JPEG streams share the tables stored in the page: the tables (without their end of image marker) are put
+            # in front of the stream (without its start of image marker)
+            if "jpegTables" in page:
+                stream = page["jpegTables"][:-2] + stream[2:]
+            img = Image.open(io.BytesIO(stream))
+            # Pixels stored as RGB (e.g. Aperio SVS) were not converted to YCbCr when encoded, hence they must not be converted back
+            if page["photometric"] == 2 and img.mode == "RGB":
+                img.draft("YCbCr", img.size)
+            tile = np.asarray(img)
+        return tile[:, :, :3]
+
+    def readRegion(self, x, y, width, height, level=0):
+
+        ''' Returns the region of the given level whose top-left corner is (x, y), as a uint8 array of shape (height, width, 3).
+        Pixels outside the image are white. A region matching a single uncompressed tile of the file is returned without copying it.'''
+
+        page = self.levels[level]
+        tileWidth, tileHeight = page["tileWidth"], page["tileHeight"]
+        if (x % tileWidth == 0 and y % tileHeight == 0 and width == tileWidth and height == tileHeight
+                and x + width <= page["width"] and y + height <= page["height"]):
+            return self.readTile(level, y // tileHeight, x // tileWidth)
+
+        region = np.full((height, width, 3), 255, dtype=np.uint8)
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, page["width"]), min(y + height, page["height"])
+        for row in range(y0 // tileHeight, (y1 - 1) // tileHeight + 1 if y1 > y0 else 0):
+            for col in range(x0 // tileWidth, (x1 - 1) // tileWidth + 1 if x1 > x0 else 0):
+                tile = self.readTile(level, row, col)
+                tx0, ty0 = max(x0, col * tileWidth), max(y0, row * tileHeight)
+                tx1, ty1 = min(x1, (col + 1) * tileWidth), min(y1, (row + 1) * tileHeight)
+                region[ty0-y:ty1-y, tx0-x:tx1-x] = tile[ty0-row*tileHeight:ty1-row*tileHeight, tx0-col*tileWidth:tx1-col*tileWidth]
+        return region
+
+    def close(self):
+
+        ''' Releases the memory-mapped file. The mapping is unmapped once the tiles returned without copying are released too.'''
+
+        self.data = None
+
+
+def loadAnnotations(path):
+
+    ''' Returns the polygons stored in the given GeoJSON file (a FeatureCollection, a list of features, a feature or a geometry), each of them
+    as a list of rings (the outer ring followed by its holes, numpy arrays of (x, y) vertices). Geometries other than polygons are ignored.'''
+
+    with open(path) as fn:
+        geo = json.load(fn)
+    if isinstance(geo, dict) and geo.get("type") == "FeatureCollection":
+        geo = geo["features"]
+    geometries = [item.get("geometry", item) for item in (geo if isinstance(geo, list) else [geo])]
+
+    polygons = []
+    for geometry in geometries:
+        if geometry is None:
+            continue
+        if geometry["type"] == "Polygon":
+            polygons.append(geometry["coordinates"])
+        elif geometry["type"] == "MultiPolygon":
+            polygons.extend(geometry["coordinates"])
+    return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon if len(ring) > 2] for polygon in polygons]
+
+
+def annotationTiles(polygons, width, height, tileSize=512, scale=1):
+
+    '''Returns the grid cells (row, col) of the tileSize x tileSize tiles of a width x height image intersecting the given polygons, in
+    row-major order. The vertices of the polygons are divided by scale (e.g. the downsampling factor of the level being tiled).
+    A tile intersects a polygon if the boundary of the polygon crosses it or if its center lies inside the polygon (tiles within a hole
+    of the polygon are excluded).'''
+
+    rows, cols = math.ceil(height / tileSize), math.ceil(width / tileSize)
+    grid = np.zeros((rows, cols), dtype=bool)
+    for polygon in polygons:
+        rings = [ring / scale / tileSize for ring in polygon]
+
+        # Cells crossed by the edges: each edge is clipped to the columns it spans, and the rows it spans within each column are marked
+        for ring in rings:
+            for (ax, ay), (bx, by) in zip(ring, np.roll(ring, -1, axis=0)):
+                if ax > bx:
+                    ax, ay, bx, by = bx, by, ax, ay
+                for col in range(max(int(math.floor(ax)), 0), min(int(math.floor(bx)), cols - 1) + 1):
+                    if bx > ax:
+                        ya = ay + (by - ay) * (min(max(col, ax), bx) - ax) / (bx - ax)
+                        yb = ay + (by - ay) * (min(max(col + 1, ax), bx) - ax) / (bx - ax)
+                    else:
+                        ya, yb = ay, by
+                    rowStart, rowEnd = int(math.floor(min(ya, yb))), int(math.floor(max(ya, yb)))
+                    # Parts of the edge above or below the image cross no cell (bounds are clamped, never used as negative indices)
+                    if rowEnd < 0 or rowStart >= rows:
+                        continue
+                    grid[max(rowStart, 0):min(rowEnd, rows - 1) + 1, col] = True
+
+        # Cells whose center is inside the polygon: the crossings of the edges with the horizontal line through the centers of each row
+        # are sorted, and the centers between pairs of crossings (even-odd rule, which also accounts for holes) are marked
+        edges = np.concatenate([np.stack((ring, np.roll(ring, -1, axis=0)), axis=1) for ring in rings])
+        yMin, yMax = edges[:, :, 1].min(), edges[:, :, 1].max()
+        for row in range(max(int(math.floor(yMin)), 0), min(int(math.ceil(yMax)), rows)):
+            yc = row + 0.5
+            a, b = edges[:, 0], edges[:, 1]
+            crossing = (a[:, 1] <= yc) != (b[:, 1] <= yc)
+            xs = np.sort(a[crossing, 0] + (yc - a[crossing, 1]) * (b[crossing, 0] - a[crossing, 0]) / (b[crossing, 1] - a[crossing, 1]))
+            for xa, xb in zip(xs[0::2], xs[1::2]):
+                colStart, colEnd = max(int(math.ceil(xa - 0.5)), 0), min(int(math.ceil(xb - 0.5)), cols)
+                if colEnd > colStart:
+                    grid[row, colStart:colEnd] = True
+
+    return [(int(row), int(col)) for row, col in np.argwhere(grid)]
+
+
+def gridTiles(slide, polygons, tileSize=512, level=0, name=None):
+
+    '''Returns a dictionary mapping the name of each tileSize x tileSize tile of the given level of a tiffSlide intersecting the polygons (in level 0
+    pixel coordinates, see loadAnnotations) to the position (x, y) of its top-left corner in that level, in row-major order. Tiles are named as the
+    ones generated through QuPath (<slide>_(<x center>_<y center>)_<index>.jpg, in level 0 pixel coordinates), name being the name of the slide
+    (by default, the name of the file without extension and white spaces).'''
+
+    if name is None:
+        name = os.path.splitext(os.path.basename(slide.path))[0].replace(" ", "")
+    page, downsample = slide.levels[level], slide.downsample(level)
+    origins = {}
+    for k, (row, col) in enumerate(annotationTiles(polygons, page["width"], page["height"], tileSize, downsample)):
+        x, y = col * tileSize, row * tileSize
+        origins[f"{name}_({(x + tileSize / 2) * downsample}_{(y + tileSize / 2) * downsample})_{k + 1}.jpg"] = (x, y)
+    return origins
+
+
+def tiffTiles(slide, polygons, tileSize=512, level=0, name=None):
+
+    '''Yields a tuple (tile name, tile) for each tile of gridTiles(slide, polygons, tileSize, level, name).'''
+
+    for tileName, (x, y) in gridTiles(slide, polygons, tileSize, level, name).items():
+        yield tileName, slide.readRegion(x, y, tileSize, tileSize, level)
+
+
+def writeTiledTiff(path, img, tileSize=256, numLevels=3, compression=None, bigTiff=False):
+
+    '''Writes the uint8 RGB image img (shape (h, w, 3)) to a pyramidal tiled TIFF of numLevels levels (each one half the size of the previous one),
+    saved as pages. compression can be None, "deflate" or "jpeg" (each tile being a complete JPEG stream, YCbCr encoded).'''
+
+    levels = [np.ascontiguousarray(img)]
+    for k in range(1, numLevels):
+        previous = levels[-1][:levels[-1].shape[0] // 2 * 2, :levels[-1].shape[1] // 2 * 2].astype(np.uint16)
+        levels.append(((previous[0::2, 0::2] + previous[1::2, 0::2] + previous[0::2, 1::2] + previous[1::2, 1::2] + 2) // 4).astype(np.uint8))
+
+    endian = "<"
+    offsetFmt, countFmt, valueSize = ("Q", "Q", 8) if bigTiff else ("I", "H", 4)
+    compressionTag, photometric = {None: (1, 2), "deflate": (8, 2), "jpeg": (7, 6)}[compression]
+    with open(path, 'wb') as fn:
+        fn.write(b"II" + (struct.pack(endian + "HHHQ", 43, 8, 0, 0) if bigTiff else struct.pack(endian + "HI", 42, 0)))
+        ifdPointer = 8 if bigTiff else 4
+        for level in levels:
+            h, w = level.shape[:2]
+            padded = np.zeros((math.ceil(h / tileSize) * tileSize, math.ceil(w / tileSize) * tileSize, 3), dtype=np.uint8)
+            padded[:h, :w] = level
+            offsets, byteCounts = [], []
+            for row in range(0, padded.shape[0], tileSize):
+                for col in range(0, padded.shape[1], tileSize):
+                    tile = np.ascontiguousarray(padded[row:row+tileSize, col:col+tileSize])
+                    if compression == "deflate":
+                        data = zlib.compress(tile.tobytes())
+                    elif compression == "jpeg":
+                        buffer = io.BytesIO()
+                        Image.fromarray(tile).save(buffer, format="JPEG", quality=90)
+                        data = buffer.getvalue()
+                    else:
+                        data = tile.tobytes()
+                    offsets.append(fn.tell())
+                    byteCounts.append(len(data))
+                    fn.write(data)
+
+            longType = 16 if bigTiff else 4
+            entries = [(256, 4, [w]), (257, 4, [h]), (258, 3, [8, 8, 8]), (259, 3, [compressionTag]), (262, 3, [photometric]), (277, 3, [3]),
+                       (284, 3, [1]), (322, 3, [tileSize]), (323, 3, [tileSize]), (324, longType, offsets), (325, longType, byteCounts)]
+            # Values longer than the value field of an entry are written (word aligned) before the directory, the others are left-aligned in it
+            fields = []
+            for tag, fieldType, values in entries:
+                packed = struct.pack(endian + tiffTypes[fieldType] * len(values), *values)
+                if len(packed) > valueSize:
+                    if fn.tell() % 2 == 1:
+                        fn.write(b"\0")
+                    fields.append((tag, fieldType, len(values), struct.pack(endian + offsetFmt, fn.tell())))
+                    fn.write(packed)
+                else:
+                    fields.append((tag, fieldType, len(values), packed.ljust(valueSize, b"\0")))
+            if fn.tell() % 2 == 1:
+                fn.write(b"\0")
+
+            ifdOffset = fn.tell()
+            fn.seek(ifdPointer)
+            fn.write(struct.pack(endian + offsetFmt, ifdOffset))
+            fn.seek(ifdOffset)
+            fn.write(struct.pack(endian + countFmt, len(fields)))
+            for tag, fieldType, count, value in fields:
+                fn.write(struct.pack(endian + "HH" + offsetFmt, tag, fieldType, count) + value)
+            ifdPointer = fn.tell()
+            fn.write(struct.pack(endian + offsetFmt, 0))
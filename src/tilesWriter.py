@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Background writing of the outputs of the pre-processing of a WSI, so that the thread normalizing the tiles does not wait for the storage.
+
+An asyncWriter runs the writes submitted to it (e.g. JPEG encoding and saving of the normalized tiles, copies of the discarded tiles) on
+a small pool of threads. At most maxPending writes are queued at a time: when the queue is full, submit blocks until a write completes,
+hence the memory held by the tiles waiting to be written is bounded. JPEG encoding and file writes release the GIL, so that the writes
+overlap with the normalization. close() waits for all the pending writes and re-raises the first error raised by any of them.
+
+The log of a WSI is written in the same way: queueLogging attaches a QueueHandler to the logger, whose records are written to the log
+file by a background listener; stopLogging flushes the records still queued and closes the log file.
+
+Example of usage:
+    writer = asyncWriter(threads=2)
+    writer.submit(saveJpeg, normTile, "path/to/norm_tile.jpg")
+    writer.close()
+"""
+
+import logging
+import logging.handlers
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+def saveJpeg(np_img, path):
+
+    ''' Encodes the given tile as JPEG and saves it to path.'''
+
+    Image.fromarray(np_img).save(path)
+
+
+class asyncWriter:
+
+    '''
+    Runs the submitted writes on threads threads, with at most maxPending writes queued at a time. With threads = 0 the writes are run
+    right away by the submitting thread (synchronous writing).
+    '''
+
+    def __init__(self, threads=2, maxPending=64):
+
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="tilesWriter") if threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(1, maxPending))
+        self.lock = threading.Lock()
+        self.error = None
+        self.closed = False
+
+    def submit(self, func, *args):
+
+        ''' Queues the call func(*args), blocking while maxPending writes are already queued. Errors of previous writes are raised here.'''
+
+        self.raiseError()
+        if self.pool is None:
+            func(*args)
+            return
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(func, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+
+        self.slots.release()
+        if future.exception() is not None:
+            with self.lock:
+                if self.error is None:
+                    self.error = future.exception()
+
+    def raiseError(self):
+
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def close(self, raiseErrors=True):
+
+        ''' Waits for all the pending writes. If raiseErrors is True, the first error raised by a write (if any) is raised.'''
+
+        if not self.closed:
+            self.closed = True
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+        if raiseErrors:
+            self.raiseError()
+
+
+def queueLogging(logger, handler):
+
+    ''' Attaches to the logger a QueueHandler whose records are written through handler by a background listener, which is returned.'''
+
+    logQueue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(logQueue, handler, respect_handler_level=True)
+    logger.addHandler(logging.handlers.QueueHandler(logQueue))
+    listener.start()
+    return listener
+
+
+def stopLogging(logger, listener):
+
+    ''' Removes all the handlers from the logger, writes the records still queued and closes the handlers of the listener.'''
+
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from tilesTiff import annotationTiles, gridTiles, tiffSlide, writeTiledTiff
+
+
+def syntheticImage(height=700, width=1000):
+
+    '''Smooth RGB image (so that JPEG compression only slightly changes it) whose size is not a multiple of the tile size.'''
+
+    y, x = np.mgrid[0:height, 0:width]
+    return np.stack(((x * 255 // width), (y * 255 // height), ((x + y) * 255 // (width + height))), axis=-1).astype(np.uint8)
+
+
+def downsampled(img):
+
+    previous = img[:img.shape[0] // 2 * 2, :img.shape[1] // 2 * 2].astype(np.uint16)
+    return ((previous[0::2, 0::2] + previous[1::2, 0::2] + previous[0::2, 1::2] + previous[1::2, 1::2] + 2) // 4).astype(np.uint8)
+
+
+def assertClose(region, expected, compression):
+
+    # JPEG tiles are lossy: only the mean error is bounded
+    if compression == "jpeg":
+        assert np.abs(region.astype(int) - expected.astype(int)).mean() < 3
+    else:
+        np.testing.assert_array_equal(region, expected)
+
+
+@pytest.fixture(params=[(None, False), ("deflate", False), ("jpeg", False), (None, True), ("deflate", True)],
+                ids=["none", "deflate", "jpeg", "bigtiff", "bigtiff-deflate"])
+def pyramid(request, tmp_path):
+
+    compression, bigTiff = request.param
+    img = syntheticImage()
+    path = str(tmp_path / "slide.tif")
+    writeTiledTiff(path, img, tileSize=256, numLevels=3, compression=compression, bigTiff=bigTiff)
+    slide = tiffSlide(path)
+    yield slide, img, compression, bigTiff
+    slide.close()
+
+
+def test_levels(pyramid):
+
+    slide, img, compression, bigTiff = pyramid
+    assert slide.bigTiff == bigTiff
+    assert [(level["width"], level["height"]) for level in slide.levels] == [(1000, 700), (500, 350), (250, 175)]
+    assert slide.downsample(1) == 2 and slide.downsample(2) == 4
+    assertClose(slide.readRegion(0, 0, 500, 350, level=1), downsampled(img), compression)
+
+
+def test_readRegion(pyramid):
+
+    slide, img, compression, bigTiff = pyramid
+    # A single tile of the file, and a region spanning four tiles
+    assertClose(slide.readRegion(256, 256, 256, 256), img[256:512, 256:512], compression)
+    assertClose(slide.readRegion(200, 100, 300, 250), img[100:350, 200:500], compression)
+
+
+def test_readRegionPadding(pyramid):
+
+    slide, img, compression, bigTiff = pyramid
+    # Past the right and bottom borders (the last tiles of the file are only partly covered by the image)
+    region = slide.readRegion(768, 512, 512, 512)
+    assertClose(region[:188, :232], img[512:, 768:], compression)
+    assert (region[188:] == 255).all() and (region[:, 232:] == 255).all()
+    # Before the top-left corner
+    region = slide.readRegion(-100, -50, 200, 200)
+    assertClose(region[50:, 100:], img[:150, :100], compression)
+    assert (region[:50] == 255).all() and (region[:, :100] == 255).all()
+    # Entirely outside the image
+    assert (slide.readRegion(2000, 2000, 64, 64) == 255).all()
+
+
+def square(x0, y0, x1, y1):
+
+    return [np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=np.float64)]
+
+
+def test_annotationTiles():
+
+    # A 4 x 3 tiles image: the square covers the centers of the tiles (1, 1) and (1, 2) and its edges cross the tiles around them
+    assert annotationTiles([square(600, 600, 1400, 900)], 2048, 1536, 512) == [(1, 1), (1, 2)]
+    assert annotationTiles([square(300, 300, 1100, 700)], 2048, 1536, 512) == [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)]
+    # Tiles within a hole of the polygon are excluded, the ones crossed by the edges of the hole are not
+    outer, hole = square(10, 10, 2038, 1526)[0], square(520, 520, 1000, 1000)[0]
+    cells = annotationTiles([[outer, hole]], 2048, 1536, 512)
+    assert (1, 1) in cells and len(cells) == 12
+    cells = annotationTiles([[outer, square(400, 400, 1100, 1100)[0]]], 2048, 1536, 512)
+    assert (1, 1) not in cells and len(cells) == 11
+    # The scale divides the vertices (e.g. the downsampling factor of a level)
+    assert annotationTiles([square(1200, 1200, 2800, 1800)], 1024, 768, 512, scale=2) == [(1, 1)]
+
+
+def test_annotationTilesBorders():
+
+    # Polygons going past the borders of the image only mark the tiles of the image they intersect
+    assert annotationTiles([square(-1000, -1000, 5000, 5000)], 2048, 1536, 512) == [(row, col) for row in range(3) for col in range(4)]
+    assert annotationTiles([square(-300, -300, 300, 300)], 2048, 1536, 512) == [(0, 0)]
+    assert annotationTiles([square(1900, 1400, 3000, 3000)], 2048, 1536, 512) == [(2, 3)]
+    # A triangle whose edges start above the image (its right edge enters the tile (1, 2) at x = 1050)
+    assert annotationTiles([[np.array([[600, -800], [1400, -800], [1000, 700]])]], 2048, 1536, 512) == [(0, 1), (0, 2), (1, 1), (1, 2)]
+    # Polygons outside the image
+    assert annotationTiles([square(-900, -900, -100, -100)], 2048, 1536, 512) == []
+    assert annotationTiles([square(2100, 100, 3000, 900)], 2048, 1536, 512) == []
+
+
+def test_gridTiles(pyramid):
+
+    slide, img, compression, bigTiff = pyramid
+    origins = gridTiles(slide, [square(300, 300, 700, 600)], tileSize=256, level=1, name="slide")
+    # Level 1 is 500 x 350 pixels: the square covers the tiles (0, 0), (0, 1), (1, 0) and (1, 1), named after their centers in level 0
+    assert origins == {"slide_(256.0_256.0)_1.jpg": (0, 0), "slide_(768.0_256.0)_2.jpg": (256, 0),
+                       "slide_(256.0_768.0)_3.jpg": (0, 256), "slide_(768.0_768.0)_4.jpg": (256, 256)}